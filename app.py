@@ -1,35 +1,103 @@
 """
 Main application module for the eyewear bot
+
+``create_app()`` builds the Flask app; gunicorn loads ``app:app``, which
+calls it on first access. Importing this module only imports Flask and the
+configuration: the query handler, WeChat crypto and scheduler (with
+wechatpy, pymysql and apscheduler behind them) are created when first
+needed, see components.py.
 """
-from flask import Flask, request, jsonify, make_response
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, make_response
 import atexit
-from config import FLASK_PORT
-from scheduler import start_scheduler
-from query_handler import QueryHandler
-from wechat_bot import WeChatBot
-from wechatpy.enterprise.crypto import WeChatCrypto
-from wechatpy.enterprise import parse_message, create_reply
+import hmac
 import os
 import logging
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime
+from config import (
+    FLASK_PORT,
+    WECHAT_REPLY_MODE,
+    DEDUP_WAIT_TIMEOUT,
+    DEBUG_TOKEN,
+    DEBUG_PROFILE_MAX_SECONDS,
+    WARMUP_ENABLED,
+    check_config,
+)
+from components import BotComponents
+from dedup import message_key
+from metrics import REGISTRY, CALLBACK_DECRYPT_SECONDS, REPLY_ENCRYPT_SECONDS, ERRORS
+
+
+bp = Blueprint('eyewear_bot', __name__)
+
+
+def components():
+    """The BotComponents of the app handling the current request"""
+    return current_app.extensions['eyewear_bot']
+
+
+def configure_logging():
+    """Log INFO and above with timestamps (a no-op if logging is already set up)"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s',
+    )
+
+
+def create_app(start_scheduler=True, warm_up=WARMUP_ENABLED):
+    """
+    Build the Flask app
+
+    Args:
+        start_scheduler: Start the background jobs (tests and tools pass False)
+        warm_up: Open pooled connections and prime the report cache in the
+            background; /ready reports when that has finished
+
+    Returns:
+        Flask: The app, with its BotComponents in ``app.extensions['eyewear_bot']``
+    """
+    check_config()
+    configure_logging()
+    app = Flask(__name__)
+    bot_components = BotComponents()
+    app.extensions['eyewear_bot'] = bot_components
+    app.register_blueprint(bp)
+    REGISTRY.register_collector(bot_components.collect_runtime_metrics, key='bot_components')
+    atexit.register(bot_components.shutdown)
+
+    if start_scheduler:
+        bot_components.start_scheduler()
+    if warm_up:
+        bot_components.start_warm_up()
+    else:
+        bot_components.ready.set()
+    return app
 
 
-app = Flask(__name__)
+_app = None
+_app_lock = threading.Lock()
 
-# Start the scheduler
-scheduler = start_scheduler()
 
-# Initialize query handler
-query_handler = QueryHandler()
+def get_app():
+    """Return the process-wide app, creating it on first use"""
+    global _app
+    with _app_lock:
+        if _app is None:
+            _app = create_app()
+        return _app
 
 
-TOKEN = os.getenv('WECHAT_TOKEN')
-AES_KEY = os.getenv('WECHAT_AES_KEY')
-CORP_ID = os.getenv('WECHAT_CORP_ID')
+def __getattr__(name):
+    # ``app.app`` (gunicorn's app:app) builds the app on first access
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-crypto = WeChatCrypto(TOKEN, AES_KEY, CORP_ID)
 
-@app.route('/wechat', methods=['GET', 'POST'])
+@bp.route('/wechat', methods=['GET', 'POST'])
 def wechat():
+    c = components()
     if request.method == 'GET':
         # 企业微信验证URL
         msg_signature = request.args.get('msg_signature')
@@ -37,9 +105,10 @@ def wechat():
         nonce = request.args.get('nonce')
         echostr = request.args.get('echostr')
         try:
-            echo = crypto.check_signature(msg_signature, timestamp, nonce, echostr)
+            echo = c.crypto.check_signature(msg_signature, timestamp, nonce, echostr)
             return echo
         except Exception as e:
+            ERRORS.inc(where='callback_verify')
             return str(e), 400
 
     # POST: 接收消息
@@ -48,78 +117,219 @@ def wechat():
     nonce = request.args.get('nonce')
     xml = request.data
     try:
-        decrypted_xml = crypto.decrypt_message(xml, msg_signature, timestamp, nonce)
+        from wechatpy.enterprise import parse_message, create_reply
+        with CALLBACK_DECRYPT_SECONDS.time():
+            decrypted_xml = c.crypto.decrypt_message(xml, msg_signature, timestamp, nonce)
         msg = parse_message(decrypted_xml)
         # 处理消息内容
-        if msg.type == 'text':
-            reply_content = query_handler.process_query(msg.content)
-            reply = create_reply(reply_content, msg)
-        elif msg.type == 'event':
-            # 处理事件消息（如菜单点击）
-            ev = getattr(msg, 'event', '') or getattr(msg, 'Event', '') or ''
-            key = getattr(msg, 'key', '') or getattr(msg, 'EventKey', '') or ''
-            logging.info(f"收到 event: {ev}, key: {key}")
-            if str(ev).lower() == 'click':
-                k = str(key).upper()
-                logging.info(f"menu click key received: {k}")
-                if k == 'TODAY_ORDER':
-                    # 菜单点击等同于用户输入“今日”
-                    reply_content = query_handler.process_query('今日')
-                elif k == 'YESTERDAY_ORDER':
-                    # 菜单点击等同于用户输入“昨日”
-                    reply_content = query_handler.process_query('昨日')
-                elif k == 'THIS_MONTH_ORDER':
-                    # 菜单点击等同于用户输入“本月”
-                    reply_content = query_handler.process_query('本月')
+        query_text, reply_content = resolve_message(msg)
+        if query_text is not None:
+            key = message_key(msg)
+            future, is_new = c.deduplicator.claim(key)
+            if not is_new:
+                # 企业微信重试的同一条消息：复用进行中或已生成的回复，不再重复查询
+                logging.info(f"重复回调: {key}")
+                if WECHAT_REPLY_MODE == 'async':
+                    return '', 200
+                try:
+                    reply_content = future.result(timeout=DEDUP_WAIT_TIMEOUT)
+                except FutureTimeoutError:
+                    # 仍未算完：先应答，结果算完后主动推送
+                    if c.deduplicator.request_push(key):
+                        source = msg.source
+                        dispatcher = c.reply_dispatcher
+                        future.add_done_callback(
+                            lambda f: f.exception() is None and dispatcher.deliver(source, f.result())
+                        )
+                    return '', 200
+            elif WECHAT_REPLY_MODE == 'async':
+                # 先应答，报表由后台线程计算后主动推送，避免超过企业微信 5 秒回调时限
+                if c.deduplicator.claim_shared(key):
+                    c.reply_dispatcher.submit(msg.source, query_text)
                 else:
-                    reply_content = '不能处理的菜单命令'
-                reply = create_reply(reply_content, msg)
+                    # 重试落到了另一个工作进程：第一次投递所在的进程负责推送
+                    logging.info(f"重复回调（其他进程）: {key}")
+                future.set_result(None)
+                return '', 200
             else:
-                reply = create_reply('不能处理的菜单命令', msg)
-        else:
-            reply = create_reply('不支持非文本命令', msg)
-        encrypted_reply = crypto.encrypt_message(reply.render(), nonce, timestamp)
+                try:
+                    reply_content = c.query_handler.process_query(query_text)
+                except Exception as e:
+                    future.set_exception(e)
+                    raise
+                future.set_result(reply_content)
+        with REPLY_ENCRYPT_SECONDS.time():
+            reply = create_reply(reply_content, msg)
+            encrypted_reply = c.crypto.encrypt_message(reply.render(), nonce, timestamp)
         response = make_response(encrypted_reply)
         response.content_type = 'application/xml'
         return response
     except Exception as e:
+        ERRORS.inc(where='callback')
         return str(e), 400
 
 
+def resolve_message(msg):
+    """
+    Work out what a decrypted callback message asks for
 
-@app.route('/health', methods=['GET'])
+    Args:
+        msg: Message parsed by wechatpy
+
+    Returns:
+        tuple: (query_text, None) when a report query should be run, or
+        (None, reply_content) when the reply is a fixed message
+    """
+    if msg.type == 'text':
+        return msg.content, None
+    if msg.type == 'event':
+        # 处理事件消息（如菜单点击）
+        ev = getattr(msg, 'event', '') or getattr(msg, 'Event', '') or ''
+        key = getattr(msg, 'key', '') or getattr(msg, 'EventKey', '') or ''
+        logging.info(f"收到 event: {ev}, key: {key}")
+        if str(ev).lower() == 'click':
+            k = str(key).upper()
+            logging.info(f"menu click key received: {k}")
+            if k == 'TODAY_ORDER':
+                # 菜单点击等同于用户输入“今日”
+                return '今日', None
+            elif k == 'YESTERDAY_ORDER':
+                # 菜单点击等同于用户输入“昨日”
+                return '昨日', None
+            elif k == 'THIS_MONTH_ORDER':
+                # 菜单点击等同于用户输入“本月”
+                return '本月', None
+        return None, '不能处理的菜单命令'
+    return None, '不支持非文本命令'
+
+
+@bp.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
+    from scheduler import is_scheduler_leader
+    from wechat_bot import outbound_queue_stats
+
+    c = components()
+    query_handler = c.query_handler
+    db = query_handler.db
     return jsonify({
         "status": "healthy",
-        "scheduler_running": scheduler.running
+        "scheduler_running": c.scheduler is not None and c.scheduler.running,
+        "scheduler_leader": is_scheduler_leader(),
+        "pid": os.getpid(),
+        "readiness": c.readiness(),
+        "db_pool": db.pool_stats(),
+        "db_replicas": db.replicas.stats() if db.replicas is not None else None,
+        "db_breaker": db.breaker.stats() if db.breaker is not None else None,
+        "last_good": query_handler.last_good.stats() if query_handler.last_good is not None else None,
+        "result_cache": db.cache_stats(),
+        "reply_mode": WECHAT_REPLY_MODE,
+        "async_replies": c.reply_dispatcher.stats(),
+        "dedup": c.deduplicator.stats(),
+        "single_flight": query_handler.single_flight.stats(),
+        "outbound_queue": outbound_queue_stats(),
+        "sales_cube": db.cube.stats() if db.cube is not None else None,
+        "today_counters": query_handler.today_counters.stats() if query_handler.today_counters is not None else None,
+        "snapshots": query_handler.snapshots.stats() if query_handler.snapshots is not None else None,
+        "sales_directory": db.sales_directory.stats() if db.sales_directory is not None else None,
+        "embedded_backend": db.backend.stats() if db.backend is not None else None
     }), 200
 
 
-@app.route('/trigger_daily_report', methods=['POST'])
+@bp.route('/ready', methods=['GET'])
+def ready():
+    """Readiness probe: 503 until the startup warm-up has finished"""
+    readiness = components().readiness()
+    return jsonify(readiness), 200 if readiness['ready'] else 503
+
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def debug_allowed():
+    """Whether the request carries DEBUG_TOKEN (always False when it is unset)"""
+    return bool(DEBUG_TOKEN) and hmac.compare_digest(request.headers.get('X-Debug-Token', ''), DEBUG_TOKEN)
+
+
+@bp.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    """
+    Sample every thread's stack for a while and return collapsed stacks
+
+    Query: seconds (default 10, at most DEBUG_PROFILE_MAX_SECONDS),
+    interval (seconds between samples). Feed the output to flamegraph.pl
+    or speedscope. Needs the X-Debug-Token header.
+    """
+    if not debug_allowed():
+        return '', 404
+    try:
+        seconds = min(float(request.args.get('seconds', 10)), DEBUG_PROFILE_MAX_SECONDS)
+        interval = request.args.get('interval')
+        interval = max(float(interval), 0.001) if interval else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    from profiler import get_default_profiler, ProfilerBusyError
+
+    profiler = get_default_profiler()
+    try:
+        stacks, rounds = profiler.profile(seconds, interval)
+    except ProfilerBusyError as e:
+        return jsonify({"error": str(e)}), 409
+    logging.info(f"性能分析完成: {seconds}s, {rounds} 轮采样")
+    return Response(profiler.render(stacks), mimetype='text/plain')
+
+
+@bp.route('/debug/slow_queries', methods=['GET'])
+def debug_slow_queries():
+    """Recent statements slower than SLOW_QUERY_MS, most recent first (needs X-Debug-Token)"""
+    if not debug_allowed():
+        return '', 404
+    from slowlog import get_default_slow_query_log
+
+    log = get_default_slow_query_log()
+    if log is None:
+        return jsonify({"error": "SLOW_QUERY_MS 未设置"}), 404
+    return jsonify({"stats": log.stats(), "queries": log.entries()}), 200
+
+
+@bp.route('/trigger_daily_report', methods=['POST'])
 def trigger_daily_report():
     """
     Manual trigger endpoint for daily report (for testing)
     """
     try:
         from scheduler import daily_report_job
-        daily_report_job()
+        daily_report_job(force=True)
         return jsonify({"status": "success", "message": "Daily report triggered"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
-def shutdown_scheduler():
-    """Shutdown the scheduler gracefully"""
-    if scheduler.running:
-        scheduler.shutdown()
-        print("Scheduler shut down")
-
+@bp.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    """
+    Drop cached report results for a date range
 
-# Register shutdown handler
-atexit.register(shutdown_scheduler)
+    Body (JSON, optional): {"start_date": "YYYY-MM-DD", "end_date": "YYYY-MM-DD"}
+    Without a start_date the whole cache is cleared. Use after back-dating
+    orders or loading late leads.
+    """
+    try:
+        body = request.get_json(silent=True) or {}
+        start = body.get('start_date')
+        end = body.get('end_date')
+        start_date = datetime.strptime(start, '%Y-%m-%d').date() if start else None
+        end_date = datetime.strptime(end, '%Y-%m-%d').date() if end else None
+        removed = components().query_handler.db.invalidate_cache(start_date, end_date)
+        return jsonify({"status": "success", "removed": removed}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
 
 
 if __name__ == '__main__':
+    # Development server; in production run gunicorn -c gunicorn.conf.py app:app
     print(f"Starting eyewear bot on port {FLASK_PORT}")
-    app.run(host='0.0.0.0', port=FLASK_PORT, debug=False)
+    get_app().run(host='0.0.0.0', port=FLASK_PORT, debug=False)
@@ -0,0 +1,230 @@
+"""
+Parquet archive of closed days
+
+Optional: requires pyarrow. Each settled day of ``leads`` and
+``sales_orders`` is written once to ``<ARCHIVE_DIR>/<table>/dt=YYYY-MM-DD/``
+as a compressed Parquet file; later exports only append days after the last
+archived one. Reads open the files memory-mapped as a hive-partitioned
+dataset and filter on ``dt``, so only the partitions of the requested days
+are touched. Used as a ``ReportBackend`` (EMBEDDED_BACKEND=parquet).
+"""
+import json
+import os
+import shutil
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+from config import ARCHIVE_DIR, ARCHIVE_SETTLE_DAYS, ARCHIVE_COMPRESSION, EMBEDDED_HISTORY_DAYS
+from backends import ReportBackend, SYNC_CHUNK_DAYS, _to_date
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional
+    pa = None
+
+TABLES = ('leads', 'sales_orders')
+
+
+class ParquetArchive(ReportBackend):
+    """
+    Day-partitioned Parquet files of the report columns
+
+    A day is archived once it is ``settle_days`` old, on the assumption
+    that it no longer changes; rows back-dated after that are not picked
+    up. ``_manifest.json`` records the archived day range and the sales
+    key type; the files of a day are in place before the manifest
+    includes it.
+    """
+
+    name = 'parquet'
+
+    def __init__(self, root=ARCHIVE_DIR, settle_days=ARCHIVE_SETTLE_DAYS, compression=ARCHIVE_COMPRESSION):
+        if pa is None:
+            raise RuntimeError("pyarrow 未安装")
+        self.root = root
+        self.settle_days = settle_days
+        self.compression = compression
+        self.synced_at = None
+        self._manifest = None
+        self._manifest_mtime = None
+        self._datasets = {}
+        self._filesystem = pafs.LocalFileSystem(use_mmap=True)
+        self._lock = threading.Lock()
+
+    @property
+    def _manifest_path(self):
+        return os.path.join(self.root, '_manifest.json')
+
+    def _load_manifest(self):
+        """Read the manifest, re-reading it when another process exported days"""
+        try:
+            mtime = os.path.getmtime(self._manifest_path)
+        except OSError:
+            return None
+        with self._lock:
+            if mtime != self._manifest_mtime:
+                with open(self._manifest_path, encoding='utf-8') as f:
+                    self._manifest = json.load(f)
+                self._manifest_mtime = mtime
+                self._datasets = {}
+            return self._manifest
+
+    def _save_manifest(self, manifest):
+        tmp = self._manifest_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self._manifest_path)
+
+    def coverage(self):
+        manifest = self._load_manifest()
+        if not manifest or not manifest.get('last_day'):
+            return None
+        return _to_date(manifest['first_day']), _to_date(manifest['last_day'])
+
+    def _schema(self, table, sales_type):
+        sales = pa.int64() if sales_type == 'int' else pa.string()
+        if table == 'leads':
+            return pa.schema([('sales', sales), ('leads_id', pa.string())])
+        return pa.schema([('sales', sales), ('price_cents', pa.int64()), ('order_id', pa.int64())])
+
+    def _write_day(self, table, day, rows, sales_type):
+        directory = os.path.join(self.root, table, f"dt={day.isoformat()}")
+        os.makedirs(directory, exist_ok=True)
+        schema = self._schema(table, sales_type)
+        columns = list(zip(*rows)) if rows else [[] for _ in schema.names]
+        data = pa.table([pa.array(list(values), type=field.type) for values, field in zip(columns, schema)],
+                        schema=schema)
+        path = os.path.join(directory, 'part-0.parquet')
+        pq.write_table(data, path + '.tmp', compression=self.compression)
+        os.replace(path + '.tmp', path)
+
+    def sync(self, db, history_days=EMBEDDED_HISTORY_DAYS):
+        """
+        Export settled days that are not archived yet
+
+        The first export covers the last ``history_days`` settled days.
+        Archived days are never rewritten, except that a change of the
+        sales key (SALES_DIMENSION_ENABLED) starts a new archive.
+
+        Args:
+            db: Database to read from
+
+        Returns:
+            int: Number of days exported
+        """
+        sales_type = 'int' if db.sales_column == 'sales_id' else 'str'
+        last_day = datetime.now().date() - timedelta(days=max(self.settle_days, 1))
+        manifest = self._load_manifest()
+        if manifest and manifest.get('sales_type') != sales_type:
+            for table in TABLES:
+                shutil.rmtree(os.path.join(self.root, table), ignore_errors=True)
+            manifest = None
+        if manifest and manifest.get('last_day'):
+            start_date = _to_date(manifest['last_day']) + timedelta(days=1)
+        else:
+            start_date = last_day - timedelta(days=history_days - 1)
+            manifest = {'first_day': start_date.isoformat(), 'last_day': None, 'sales_type': sales_type}
+        os.makedirs(self.root, exist_ok=True)
+
+        exported = 0
+        day = start_date
+        while day <= last_day:
+            chunk_end = min(day + timedelta(days=SYNC_CHUNK_DAYS - 1), last_day)
+            leads, orders = db.export_fact_rows(day, chunk_end)
+            by_day = {table: defaultdict(list) for table in TABLES}
+            for leads_date, sales, leads_id in leads:
+                by_day['leads'][_to_date(leads_date)].append((sales, leads_id))
+            for order_date, sales, cents, order_id in orders:
+                by_day['sales_orders'][_to_date(order_date)].append((sales, int(cents), order_id))
+            while day <= chunk_end:
+                for table in TABLES:
+                    self._write_day(table, day, by_day[table].get(day, []), sales_type)
+                day += timedelta(days=1)
+                exported += 1
+            manifest['last_day'] = chunk_end.isoformat()
+            self._save_manifest(manifest)
+        self.synced_at = time.time()
+        return exported
+
+    def _dataset(self, table):
+        with self._lock:
+            dataset = self._datasets.get(table)
+            if dataset is None:
+                dataset = ds.dataset(
+                    os.path.join(self.root, table),
+                    format='parquet',
+                    partitioning=ds.partitioning(pa.schema([('dt', pa.string())]), flavor='hive'),
+                    filesystem=self._filesystem,
+                    exclude_invalid_files=True,
+                )
+                self._datasets[table] = dataset
+            return dataset
+
+    def _read(self, table, columns, start_date, end_date):
+        self._load_manifest()
+        day_filter = (ds.field('dt') >= start_date.isoformat()) & (ds.field('dt') <= end_date.isoformat())
+        return self._dataset(table).to_table(columns=columns, filter=day_filter)
+
+    def _aggregate(self, keys, start_date, end_date):
+        """Leads and orders grouped by ``keys``: {key tuple: [leads, orders, cents]}"""
+        totals = defaultdict(lambda: [0, 0, 0])
+        leads = self._read('leads', keys + ['leads_id'], start_date, end_date) \
+            .group_by(keys).aggregate([('leads_id', 'count')])
+        for row in leads.to_pylist():
+            totals[tuple(row[k] for k in keys)][0] = row['leads_id_count']
+        orders = self._read('sales_orders', keys + ['order_id', 'price_cents'], start_date, end_date) \
+            .group_by(keys).aggregate([('order_id', 'count'), ('price_cents', 'sum')])
+        for row in orders.to_pylist():
+            total = totals[tuple(row[k] for k in keys)]
+            total[1] = row['order_id_count']
+            total[2] = row['price_cents_sum'] or 0
+        return totals
+
+    def sales_rows(self, start_date, end_date):
+        return [
+            {
+                'sales': sales,
+                'leads_count': leads_count,
+                'orders_count': orders_count,
+                'total_sales': Decimal(cents) / 100,
+            }
+            for (sales,), (leads_count, orders_count, cents) in self._aggregate(['sales'], start_date, end_date).items()
+        ]
+
+    def daily_totals(self, start_date, end_date):
+        leads_by_day = {}
+        orders_by_day = {}
+        for (dt,), (leads_count, orders_count, cents) in self._aggregate(['dt'], start_date, end_date).items():
+            if leads_count:
+                leads_by_day[dt] = leads_count
+            if orders_count:
+                orders_by_day[dt] = {'orders_count': orders_count, 'total_sales': cents // 100}
+        return leads_by_day, orders_by_day
+
+    def daily_sales_rows(self, start_date, end_date):
+        return [
+            {
+                'day': _to_date(dt),
+                'sales': sales,
+                'leads_count': leads_count,
+                'orders_count': orders_count,
+                'total_sales': Decimal(cents) / 100,
+            }
+            for (dt, sales), (leads_count, orders_count, cents)
+            in self._aggregate(['dt', 'sales'], start_date, end_date).items()
+        ]
+
+    def stats(self):
+        coverage = self.coverage()
+        return {
+            'engine': self.name,
+            'path': self.root,
+            'first_day': coverage[0].strftime('%Y-%m-%d') if coverage else None,
+            'last_day': coverage[1].strftime('%Y-%m-%d') if coverage else None,
+            'age_seconds': round(time.time() - self.synced_at, 1) if self.synced_at else None,
+        }
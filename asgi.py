@@ -0,0 +1,232 @@
+"""
+Native asyncio entry point for the eyewear bot
+
+Optional: requires starlette, aiomysql and httpx, plus an ASGI server:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Serves /wechat, /health, /ready, /metrics and /trigger_daily_report on one
+event loop. Report queries run on an aiomysql pool (async_database.py) and
+background replies are pushed with httpx (async_wechat.py), so a callback
+waiting on MySQL or WeChat holds a coroutine instead of a thread and one
+process handles hundreds of concurrent callbacks. The scheduler, warm-up,
+deduplication and metrics are those of the Flask app (components.py).
+"""
+import asyncio
+import logging
+import os
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+from config import WECHAT_REPLY_MODE, DEDUP_WAIT_TIMEOUT, WARMUP_ENABLED, check_config
+from app import configure_logging, resolve_message
+from async_query_handler import AsyncQueryHandler
+from async_wechat import AsyncWeChatAppClient, close_async_client
+from components import BotComponents
+from dedup import message_key
+from metrics import REGISTRY, CALLBACK_DECRYPT_SECONDS, REPLY_ENCRYPT_SECONDS, ERRORS
+
+
+class AsyncBot:
+    """Request handlers of the ASGI app and the replies they push in the background"""
+
+    def __init__(self, start_scheduler=True, warm_up=WARMUP_ENABLED):
+        self.components = BotComponents(query_handler_factory=AsyncQueryHandler)
+        self.start_scheduler = start_scheduler
+        self.warm_up = warm_up
+        self._app_client = None
+        # Keeps background reply tasks referenced until they finish
+        self._tasks = set()
+
+    @property
+    def app_client(self):
+        if self._app_client is None:
+            self._app_client = AsyncWeChatAppClient()
+        return self._app_client
+
+    async def startup(self):
+        configure_logging()
+        REGISTRY.register_collector(self.components.collect_runtime_metrics, key='bot_components')
+        if self.start_scheduler:
+            await asyncio.to_thread(self.components.start_scheduler)
+        if self.warm_up:
+            self.components.start_warm_up()
+        else:
+            self.components.ready.set()
+
+    async def shutdown(self):
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=DEDUP_WAIT_TIMEOUT)
+        self.components.shutdown()
+        await self.components.query_handler.adb.close()
+        await close_async_client()
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def deliver(self, touser, content):
+        """Async ``ReplyDispatcher.deliver``: app message to the sender, never the group robot"""
+        if not self.app_client.configured:
+            logging.warning(f"未配置企业微信应用凭据，无法推送回复给 {touser}")
+            return False
+        return await self.app_client.send_text_message_async(touser, content)
+
+    async def reply_later(self, touser, query_text, future):
+        try:
+            content = await self.components.query_handler.process_query_async(query_text)
+        except Exception as e:
+            logging.error(f"后台回复失败: {str(e)}")
+            ERRORS.inc(where='async_reply')
+            future.set_exception(e)
+            return
+        future.set_result(None)
+        await self.deliver(touser, content)
+
+    async def push_when_done(self, touser, waiter):
+        try:
+            content = await waiter
+        except Exception:
+            return
+        await self.deliver(touser, content)
+
+    async def wechat(self, request):
+        c = self.components
+        params = request.query_params
+        msg_signature = params.get('msg_signature')
+        timestamp = params.get('timestamp')
+        nonce = params.get('nonce')
+        if request.method == 'GET':
+            # 企业微信验证URL
+            try:
+                echo = c.crypto.check_signature(msg_signature, timestamp, nonce, params.get('echostr'))
+                return PlainTextResponse(echo)
+            except Exception as e:
+                ERRORS.inc(where='callback_verify')
+                return PlainTextResponse(str(e), status_code=400)
+
+        # POST: 接收消息
+        xml = await request.body()
+        try:
+            from wechatpy.enterprise import parse_message, create_reply
+            with CALLBACK_DECRYPT_SECONDS.time():
+                decrypted_xml = c.crypto.decrypt_message(xml, msg_signature, timestamp, nonce)
+            msg = parse_message(decrypted_xml)
+            query_text, reply_content = resolve_message(msg)
+            if query_text is not None:
+                key = message_key(msg)
+                future, is_new = c.deduplicator.claim(key)
+                if not is_new:
+                    # 企业微信重试的同一条消息：复用进行中或已生成的回复，不再重复查询
+                    logging.info(f"重复回调: {key}")
+                    if WECHAT_REPLY_MODE == 'async':
+                        return PlainTextResponse('')
+                    waiter = asyncio.wrap_future(future)
+                    try:
+                        reply_content = await asyncio.wait_for(asyncio.shield(waiter), DEDUP_WAIT_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        # 仍未算完：先应答，结果算完后主动推送
+                        if c.deduplicator.request_push(key):
+                            self.spawn(self.push_when_done(msg.source, waiter))
+                        return PlainTextResponse('')
+                elif WECHAT_REPLY_MODE == 'async':
+                    # 先应答，报表在事件循环上计算后主动推送
+                    if c.deduplicator.claim_shared(key):
+                        self.spawn(self.reply_later(msg.source, query_text, future))
+                    else:
+                        # 重试落到了另一个工作进程：第一次投递所在的进程负责推送
+                        logging.info(f"重复回调（其他进程）: {key}")
+                        future.set_result(None)
+                    return PlainTextResponse('')
+                else:
+                    try:
+                        reply_content = await c.query_handler.process_query_async(query_text)
+                    except Exception as e:
+                        future.set_exception(e)
+                        raise
+                    future.set_result(reply_content)
+            with REPLY_ENCRYPT_SECONDS.time():
+                reply = create_reply(reply_content, msg)
+                encrypted_reply = c.crypto.encrypt_message(reply.render(), nonce, timestamp)
+            return Response(encrypted_reply, media_type='application/xml')
+        except Exception as e:
+            ERRORS.inc(where='callback')
+            return PlainTextResponse(str(e), status_code=400)
+
+    async def health(self, request):
+        """Health check endpoint"""
+        from scheduler import is_scheduler_leader
+        from wechat_bot import outbound_queue_stats
+
+        c = self.components
+        query_handler = c.query_handler
+        db = query_handler.db
+        return JSONResponse({
+            "status": "healthy",
+            "server": "asgi",
+            "scheduler_running": c.scheduler is not None and c.scheduler.running,
+            "scheduler_leader": is_scheduler_leader(),
+            "pid": os.getpid(),
+            "readiness": c.readiness(),
+            "db_pool": db.pool_stats(),
+            "db_replicas": db.replicas.stats() if db.replicas is not None else None,
+            "db_breaker": db.breaker.stats() if db.breaker is not None else None,
+            "async_db_pool": query_handler.adb.pool_stats(),
+            "result_cache": db.cache_stats(),
+            "reply_mode": WECHAT_REPLY_MODE,
+            "background_replies": len(self._tasks),
+            "dedup": c.deduplicator.stats(),
+            "single_flight": query_handler.single_flight.stats(),
+            "outbound_queue": outbound_queue_stats(),
+        })
+
+    async def ready(self, request):
+        """Readiness probe: 503 until the startup warm-up has finished"""
+        readiness = self.components.readiness()
+        return JSONResponse(readiness, status_code=200 if readiness['ready'] else 503)
+
+    async def metrics(self, request):
+        """Prometheus scrape endpoint"""
+        return Response(REGISTRY.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+    async def trigger_daily_report(self, request):
+        """Manual trigger endpoint for daily report (for testing)"""
+        try:
+            from scheduler import daily_report_job
+            await asyncio.to_thread(daily_report_job, force=True)
+            return JSONResponse({"status": "success", "message": "Daily report triggered"})
+        except Exception as e:
+            return JSONResponse({"error": str(e)}, status_code=500)
+
+
+def create_app(start_scheduler=True, warm_up=WARMUP_ENABLED):
+    """
+    Build the ASGI app
+
+    Args:
+        start_scheduler: Start the background jobs on startup
+        warm_up: Warm up in the background on startup
+
+    Returns:
+        Starlette: The app, with its AsyncBot in ``app.state.bot``
+    """
+    check_config()
+    bot = AsyncBot(start_scheduler, warm_up)
+    app = Starlette(
+        routes=[
+            Route('/wechat', bot.wechat, methods=['GET', 'POST']),
+            Route('/health', bot.health, methods=['GET']),
+            Route('/ready', bot.ready, methods=['GET']),
+            Route('/metrics', bot.metrics, methods=['GET']),
+            Route('/trigger_daily_report', bot.trigger_daily_report, methods=['POST']),
+        ],
+        on_startup=[bot.startup],
+        on_shutdown=[bot.shutdown],
+    )
+    app.state.bot = bot
+    return app
+
+
+app = create_app()
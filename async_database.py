@@ -0,0 +1,262 @@
+"""
+asyncio report queries for the ASGI entry point
+
+Optional: requires aiomysql. ``AsyncDatabase`` runs the raw-table report
+statements of ``database.py`` on aiomysql pools and builds the same
+result shapes, so a slow query holds a coroutine instead of a thread. It
+shares the result cache, sales cube, sales directory, read replicas and
+slow query log with a ``Database``: each statement goes to the server
+``Database.get_read_connection`` would pick, through one aiomysql pool
+per server. Ranges answered from the embedded backend or the rollup
+tables are handed to that Database on a worker thread.
+"""
+import asyncio
+import time
+from datetime import datetime, timedelta
+from config import DB_CONFIG, ASYNC_DB_POOL_SIZE, DB_POOL_MAX_LIFETIME, ROLLUP_ENABLED
+from database import (
+    Database,
+    DB_FAILURES,
+    QueryTimeoutError,
+    COMBINED_STATS_SQL,
+    LEADS_BY_DAY_SQL,
+    ORDERS_BY_DAY_SQL,
+    _build_combined_rows,
+    _is_connection_error,
+    _fold_rollup_rows,
+    _merge_daily_totals,
+    _stats_to_rows,
+    _sum_rows_by_sales,
+)
+from deadlines import remaining, execution_time_ms
+from metrics import DB_QUERY_SECONDS
+from slowlog import get_default_slow_query_log
+
+try:
+    import aiomysql
+except ImportError:  # aiomysql is optional
+    aiomysql = None
+
+
+def _combined(leads_stats, orders_stats, start_date, end_date):
+    return {
+        'leads': leads_stats,
+        'orders': orders_stats,
+        'start_date': start_date.strftime('%Y-%m-%d'),
+        'end_date': end_date.strftime('%Y-%m-%d')
+    }
+
+
+class AsyncDatabase:
+    """Async counterpart of the ``Database`` report methods"""
+
+    def __init__(self, db=None, pool=None, slow_query_log=None):
+        self.db = db if db is not None else Database()
+        # aiomysql pool per server: None for the primary, else the replica's name
+        self._pools = {} if pool is None else {None: pool}
+        self._pool_lock = asyncio.Lock()
+        self.slow_query_log = slow_query_log if slow_query_log is not None else get_default_slow_query_log()
+
+    async def pool(self, replica=None):
+        """aiomysql pool of the primary, or of ``replica``, created on first use"""
+        key = None if replica is None else replica.name
+        if key not in self._pools:
+            async with self._pool_lock:
+                if key not in self._pools:
+                    if aiomysql is None:
+                        raise RuntimeError("aiomysql 未安装")
+                    config = dict(DB_CONFIG if replica is None else replica.pool.config)
+                    config['db'] = config.pop('database')
+                    config.pop('autocommit', None)
+                    # aiomysql has no socket read/write timeouts; query deadlines bound the waits
+                    config.pop('read_timeout', None)
+                    config.pop('write_timeout', None)
+                    self._pools[key] = await aiomysql.create_pool(
+                        minsize=1,
+                        maxsize=ASYNC_DB_POOL_SIZE,
+                        autocommit=True,
+                        pool_recycle=int(DB_POOL_MAX_LIFETIME) if DB_POOL_MAX_LIFETIME > 0 else -1,
+                        **config
+                    )
+        return self._pools[key]
+
+    def pool_stats(self):
+        """Usage of the primary's pool"""
+        pool = self._pools.get(None)
+        if pool is None:
+            return {'size': ASYNC_DB_POOL_SIZE, 'open': 0, 'idle': 0}
+        return {'size': pool.maxsize, 'open': pool.size, 'idle': pool.freesize}
+
+    async def close(self):
+        pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close()
+            await pool.wait_closed()
+
+    async def _fetchall(self, sql, params, start_date=None):
+        """
+        Run a read-only statement under the current query deadline
+
+        The server is chosen as ``Database.get_read_connection`` chooses it
+        (a usable replica, the primary for 今日 or when none is usable) and
+        the statement runs under that server's circuit breaker.
+        """
+        replica = self.db._read_replica(start_date)
+        breaker = self.db.breaker if replica is None else replica.breaker
+        if breaker is not None:
+            breaker.before_call()
+        try:
+            left = remaining()
+            rows = await asyncio.wait_for(self._execute(replica, sql, params),
+                                          None if left is None else max(left, 0))
+        except asyncio.TimeoutError:
+            if breaker is not None:
+                breaker.record_failure()
+            raise QueryTimeoutError("Query did not finish before the query deadline")
+        except DB_FAILURES as e:
+            if breaker is not None:
+                breaker.record_failure()
+            if replica is not None and _is_connection_error(e):
+                replica.lag = None
+                replica.error = str(e)
+            raise
+        except BaseException:
+            # Cancelled, or not the database's fault: neither a success nor a failure
+            if breaker is not None:
+                breaker.record_abandoned()
+            raise
+        if breaker is not None:
+            breaker.record_success()
+        return rows
+
+    async def _execute(self, replica, sql, params):
+        pool = await self.pool(replica)
+        conn = await pool.acquire()
+        try:
+            cursor = await conn.cursor(aiomysql.DictCursor)
+            # Same session limit as ConnectionPool._apply_deadline
+            ms = execution_time_ms()
+            if ms != getattr(conn, 'max_execution_time', 0):
+                await cursor.execute("SET SESSION MAX_EXECUTION_TIME = %s", (ms,))
+                conn.max_execution_time = ms
+            started = time.perf_counter()
+            rows = error = None
+            try:
+                await cursor.execute(sql, params)
+                rows = await cursor.fetchall()
+            except BaseException as e:
+                error = type(e).__name__
+                raise
+            finally:
+                if self.slow_query_log is not None:
+                    self.slow_query_log.record(sql, params, (time.perf_counter() - started) * 1000,
+                                               None if rows is None else len(rows), error)
+            await cursor.close()
+            return rows
+        except asyncio.CancelledError:
+            # Cut off mid-statement (e.g. by the query deadline): the server may
+            # still be sending its result, so the connection cannot be reused
+            conn.close()
+            raise
+        finally:
+            await pool.release(conn)
+
+    async def resolve_sales_names(self, rows):
+        """Async ``Database.resolve_sales_names``"""
+        directory = self.db.sales_directory
+        if directory is None:
+            return rows
+        sales_ids = {row['sales'] for row in rows if row['sales'] is not None}
+        if not sales_ids:
+            return rows
+        names = directory.lookup(sales_ids)
+        if names is None:
+            loaded = await self._fetchall("SELECT sales_id, name FROM sales_people", ())
+            names = directory.store({row['sales_id']: row['name'] for row in loaded})
+        for row in rows:
+            if row['sales'] is not None:
+                row['sales'] = names.get(row['sales'], f"#{row['sales']}")
+        return rows
+
+    def _delegated(self, query_type, start_date, end_date):
+        """Whether the range is answered by the backend or rollups, which stay on Database"""
+        return ROLLUP_ENABLED or self.db._backend_split(query_type, start_date, end_date)[0] is not None
+
+    def _cube_closed_end(self, start_date, end_date):
+        """Last closed day of the range when there is a cube to read it from, else None"""
+        closed_end = min(end_date, datetime.now().date() - timedelta(days=1))
+        if self.db.cube is None or start_date > closed_end:
+            return None
+        return closed_end
+
+    async def _cached(self, name, start_date, end_date, compute):
+        self.db.apply_shared_invalidations()
+        cache = self.db.cache
+        key = (name, start_date, end_date)
+        if cache is not None:
+            hit, value = cache.get(key)
+            if hit:
+                return value
+        value = await compute()
+        if cache is not None:
+            cache.put(key, value, start_date, end_date)
+        return value
+
+    async def get_combined_stats(self, start_date, end_date):
+        """Async ``Database.get_combined_stats``"""
+        with DB_QUERY_SECONDS.time(method='async_get_combined_stats'):
+            return await self._cached('get_combined_stats', start_date, end_date,
+                                      lambda: self._combined_stats(start_date, end_date))
+
+    async def _combined_stats(self, start_date, end_date):
+        closed_end = self._cube_closed_end(start_date, end_date)
+        rows = self.db.cube.range_rows(start_date, closed_end) if closed_end is not None else None
+        if rows is not None:
+            rows = await self.resolve_sales_names(rows)
+            if closed_end < end_date:
+                open_stats = await self.get_combined_stats(closed_end + timedelta(days=1), end_date)
+                rows = _sum_rows_by_sales(rows + _stats_to_rows(open_stats))
+            return _combined(*_build_combined_rows(rows), start_date, end_date)
+
+        if self._delegated('combined_stats', start_date, end_date):
+            return await asyncio.to_thread(self.db.get_combined_stats, start_date, end_date)
+
+        rows = await self._fetchall(self.db._sql(COMBINED_STATS_SQL), (start_date, end_date, start_date, end_date),
+                                    start_date)
+        leads_stats, orders_stats = _fold_rollup_rows(await self.resolve_sales_names(list(rows)))
+        return _combined(leads_stats, orders_stats, start_date, end_date)
+
+    async def _daily_totals(self, start_date, end_date):
+        leads, orders = await asyncio.gather(
+            self._fetchall(LEADS_BY_DAY_SQL, (start_date, end_date), start_date),
+            self._fetchall(ORDERS_BY_DAY_SQL, (start_date, end_date), start_date),
+        )
+        leads_by_day = {row['day'].strftime('%Y-%m-%d'): row['leads_count'] for row in leads}
+        orders_by_day = {
+            row['day'].strftime('%Y-%m-%d'): {'orders_count': row['orders_count'],
+                                              'total_sales': int(row['total_sales'] or 0)}
+            for row in orders
+        }
+        return leads_by_day, orders_by_day
+
+    async def get_stats_by_date(self, start_date, end_date):
+        """Async ``Database.get_stats_by_date``"""
+        with DB_QUERY_SECONDS.time(method='async_get_stats_by_date'):
+            return await self._cached('get_stats_by_date', start_date, end_date,
+                                      lambda: self._stats_by_date(start_date, end_date))
+
+    async def _stats_by_date(self, start_date, end_date):
+        closed_end = self._cube_closed_end(start_date, end_date)
+        cube_totals = self.db.cube.daily_totals(start_date, closed_end) if closed_end is not None else None
+        if cube_totals is not None:
+            leads_by_day, orders_by_day = cube_totals
+            if closed_end < end_date:
+                open_leads, open_orders = await self._daily_totals(closed_end + timedelta(days=1), end_date)
+                leads_by_day.update(open_leads)
+                orders_by_day.update(open_orders)
+            return _merge_daily_totals(leads_by_day, orders_by_day)
+
+        if self._delegated('stats_by_date', start_date, end_date):
+            return await asyncio.to_thread(self.db.get_stats_by_date, start_date, end_date)
+
+        return _merge_daily_totals(*await self._daily_totals(start_date, end_date))
@@ -0,0 +1,101 @@
+"""
+asyncio query handler for the ASGI entry point
+"""
+import asyncio
+import logging
+from datetime import datetime
+from async_database import AsyncDatabase
+from config import QUERY_DEADLINES
+from deadlines import deadline
+from metrics import QUERY_SECONDS
+from singleflight import FollowerTimeoutError
+from query_handler import QueryHandler, parse_query, report_range, report_label, last_good_key
+
+
+class AsyncQueryHandler(QueryHandler):
+    """
+    ``QueryHandler`` whose reports are built on the event loop
+
+    Commands, date ranges, snapshots, today counters and message formats
+    are the ones of QueryHandler; only the database reads go through
+    ``AsyncDatabase``. Identical queries arriving together share one task.
+    """
+
+    def __init__(self, adb=None):
+        super().__init__()
+        self.adb = adb if adb is not None else AsyncDatabase(self.db)
+        self._in_flight = {}
+
+    async def process_query_async(self, query_text):
+        """
+        Async ``QueryHandler.process_query``
+
+        Args:
+            query_text: Query text from user
+
+        Returns:
+            str: Response message
+        """
+        query_text = query_text.strip()
+        logging.info(f"收到 query_text: {query_text}")
+
+        command, args = parse_query(query_text)
+        if command is None:
+            logging.info("分支: 未知查询格式")
+            with QUERY_SECONDS.time(command='unknown'):
+                return self.handle_unknown_query()
+
+        logging.info(f"分支: {query_text}查询")
+        with QUERY_SECONDS.time(command=command):
+            key = (command, args, datetime.now().date())
+            task = self._in_flight.get(key)
+            if task is None:
+                self.single_flight.executed += 1
+                task = asyncio.ensure_future(self._report(command, *args))
+                self._in_flight[key] = task
+                task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+                # A caller that goes away must not cancel the report for the others
+                return await asyncio.shield(task)
+            self.single_flight.collapsed += 1
+            # Joining a running report waits no longer than the command's deadline
+            limit = QUERY_DEADLINES.get(command)
+            try:
+                return await asyncio.wait_for(asyncio.shield(task), limit)
+            except asyncio.TimeoutError:
+                error = FollowerTimeoutError(f"Shared call did not finish within {limit:.1f}s")
+                return self._failure_reply(last_good_key(command, args), report_label(command, args), error)
+
+    async def _report(self, command, *args):
+        """Async ``handle_*_query``: the same dispatch, snapshots and fallbacks"""
+        key = last_good_key(command, args)
+        try:
+            with deadline(QUERY_DEADLINES.get(command)):
+                if command == 'recent_days':
+                    invalid = self.check_days(*args)
+                    if invalid:
+                        return invalid
+                    return self._remember(key, await self._recent_days_report(*args))
+                snapshot = self._snapshot(command)
+                if snapshot is not None:
+                    return self._remember(key, *snapshot)
+                return self._remember(key, *await self._build_report(command))
+        except Exception as e:
+            return self._failure_reply(key, report_label(command, args), e)
+
+    async def _build_report(self, command):
+        """Async ``build_report``: only the database read is awaited"""
+        counted = self._counted_report(command)
+        if counted is not None:
+            return counted
+        start_date, end_date = report_range(command)
+        stats = await self.adb.get_combined_stats(start_date, end_date)
+        return self.render_report(command, stats, start_date, end_date), None
+
+    async def _recent_days_report(self, days):
+        start_date, end_date = report_range('recent_days', days)
+        # 汇总和按日期分组相互独立，并发查询
+        stats, date_stats = await asyncio.gather(
+            self.adb.get_combined_stats(start_date, end_date),
+            self.adb.get_stats_by_date(start_date, end_date),
+        )
+        return self.format_recent_days_message(stats, days, date_stats)
@@ -0,0 +1,175 @@
+"""
+asyncio WeChat Work clients for the ASGI entry point
+
+Optional: requires httpx. Same retry policy as ``wechat_bot.post_json``,
+but waiting happens on the event loop instead of in a blocked thread.
+Group robot messages still go through ``wechat_bot``'s outbound queue,
+whose ``enqueue`` never blocks.
+"""
+import asyncio
+import json
+import time
+from config import (
+    WECHAT_CONNECT_TIMEOUT,
+    WECHAT_READ_TIMEOUT,
+    WECHAT_HTTP_POOL_SIZE,
+    WECHAT_SEND_RETRIES,
+    WECHAT_RETRY_BACKOFF,
+    WECHAT_TEXT_MAX_BYTES,
+)
+from wechat_bot import (
+    ERRCODE_SYSTEM_BUSY,
+    ERRCODE_RATE_LIMITED,
+    WeChatAppClient,
+    _TransientHTTPError,
+    _backoff,
+    _rate_limit_delay,
+    split_message,
+)
+from metrics import WECHAT_SEND_SECONDS, ERRORS
+
+try:
+    import httpx
+except ImportError:  # httpx is optional
+    httpx = None
+
+
+_client = None
+
+
+def get_async_client():
+    """Return the event loop's keep-alive HTTP client for WeChat APIs"""
+    global _client
+    if httpx is None:
+        raise RuntimeError("httpx 未安装")
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(WECHAT_READ_TIMEOUT, connect=WECHAT_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=WECHAT_HTTP_POOL_SIZE,
+                                max_keepalive_connections=WECHAT_HTTP_POOL_SIZE),
+        )
+    return _client
+
+
+async def close_async_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def async_post_json(url, data, params=None):
+    """
+    POST a JSON body to a WeChat API and return the decoded response
+
+    See ``wechat_bot.post_json`` for the retry policy.
+
+    Raises:
+        httpx.HTTPError: If the request could not be completed
+    """
+    client = get_async_client()
+    body = json.dumps(data)
+    attempt = 0
+    rate_limited = 0
+    rate_limit_waited = 0.0
+    while True:
+        try:
+            response = await client.post(
+                url, params=params, content=body, headers={'Content-Type': 'application/json'}
+            )
+            if response.status_code >= 500:
+                raise _TransientHTTPError(f"HTTP {response.status_code}")
+            result = response.json()
+        except (httpx.ConnectError, httpx.ConnectTimeout, _TransientHTTPError) as e:
+            if attempt >= WECHAT_SEND_RETRIES:
+                if isinstance(e, _TransientHTTPError):
+                    return {'errcode': ERRCODE_SYSTEM_BUSY, 'errmsg': str(e)}
+                raise
+            delay = _backoff(WECHAT_RETRY_BACKOFF, attempt)
+            print(f"WeChat request failed ({str(e)}), retrying in {delay:.1f}s")
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+
+        errcode = result.get('errcode')
+        delay = _rate_limit_delay(rate_limited, rate_limit_waited) if errcode == ERRCODE_RATE_LIMITED else None
+        if delay is not None:
+            print(f"WeChat rate limit hit, retrying in {delay:.1f}s")
+            rate_limited += 1
+            rate_limit_waited += delay
+            await asyncio.sleep(delay)
+            continue
+        if errcode == ERRCODE_SYSTEM_BUSY and attempt < WECHAT_SEND_RETRIES:
+            delay = _backoff(WECHAT_RETRY_BACKOFF, attempt)
+            print(f"WeChat system busy, retrying in {delay:.1f}s")
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        return result
+
+
+class AsyncWeChatAppClient(WeChatAppClient):
+    """WeChat Work app message client whose sends run on the event loop"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._async_lock = asyncio.Lock()
+
+    async def get_access_token_async(self, force_refresh=False):
+        """Cached access token; see ``WeChatAppClient.get_access_token``"""
+        async with self._async_lock:
+            if force_refresh or not self._access_token or time.time() >= self._token_expires_at:
+                response = await get_async_client().get(
+                    self.TOKEN_URL, params={'corpid': self.corp_id, 'corpsecret': self.corp_secret}
+                )
+                result = response.json()
+                if result.get('errcode') != 0:
+                    raise RuntimeError(f"Failed to get access token: {result}")
+                self._access_token = result['access_token']
+                # Refresh a few minutes before WeChat expires the token
+                self._token_expires_at = time.time() + result.get('expires_in', 7200) - 300
+            return self._access_token
+
+    async def send_text_message_async(self, touser, content):
+        """
+        Push a text message to users through the app
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        if not self.configured:
+            print("Warning: WeChat app credentials not configured")
+            return False
+
+        data = {
+            "touser": touser,
+            "msgtype": "text",
+            "agentid": self.agent_id,
+            "text": {
+                "content": content
+            }
+        }
+
+        with WECHAT_SEND_SECONDS.time(channel='app_text_async'):
+            try:
+                for chunk in split_message(content, WECHAT_TEXT_MAX_BYTES):
+                    data["text"]["content"] = chunk
+                    result = {}
+                    for attempt in range(2):
+                        token = await self.get_access_token_async(force_refresh=attempt > 0)
+                        result = await async_post_json(self.SEND_URL, data, params={'access_token': token})
+                        # 40014/42001: invalid or expired token, fetch a new one and retry once
+                        if result.get('errcode') not in (40014, 42001):
+                            break
+
+                    if result.get('errcode') != 0:
+                        print(f"Failed to send app message: {result}")
+                        ERRORS.inc(where='wechat_send')
+                        return False
+
+                print(f"App message sent successfully to {touser}: {content[:50]}...")
+                return True
+            except Exception as e:
+                print(f"Error sending app message: {str(e)}")
+                ERRORS.inc(where='wechat_send')
+                return False
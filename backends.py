@@ -0,0 +1,322 @@
+"""
+Report storage backends
+
+``Database`` answers every report from MySQL. A ``ReportBackend`` can take
+over the closed days of a range so long reports stay off the transactional
+database; Database routes a query type to it when the type is listed in
+EMBEDDED_ROUTES, the range is at least EMBEDDED_MIN_DAYS long and the
+backend holds its first day. Days past what the backend holds (normally
+just today) are still read from MySQL and merged in.
+
+``EmbeddedBackend`` keeps a local copy of the leads / sales_orders columns
+the reports need, in SQLite (built in) or DuckDB (optional, columnar);
+``archive.ParquetArchive`` keeps them as day-partitioned Parquet files.
+"""
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+from config import (
+    EMBEDDED_BACKEND,
+    EMBEDDED_DB_PATH,
+    EMBEDDED_HISTORY_DAYS,
+    EMBEDDED_SYNC_LOOKBACK_DAYS,
+)
+
+try:
+    import duckdb
+except ImportError:  # duckdb is optional
+    duckdb = None
+
+# Days copied from MySQL per batch during a sync
+SYNC_CHUNK_DAYS = 31
+
+
+class ReportBackend:
+    """
+    Interface of a backend answering report aggregations for closed days
+
+    Row shapes match the MySQL paths in ``Database``: ``sales`` holds the
+    sales key (the ID when the sales_people dimension is enabled) and
+    Database resolves names afterwards.
+    """
+
+    name = 'base'
+
+    def coverage(self):
+        """
+        Returns:
+            tuple: (first_day, last_day) held by the backend, or None
+        """
+        raise NotImplementedError
+
+    def sales_rows(self, start_date, end_date):
+        """Per-sales ``leads_count``, ``orders_count`` and ``total_sales`` for a range"""
+        raise NotImplementedError
+
+    def daily_totals(self, start_date, end_date):
+        """(leads_by_day, orders_by_day) keyed by 'YYYY-MM-DD', as in ``Database.get_stats_by_date``"""
+        raise NotImplementedError
+
+    def daily_sales_rows(self, start_date, end_date):
+        """Rows per (day, sales), as returned by ``Database.get_daily_sales_rows``"""
+        raise NotImplementedError
+
+    def stats(self):
+        """Coverage and freshness for /health"""
+        raise NotImplementedError
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+
+class EmbeddedBackend(ReportBackend):
+    """
+    Local replica of closed days in an embedded SQL engine
+
+    Only the columns the reports use are copied: the date, the sales key,
+    the lead / order ID and the price in cents (summed as integers, like the
+    in-memory cube). ``sync`` appends days after the last synced one and
+    re-copies the most recent few to pick up late rows. Access is serialized
+    on one connection; embedded reads of pre-filtered date ranges are short.
+    """
+
+    def __init__(self, path=EMBEDDED_DB_PATH, engine='sqlite'):
+        if engine == 'duckdb' and duckdb is None:
+            raise RuntimeError("duckdb 未安装")
+        self.path = path
+        self.engine = engine
+        self.synced_at = None
+        self._conn = None
+        self._sales_type = None
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self.engine
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if self.engine == 'duckdb':
+                self._conn = duckdb.connect(self.path)
+            else:
+                self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        return self._conn
+
+    def _param(self, day):
+        # SQLite stores dates as ISO text; DuckDB has a DATE type
+        return day if self.engine == 'duckdb' else day.isoformat()
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def _ensure_schema(self, conn, sales_type):
+        """Create the replica tables; rebuild them when the sales key type changed"""
+        conn.execute("CREATE TABLE IF NOT EXISTS replica_meta (key VARCHAR PRIMARY KEY, value VARCHAR)")
+        row = conn.execute("SELECT value FROM replica_meta WHERE key = 'sales_type'").fetchone()
+        if row is not None and row[0] != sales_type:
+            for table in ('leads', 'sales_orders', 'synced_days'):
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.execute(f"CREATE TABLE IF NOT EXISTS leads (leads_date DATE, sales {sales_type}, leads_id VARCHAR)")
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS sales_orders (
+                order_date DATE, sales {sales_type}, price_cents BIGINT, order_id BIGINT
+            )
+        """)
+        conn.execute("CREATE TABLE IF NOT EXISTS synced_days (day DATE PRIMARY KEY)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_leads_date ON leads (leads_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_order_date ON sales_orders (order_date)")
+        conn.execute("DELETE FROM replica_meta WHERE key = 'sales_type'")
+        conn.execute("INSERT INTO replica_meta (key, value) VALUES ('sales_type', ?)", (sales_type,))
+        conn.commit()
+
+    def coverage(self):
+        if not os.path.exists(self.path) and self._conn is None:
+            return None
+        try:
+            row = self._query("SELECT MIN(day), MAX(day) FROM synced_days")[0]
+        except Exception:
+            return None
+        if row[0] is None:
+            return None
+        return _to_date(row[0]), _to_date(row[1])
+
+    def sync(self, db, lookback_days=EMBEDDED_SYNC_LOOKBACK_DAYS, history_days=EMBEDDED_HISTORY_DAYS):
+        """
+        Copy closed days from MySQL
+
+        The first sync copies the last ``history_days`` closed days; later
+        ones copy the days since the last sync plus the most recent
+        ``lookback_days`` again.
+
+        Args:
+            db: Database to read from
+
+        Returns:
+            int: Number of days copied
+        """
+        sales_type = 'INTEGER' if db.sales_column == 'sales_id' else 'VARCHAR'
+        with self._lock:
+            conn = self._connect()
+            if self._sales_type != sales_type:
+                self._ensure_schema(conn, sales_type)
+                self._sales_type = sales_type
+
+        yesterday = datetime.now().date() - timedelta(days=1)
+        coverage = self.coverage()
+        if coverage is None:
+            start_date = yesterday - timedelta(days=history_days - 1)
+        else:
+            start_date = max(min(coverage[1] + timedelta(days=1),
+                                 yesterday - timedelta(days=max(lookback_days, 1) - 1)), coverage[0])
+
+        day = start_date
+        while day <= yesterday:
+            chunk_end = min(day + timedelta(days=SYNC_CHUNK_DAYS - 1), yesterday)
+            leads, orders = db.export_fact_rows(day, chunk_end)
+            self._replace_days(day, chunk_end, leads, orders)
+            day = chunk_end + timedelta(days=1)
+        self.synced_at = time.time()
+        return max((yesterday - start_date).days + 1, 0)
+
+    def _replace_days(self, start_date, end_date, leads, orders):
+        lo, hi = self._param(start_date), self._param(end_date)
+        days = []
+        day = start_date
+        while day <= end_date:
+            days.append((self._param(day),))
+            day += timedelta(days=1)
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.execute("DELETE FROM leads WHERE leads_date >= ? AND leads_date <= ?", (lo, hi))
+                conn.execute("DELETE FROM sales_orders WHERE order_date >= ? AND order_date <= ?", (lo, hi))
+                conn.execute("DELETE FROM synced_days WHERE day >= ? AND day <= ?", (lo, hi))
+                if leads:
+                    conn.executemany("INSERT INTO leads VALUES (?, ?, ?)",
+                                     [(self._param(d), s, i) for d, s, i in leads])
+                if orders:
+                    conn.executemany("INSERT INTO sales_orders VALUES (?, ?, ?, ?)",
+                                     [(self._param(d), s, int(c), i) for d, s, c, i in orders])
+                conn.executemany("INSERT INTO synced_days VALUES (?)", days)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def sales_rows(self, start_date, end_date):
+        lo, hi = self._param(start_date), self._param(end_date)
+        rows = self._query("""
+            SELECT sales, SUM(leads_count), SUM(orders_count), SUM(price_cents) FROM (
+                SELECT sales, COUNT(*) AS leads_count, 0 AS orders_count, 0 AS price_cents
+                FROM leads WHERE leads_date >= ? AND leads_date <= ? GROUP BY sales
+                UNION ALL
+                SELECT sales, 0 AS leads_count, COUNT(*) AS orders_count, SUM(price_cents) AS price_cents
+                FROM sales_orders WHERE order_date >= ? AND order_date <= ? GROUP BY sales
+            ) AS t GROUP BY sales
+        """, (lo, hi, lo, hi))
+        return [
+            {
+                'sales': sales,
+                'leads_count': int(leads_count or 0),
+                'orders_count': int(orders_count or 0),
+                'total_sales': Decimal(int(cents or 0)) / 100,
+            }
+            for sales, leads_count, orders_count, cents in rows
+        ]
+
+    def daily_totals(self, start_date, end_date):
+        lo, hi = self._param(start_date), self._param(end_date)
+        rows = self._query("""
+            SELECT day, SUM(leads_count), SUM(orders_count), SUM(price_cents) FROM (
+                SELECT leads_date AS day, COUNT(*) AS leads_count, 0 AS orders_count, 0 AS price_cents
+                FROM leads WHERE leads_date >= ? AND leads_date <= ? GROUP BY leads_date
+                UNION ALL
+                SELECT order_date AS day, 0 AS leads_count, COUNT(*) AS orders_count, SUM(price_cents) AS price_cents
+                FROM sales_orders WHERE order_date >= ? AND order_date <= ? GROUP BY order_date
+            ) AS t GROUP BY day
+        """, (lo, hi, lo, hi))
+        leads_by_day = {}
+        orders_by_day = {}
+        for day, leads_count, orders_count, cents in rows:
+            key = _to_date(day).strftime('%Y-%m-%d')
+            if leads_count:
+                leads_by_day[key] = int(leads_count)
+            if orders_count:
+                orders_by_day[key] = {'orders_count': int(orders_count), 'total_sales': int(cents or 0) // 100}
+        return leads_by_day, orders_by_day
+
+    def daily_sales_rows(self, start_date, end_date):
+        lo, hi = self._param(start_date), self._param(end_date)
+        rows = self._query("""
+            SELECT day, sales, SUM(leads_count), SUM(orders_count), SUM(price_cents) FROM (
+                SELECT leads_date AS day, sales, COUNT(*) AS leads_count, 0 AS orders_count, 0 AS price_cents
+                FROM leads WHERE leads_date >= ? AND leads_date <= ? GROUP BY leads_date, sales
+                UNION ALL
+                SELECT order_date AS day, sales, 0 AS leads_count, COUNT(*) AS orders_count,
+                       SUM(price_cents) AS price_cents
+                FROM sales_orders WHERE order_date >= ? AND order_date <= ? GROUP BY order_date, sales
+            ) AS t GROUP BY day, sales
+        """, (lo, hi, lo, hi))
+        return [
+            {
+                'day': _to_date(day),
+                'sales': sales,
+                'leads_count': int(leads_count or 0),
+                'orders_count': int(orders_count or 0),
+                'total_sales': Decimal(int(cents or 0)) / 100,
+            }
+            for day, sales, leads_count, orders_count, cents in rows
+        ]
+
+    def stats(self):
+        coverage = self.coverage()
+        return {
+            'engine': self.engine,
+            'path': self.path,
+            'first_day': coverage[0].strftime('%Y-%m-%d') if coverage else None,
+            'last_day': coverage[1].strftime('%Y-%m-%d') if coverage else None,
+            'age_seconds': round(time.time() - self.synced_at, 1) if self.synced_at else None,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_default_backend = None
+_default_backend_lock = threading.Lock()
+
+
+def get_default_backend():
+    """
+    Return the process-wide embedded backend, or None when EMBEDDED_BACKEND
+    is off (or names an engine whose package is not installed)
+    """
+    global _default_backend
+    if EMBEDDED_BACKEND == 'parquet':
+        import archive
+        if archive.pa is None:
+            return None
+    elif EMBEDDED_BACKEND not in ('sqlite', 'duckdb') or (EMBEDDED_BACKEND == 'duckdb' and duckdb is None):
+        return None
+    with _default_backend_lock:
+        if _default_backend is None:
+            if EMBEDDED_BACKEND == 'parquet':
+                _default_backend = archive.ParquetArchive()
+            else:
+                _default_backend = EmbeddedBackend(EMBEDDED_DB_PATH, EMBEDDED_BACKEND)
+        return _default_backend
@@ -0,0 +1,486 @@
+"""
+Benchmark harness for the report query paths
+
+Usage:
+    python benchmark.py generate --orders 10000000 --reps 200 --years 5 --truncate
+    python benchmark.py run --iterations 20 --output bench-new.json
+    python benchmark.py compare bench-old.json bench-new.json
+    python benchmark.py imports --output imports-new.json
+
+``generate`` loads synthetic leads and orders into the database configured
+by the DB_* settings; point them at a dedicated benchmark database, never at
+production. ``run`` times every QueryHandler command and Database method
+under the feature flags currently set (rollups, cube, today counters,
+snapshots, sales dimension), so each path is measured by switching its flag,
+and saves p50/p95/p99 latencies and statement counts as JSON. ``compare``
+reports the differences between two result files and exits with status 1
+when a case got slower than the threshold.
+
+``imports`` times importing the app and building it with ``create_app()``
+in fresh interpreters; it needs no database, and its result files compare
+the same way.
+
+The statements are MySQL dialect (WITH ROLLUP, partitions, triggers), so the
+target has to be MySQL or a compatible server such as MariaDB.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from config import (
+    DB_CONFIG,
+    DB_POOL_SIZE,
+    ROLLUP_ENABLED,
+    CUBE_ENABLED,
+    TODAY_COUNTERS_ENABLED,
+    SNAPSHOT_ENABLED,
+    SALES_DIMENSION_ENABLED,
+)
+from database import Database, get_default_pool
+from migrate import table_exists
+
+# Commands sent to QueryHandler.process_query
+COMMANDS = ['今日', '昨日', '本月', '上个月', '最近7日', '最近30日', '最近365日']
+
+
+class _CountingCursor:
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, sql, params=None):
+        self._counter.add()
+        return self._cursor.execute(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+        return False
+
+
+class _CountingConnection:
+    def __init__(self, conn, counter):
+        self._conn = conn
+        self._counter = counter
+
+    def cursor(self, *args):
+        return _CountingCursor(self._conn.cursor(*args), self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class CountingPool:
+    """Connection pool wrapper that counts the statements executed through it"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.statements = 0
+        self._lock = threading.Lock()
+
+    def add(self):
+        with self._lock:
+            self.statements += 1
+
+    def reset(self):
+        with self._lock:
+            count, self.statements = self.statements, 0
+        return count
+
+    @contextmanager
+    def connection(self):
+        with self.pool.connection() as conn:
+            yield _CountingConnection(conn, self)
+
+    def stats(self):
+        return self.pool.stats()
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(samples)
+    rank = max(math.ceil(p / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(samples, statements):
+    """
+    Summarize one case
+
+    Args:
+        samples: Latencies in seconds
+        statements: Statements executed per call
+
+    Returns:
+        dict: Latency percentiles in milliseconds and the median statement count
+    """
+    ms = [s * 1000 for s in samples]
+    return {
+        'iterations': len(ms),
+        'p50_ms': round(percentile(ms, 50), 3),
+        'p95_ms': round(percentile(ms, 95), 3),
+        'p99_ms': round(percentile(ms, 99), 3),
+        'mean_ms': round(sum(ms) / len(ms), 3),
+        'min_ms': round(min(ms), 3),
+        'max_ms': round(max(ms), 3),
+        'queries': percentile(statements, 50),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def generate(db, orders, reps, years, leads_per_order, batch, seed, truncate):
+    """
+    Load synthetic leads and orders
+
+    Dates are spread evenly over ``years`` years up to today (today
+    included, so 今日 has rows). Sales people get a skewed share of the
+    work, as real teams do. Each lead turns into an order with probability
+    1 / ``leads_per_order``, dated up to two weeks after the lead.
+
+    Returns:
+        tuple: (leads_inserted, orders_inserted)
+    """
+    rng = random.Random(seed)
+    names = [f"销售{i:03d}" for i in range(1, reps + 1)]
+    cum_weights = list(itertools.accumulate(1 / math.sqrt(i + 1) for i in range(reps)))
+    today = datetime.now().date()
+    now = datetime.now()
+    span_days = int(years * 365)
+    total_leads = int(orders * leads_per_order)
+
+    with db.get_connection() as conn:
+        with conn.cursor() as cursor:
+            if truncate:
+                # Older schemas still have the sales_orders -> leads foreign key
+                cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+                for table in ('sales_orders', 'leads', 'daily_sales_stats', 'monthly_sales_stats',
+                              'rollup_refresh_log'):
+                    if table_exists(cursor, table):
+                        cursor.execute(f"TRUNCATE TABLE {table}")
+                cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+            cursor.execute("SELECT COUNT(*) FROM leads")
+            offset = cursor.fetchone()[0]
+
+            leads_inserted = orders_inserted = 0
+            lead_rows = []
+            order_rows = []
+
+            def flush():
+                if lead_rows:
+                    cursor.executemany(
+                        "INSERT INTO leads (leads_id, leads_date, sales, created_at) VALUES (%s, %s, %s, %s)",
+                        lead_rows)
+                if order_rows:
+                    cursor.executemany(
+                        "INSERT INTO sales_orders (order_date, sales, leads_id, sales_price, created_at) "
+                        "VALUES (%s, %s, %s, %s, %s)", order_rows)
+                lead_rows.clear()
+                order_rows.clear()
+
+            for n in range(total_leads):
+                day = today - timedelta(days=rng.randrange(span_days + 1))
+                sales = rng.choices(names, cum_weights=cum_weights)[0]
+                leads_id = f"BL{offset + n:010d}"
+                created_at = min(datetime.combine(day, datetime.min.time()) + timedelta(seconds=rng.randrange(86400)), now)
+                lead_rows.append((leads_id, day, sales, created_at))
+                leads_inserted += 1
+                if rng.random() * leads_per_order < 1:
+                    order_day = min(day + timedelta(days=rng.randrange(15)), today)
+                    price = round(rng.lognormvariate(7.3, 0.6), 2)
+                    order_created = min(datetime.combine(order_day, datetime.min.time())
+                                        + timedelta(seconds=rng.randrange(86400)), now)
+                    order_rows.append((order_day, sales, leads_id, price, order_created))
+                    orders_inserted += 1
+                if len(lead_rows) >= batch:
+                    flush()
+                    if leads_inserted % (batch * 100) == 0:
+                        print(f"  {leads_inserted}/{total_leads} leads, {orders_inserted} orders")
+            flush()
+
+    db.invalidate_cache()
+    return leads_inserted, orders_inserted
+
+
+def _database_cases(db, today):
+    """(name, callable) for each Database method and range"""
+    yesterday = today - timedelta(days=1)
+    first_this_month = today.replace(day=1)
+    last_month_end = first_this_month - timedelta(days=1)
+    ranges = {
+        'today': (today, today),
+        '7d': (today - timedelta(days=6), today),
+        '30d': (today - timedelta(days=29), today),
+        'last_month': (last_month_end.replace(day=1), last_month_end),
+        '365d': (today - timedelta(days=364), today),
+    }
+    cases = []
+    for label, (start, end) in ranges.items():
+        cases.append((f"db.get_combined_stats[{label}]", lambda s=start, e=end: db.get_combined_stats(s, e)))
+    for label in ('30d', '365d'):
+        start, end = ranges[label]
+        cases.append((f"db.get_stats_by_date[{label}]", lambda s=start, e=end: db.get_stats_by_date(s, e)))
+    start, end = ranges['30d']
+    cases.append(("db.get_daily_sales_rows[30d]", lambda: db.get_daily_sales_rows(start, end)))
+    cases.append(("db.get_leads_stats[30d]", lambda: db.get_leads_stats(start, end)))
+    cases.append(("db.get_orders_stats[30d]", lambda: db.get_orders_stats(start, end)))
+    cases.append(("db.get_today_baseline", lambda: db.get_today_baseline(today, 5, 30)))
+    baseline = db.get_today_baseline(today, 5, 30)
+    since = datetime.combine(yesterday, datetime.min.time())
+    order_since = (baseline['order_hwm_created_at'] or since) - timedelta(minutes=1)
+    lead_since = (baseline['lead_hwm_created_at'] or since) - timedelta(minutes=1)
+    cases.append(("db.get_rows_since", lambda: db.get_rows_since(order_since, lead_since)))
+    return cases
+
+
+def run(iterations, warmup, use_cache):
+    """
+    Time every case
+
+    Returns:
+        dict: Run metadata and per-case summaries
+    """
+    from query_handler import QueryHandler
+    from cache import ResultCache
+
+    pool = CountingPool(get_default_pool())
+    db = Database(pool=pool, cache=ResultCache() if use_cache else None)
+    today = datetime.now().date()
+
+    handler = QueryHandler()
+    handler.db = db
+
+    # Load the in-memory structures of the enabled paths once; their load time is a case too
+    setup = []
+    if db.replicas is not None:
+        setup.append(("replicas.refresh", lambda: db.replicas.refresh(force=True)))
+    if db.cube is not None:
+        setup.append(("cube.refresh", lambda: db.cube.refresh(db)))
+    if handler.today_counters is not None:
+        setup.append(("today_counters.refresh", lambda: handler.today_counters.refresh(db)))
+    if handler.snapshots is not None:
+        setup.append(("snapshots.refresh", handler.refresh_snapshots))
+
+    cases = [(f"query[{command}]", lambda c=command: handler.process_query(c)) for command in COMMANDS]
+    cases.extend(_database_cases(db, today))
+
+    results = {}
+    for name, func in setup:
+        pool.reset()
+        started = time.perf_counter()
+        func()
+        results[name] = summarize([time.perf_counter() - started], [pool.reset()])
+        print(f"{name}: {results[name]['p50_ms']} ms")
+
+    for name, func in cases:
+        for _ in range(warmup):
+            func()
+        samples = []
+        statements = []
+        for _ in range(iterations):
+            pool.reset()
+            started = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - started)
+            statements.append(pool.reset())
+        results[name] = summarize(samples, statements)
+        r = results[name]
+        print(f"{name}: p50 {r['p50_ms']} ms, p95 {r['p95_ms']} ms, p99 {r['p99_ms']} ms, {r['queries']} queries")
+
+    with db.get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM leads")
+            leads_rows = cursor.fetchone()[0]
+            cursor.execute("SELECT COUNT(*) FROM sales_orders")
+            orders_rows = cursor.fetchone()[0]
+
+    return {
+        'commit': _git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'database': {'host': DB_CONFIG['host'], 'name': DB_CONFIG['database'],
+                     'leads': leads_rows, 'orders': orders_rows},
+        'settings': {
+            'iterations': iterations,
+            'warmup': warmup,
+            'result_cache': use_cache,
+            'db_pool_size': DB_POOL_SIZE,
+            'rollups': ROLLUP_ENABLED,
+            'cube': CUBE_ENABLED,
+            'today_counters': TODAY_COUNTERS_ENABLED,
+            'snapshots': SNAPSHOT_ENABLED,
+            'sales_dimension': SALES_DIMENSION_ENABLED,
+        },
+        'results': results,
+    }
+
+
+# Import-time cases: statements run in a fresh interpreter
+IMPORT_CASES = [
+    ('import[app]', 'import app'),
+    ('create_app', 'import app; app.create_app(start_scheduler=False, warm_up=False)'),
+    ('import[query_handler]', 'import query_handler'),
+    ('import[scheduler]', 'import scheduler'),
+]
+
+_IMPORT_TIMER = '''
+import sys, time
+started = time.perf_counter()
+exec({statement!r})
+print(time.perf_counter() - started, len(sys.modules))
+'''
+
+
+def run_imports(iterations):
+    """
+    Time each import case in ``iterations`` fresh interpreters
+
+    Returns:
+        dict: Run metadata and per-case summaries (``queries`` is always 0;
+        ``modules`` is how many modules the case left loaded)
+    """
+    results = {}
+    for name, statement in IMPORT_CASES:
+        samples = []
+        modules = 0
+        for _ in range(iterations):
+            done = subprocess.run([sys.executable, '-c', _IMPORT_TIMER.format(statement=statement)],
+                                  capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            if done.returncode != 0:
+                print(f"{name}: failed: {done.stderr.strip().splitlines()[-1]}")
+                break
+            elapsed, modules = done.stdout.split()[-2:]
+            samples.append(float(elapsed))
+        if not samples:
+            continue
+        results[name] = dict(summarize(samples, [0]), modules=int(modules))
+        r = results[name]
+        print(f"{name}: p50 {r['p50_ms']} ms, p95 {r['p95_ms']} ms, {r['modules']} modules")
+    return {
+        'commit': _git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'settings': {'iterations': iterations, 'python': sys.version.split()[0]},
+        'results': results,
+    }
+
+
+def compare(before, after, threshold):
+    """
+    Compare two result files
+
+    A case regresses when its p95 grew by more than ``threshold`` (a
+    fraction) and by at least one millisecond, or when it runs more
+    statements than before.
+
+    Returns:
+        tuple: (report lines, list of regressed case names)
+    """
+    lines = []
+    regressions = []
+    for name, new in after['results'].items():
+        old = before['results'].get(name)
+        if old is None:
+            lines.append(f"  {name}: p95 {new['p95_ms']} ms（新增）")
+            continue
+        change = (new['p95_ms'] - old['p95_ms']) / old['p95_ms'] if old['p95_ms'] else 0.0
+        slower = (change > threshold and new['p95_ms'] - old['p95_ms'] >= 1) or new['queries'] > old['queries']
+        if slower:
+            regressions.append(name)
+        lines.append(
+            f"{'✗' if slower else '✓'} {name}: p50 {old['p50_ms']} -> {new['p50_ms']} ms, "
+            f"p95 {old['p95_ms']} -> {new['p95_ms']} ms ({change:+.0%}), "
+            f"queries {old['queries']} -> {new['queries']}"
+        )
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the eyewear bot report queries')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    gen = sub.add_parser('generate', help='Load synthetic leads and orders')
+    gen.add_argument('--orders', type=int, default=1000000, help='Approximate number of orders')
+    gen.add_argument('--reps', type=int, default=200, help='Number of sales people')
+    gen.add_argument('--years', type=float, default=5, help='Years of history up to today')
+    gen.add_argument('--leads-per-order', type=float, default=3, help='Leads generated per order')
+    gen.add_argument('--batch', type=int, default=5000, help='Rows per INSERT batch')
+    gen.add_argument('--seed', type=int, default=42)
+    gen.add_argument('--truncate', action='store_true', help='Empty the fact and rollup tables first')
+
+    bench = sub.add_parser('run', help='Time every command and Database method')
+    bench.add_argument('--iterations', type=int, default=20)
+    bench.add_argument('--warmup', type=int, default=2)
+    bench.add_argument('--cache', action='store_true', help='Keep the result cache on (measures cache hits)')
+    bench.add_argument('--output', help='JSON file for the results (default bench-<commit>.json)')
+
+    imports = sub.add_parser('imports', help='Time importing and creating the app')
+    imports.add_argument('--iterations', type=int, default=10)
+    imports.add_argument('--output', help='JSON file for the results (default imports-<commit>.json)')
+
+    cmp_ = sub.add_parser('compare', help='Compare two result files')
+    cmp_.add_argument('before')
+    cmp_.add_argument('after')
+    cmp_.add_argument('--threshold', type=float, default=0.1, help='Allowed p95 growth as a fraction')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        print(f"Loading synthetic data into {DB_CONFIG['host']}/{DB_CONFIG['database']} ...")
+        started = time.perf_counter()
+        leads, orders = generate(Database(cache=None), args.orders, args.reps, args.years,
+                                 args.leads_per_order, args.batch, args.seed, args.truncate)
+        print(f"Inserted {leads} leads and {orders} orders in {time.perf_counter() - started:.1f}s")
+        if ROLLUP_ENABLED:
+            print("Rollups are enabled: backfill them with Database().refresh_rollups(...) before running")
+        return 0
+
+    if args.command == 'run':
+        report = run(args.iterations, args.warmup, args.cache)
+        output = args.output or f"bench-{report['commit'] or 'local'}.json"
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Results saved to {output}")
+        return 0
+
+    if args.command == 'imports':
+        report = run_imports(args.iterations)
+        output = args.output or f"imports-{report['commit'] or 'local'}.json"
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Results saved to {output}")
+        return 0
+
+    with open(args.before, encoding='utf-8') as f:
+        before = json.load(f)
+    with open(args.after, encoding='utf-8') as f:
+        after = json.load(f)
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    lines, regressions = compare(before, after, args.threshold)
+    for line in lines:
+        print(line)
+    if regressions:
+        print(f"{len(regressions)} case(s) regressed")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
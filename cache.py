@@ -0,0 +1,259 @@
+"""
+Result cache module for date-range queries
+"""
+import copy
+import fcntl
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from config import (
+    RESULT_CACHE_MAX_ENTRIES,
+    RESULT_CACHE_OPEN_TTL,
+    CACHE_INVALIDATION_FILE,
+    CACHE_INVALIDATION_MAX_BYTES,
+)
+
+
+class ResultCache:
+    """
+    LRU cache for the results of date-range queries
+
+    A range that ended before today can never change, so its result is kept
+    until it is evicted or invalidated. A range that includes today expires
+    after ``open_ttl`` seconds. Values are copied on the way in and out so
+    callers can never mutate a cached result.
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_MAX_ENTRIES, open_ttl=RESULT_CACHE_OPEN_TTL):
+        self.max_entries = max_entries
+        self.open_ttl = open_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Look up a cached result
+
+        Args:
+            key: Cache key, as passed to ``put``
+
+        Returns:
+            tuple: (True, value) on a hit, (False, None) on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at, _, _ = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, copy.deepcopy(value)
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, start_date, end_date):
+        """
+        Store a result for a date range
+
+        Args:
+            key: Cache key
+            value: Result to cache
+            start_date: Start date of the range the result covers
+            end_date: End date of the range the result covers
+        """
+        if self.max_entries <= 0:
+            return
+        if end_date < datetime.now().date():
+            expires_at = None
+        elif self.open_ttl > 0:
+            expires_at = time.monotonic() + self.open_ttl
+        else:
+            return
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = (value, expires_at, start_date, end_date)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, start_date=None, end_date=None):
+        """
+        Drop cached results that overlap a date range
+
+        Use this when rows are back-dated or arrive late for days that were
+        already closed. With no arguments every entry is dropped.
+
+        Args:
+            start_date: First changed day (inclusive)
+            end_date: Last changed day (inclusive), defaults to start_date
+
+        Returns:
+            int: Number of entries removed
+        """
+        if end_date is None:
+            end_date = start_date
+        with self._lock:
+            if start_date is None:
+                stale = list(self._entries)
+            else:
+                stale = [
+                    key for key, (_, _, entry_start, entry_end) in self._entries.items()
+                    if entry_start <= end_date and entry_end >= start_date
+                ]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+            return len(stale)
+
+    def stats(self):
+        """
+        Get cache counters
+
+        Returns:
+            dict: Entry count plus hit, miss, eviction and invalidation counters
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+class InvalidationLog:
+    """
+    Invalidations shared by the worker processes of one host
+
+    Each process has its own ``ResultCache`` and cube, so an invalidation
+    made by one worker (``/cache/invalidate``, a rollup refresh) is appended
+    to ``path`` as a ``start end`` line; every worker reads the lines it has
+    not seen yet before its next cache lookup. Checking costs one ``stat``
+    while nothing changed. Once the file outgrows ``max_bytes`` it is
+    replaced by a new one; a worker that sees the new file clears
+    everything, since it may have missed lines.
+    """
+
+    ALL = '*'
+
+    def __init__(self, path=CACHE_INVALIDATION_FILE, max_bytes=CACHE_INVALIDATION_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Anything logged before this process started has nothing to drop
+        self._file_id, self._offset = self._stat()
+        self.applied = 0
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None, 0
+        return (st.st_dev, st.st_ino), st.st_size
+
+    def publish(self, start_date=None, end_date=None):
+        """
+        Tell every worker to drop results overlapping a date range
+
+        Args:
+            start_date: First changed day, or None for everything
+            end_date: Last changed day, defaults to start_date
+        """
+        if start_date is None:
+            line = f"{self.ALL} {self.ALL}\n"
+        else:
+            line = f"{start_date.isoformat()} {(end_date or start_date).isoformat()}\n"
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        while True:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                st = os.fstat(fd)
+                file_id, _ = self._stat()
+                if file_id != (st.st_dev, st.st_ino):
+                    # Rotated while we waited for the lock
+                    continue
+                if st.st_size > self.max_bytes:
+                    # Start a new file; readers notice the new inode and clear everything
+                    tmp = f"{self.path}.{os.getpid()}"
+                    with open(tmp, 'w') as f:
+                        f.write(line)
+                    os.replace(tmp, self.path)
+                else:
+                    os.write(fd, line.encode())
+                return
+            finally:
+                os.close(fd)
+
+    def poll(self):
+        """
+        Read the invalidations logged since the last call
+
+        Returns:
+            list: (start_date, end_date) tuples, (None, None) meaning everything
+        """
+        with self._lock:
+            file_id, size = self._stat()
+            if file_id == self._file_id and size == self._offset:
+                return []
+            if self._file_id is None:
+                # Created since the last call: read it from the start
+                self._file_id, self._offset = file_id, 0
+            elif file_id != self._file_id or size < self._offset:
+                # Replaced: lines may have been missed
+                self._file_id, self._offset = file_id, size
+                self.applied += 1
+                return [(None, None)]
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read(size - self._offset)
+            # A line still being written is read on the next call
+            data = data[:data.rfind(b'\n') + 1]
+            self._offset += len(data)
+
+        ranges = []
+        for line in data.decode().splitlines():
+            start, _, end = line.partition(' ')
+            if start == self.ALL:
+                ranges.append((None, None))
+            elif start and end:
+                ranges.append((datetime.strptime(start, '%Y-%m-%d').date(),
+                               datetime.strptime(end, '%Y-%m-%d').date()))
+        self.applied += len(ranges)
+        return ranges
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+_default_invalidation_log = None
+
+
+def get_default_cache():
+    """Return the process-wide cache shared by every Database instance"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResultCache()
+        return _default_cache
+
+
+def get_default_invalidation_log():
+    """Return the process-wide invalidation log, or None when CACHE_INVALIDATION_FILE is empty"""
+    global _default_invalidation_log
+    if not CACHE_INVALIDATION_FILE:
+        return None
+    with _default_cache_lock:
+        if _default_invalidation_log is None:
+            _default_invalidation_log = InvalidationLog()
+        return _default_invalidation_log
@@ -0,0 +1,124 @@
+"""
+Circuit breaker for the report database
+
+After ``failure_threshold`` consecutive failures (timeouts, lost or refused
+connections) the breaker opens: queries fail at once with
+``CircuitOpenError`` instead of adding load to a database that is already
+struggling. After ``reset_timeout`` seconds a single trial query is let
+through (half-open); its success closes the breaker, its failure opens it
+again for another ``reset_timeout``.
+"""
+import logging
+import threading
+import time
+from config import DB_BREAKER_FAILURES, DB_BREAKER_RESET_SECONDS
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of running a query while the breaker is open"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker"""
+
+    def __init__(self, name, failure_threshold=DB_BREAKER_FAILURES, reset_timeout=DB_BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.opened = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._trial_running = False
+        return self._state
+
+    def before_call(self):
+        """
+        Check a call may go ahead
+
+        Raises:
+            CircuitOpenError: While open, and in half-open while the trial
+            call is running
+        """
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+            self.rejected += 1
+            retry_in = max(self.reset_timeout - (time.monotonic() - self._opened_at), 0)
+            raise CircuitOpenError(f"{self.name} 熔断中，{int(retry_in) + 1} 秒后重试")
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                logging.info(f"{self.name} 熔断恢复")
+            self._state = CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            state = self._current_state(time.monotonic())
+            if state == HALF_OPEN or (state == CLOSED and self._failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._trial_running = False
+                self.opened += 1
+                logging.warning(f"{self.name} 连续失败 {self._failures} 次，熔断 {self.reset_timeout}s")
+
+    def record_abandoned(self):
+        """
+        Forget a call that ended without an answer about the database's
+        health (cancelled, or failed for reasons of its own); a half-open
+        breaker lets the next call make the trial instead
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def stats(self):
+        """
+        Returns:
+            dict: State, consecutive failures and how often calls were rejected
+        """
+        with self._lock:
+            return {
+                'state': self._current_state(time.monotonic()),
+                'consecutive_failures': self._failures,
+                'opened': self.opened,
+                'rejected': self.rejected,
+            }
+
+
+_default_breaker = None
+_default_breaker_lock = threading.Lock()
+
+
+def get_default_db_breaker():
+    """Return the process-wide database breaker, or None when DB_BREAKER_FAILURES is 0"""
+    global _default_breaker
+    if DB_BREAKER_FAILURES <= 0:
+        return None
+    with _default_breaker_lock:
+        if _default_breaker is None:
+            _default_breaker = CircuitBreaker('数据库')
+        return _default_breaker
@@ -0,0 +1,191 @@
+"""
+Lazily created services behind the web entry points
+
+Building a service can mean importing a heavy dependency (wechatpy,
+pymysql, apscheduler) or reading credentials, so ``BotComponents`` creates
+each one the first time a request, the warm-up or the scheduler needs it.
+"""
+import logging
+import os
+import threading
+import time
+from config import WARMUP_CONNECTIONS
+
+
+class BotComponents:
+    """The services one app instance shares between its request handlers"""
+
+    def __init__(self, query_handler_factory=None):
+        """
+        Args:
+            query_handler_factory: Builds the query handler (default QueryHandler)
+        """
+        self._query_handler_factory = query_handler_factory
+        self._lock = threading.RLock()
+        self._query_handler = None
+        self._reply_dispatcher = None
+        self._deduplicator = None
+        self._crypto = None
+        self.scheduler = None
+        # Set once the warm-up has finished (or was skipped)
+        self.ready = threading.Event()
+        self.warm_up_seconds = None
+        self.warm_up_error = None
+
+    def _lazy(self, attr, factory):
+        value = getattr(self, attr)
+        if value is None:
+            with self._lock:
+                value = getattr(self, attr)
+                if value is None:
+                    value = factory()
+                    setattr(self, attr, value)
+        return value
+
+    @property
+    def query_handler(self):
+        def build():
+            if self._query_handler_factory is not None:
+                return self._query_handler_factory()
+            from query_handler import QueryHandler
+            return QueryHandler()
+        return self._lazy('_query_handler', build)
+
+    @property
+    def reply_dispatcher(self):
+        """Background reply workers for WECHAT_REPLY_MODE=async"""
+        def build():
+            from reply_dispatcher import ReplyDispatcher
+            return ReplyDispatcher(self.query_handler)
+        return self._lazy('_reply_dispatcher', build)
+
+    @property
+    def deduplicator(self):
+        """Replies by message ID, so WeChat Work retries reuse the first computation"""
+        def build():
+            from dedup import MessageDeduplicator
+            return MessageDeduplicator()
+        return self._lazy('_deduplicator', build)
+
+    @property
+    def crypto(self):
+        def build():
+            from wechatpy.enterprise.crypto import WeChatCrypto
+            return WeChatCrypto(os.getenv('WECHAT_TOKEN'), os.getenv('WECHAT_AES_KEY'), os.getenv('WECHAT_CORP_ID'))
+        return self._lazy('_crypto', build)
+
+    def start_scheduler(self):
+        from scheduler import start_scheduler
+        with self._lock:
+            if self.scheduler is None:
+                self.scheduler = start_scheduler(query_handler=self.query_handler)
+        return self.scheduler
+
+    def warm_up(self):
+        """
+        Get ready for the first callbacks: open pooled connections and
+        render the menu reports once, which primes the result cache (and
+        the snapshots when they are enabled)
+
+        Failures are logged, not raised; the bot then starts cold.
+        """
+        started = time.monotonic()
+        try:
+            handler = self.query_handler
+            opened = handler.db.pool.warm(WARMUP_CONNECTIONS)
+            if handler.snapshots is not None:
+                handler.refresh_snapshots()
+            else:
+                for command in handler.SNAPSHOT_REPORTS:
+                    handler.build_report(command)
+            self.warm_up_seconds = round(time.monotonic() - started, 3)
+            logging.info(f"预热完成: {opened} 个数据库连接, 耗时 {self.warm_up_seconds}s")
+        except Exception as e:
+            self.warm_up_error = str(e)
+            logging.error(f"预热失败: {str(e)}")
+        finally:
+            self.ready.set()
+
+    def start_warm_up(self):
+        """Warm up on a background thread so a slow database does not hold up the server"""
+        threading.Thread(target=self.warm_up, name='warm-up', daemon=True).start()
+
+    def readiness(self):
+        """
+        Returns:
+            dict: Whether the warm-up has finished, how long it took and its error
+        """
+        return {
+            'ready': self.ready.is_set(),
+            'warm_up_seconds': self.warm_up_seconds,
+            'warm_up_error': self.warm_up_error,
+        }
+
+    def collect_runtime_metrics(self):
+        """
+        Gauges and counters read from the components' own stats at scrape time
+
+        Only components that already exist are read: a scrape must not build
+        the query handler (and its database pool) or start the reply workers.
+        """
+        from wechat_bot import outbound_queue_stats
+
+        query_handler = self._query_handler
+        if query_handler is not None:
+            yield from self._collect_query_metrics(query_handler)
+        if self._deduplicator is not None:
+            yield ('eyewear_dedup_duplicates', 'counter', 'Re-delivered callbacks absorbed',
+                   [({}, self._deduplicator.stats()['duplicates'])])
+        if self._reply_dispatcher is not None:
+            replies = self._reply_dispatcher.stats()
+            yield ('eyewear_async_replies', 'gauge', 'Async replies queued or running',
+                   [({'state': state}, replies[state]) for state in ('queued', 'running')])
+        outbound = outbound_queue_stats()
+        yield ('eyewear_outbound_queue_length', 'gauge', 'Webhook messages waiting to be sent',
+               [({}, outbound['queued'])])
+
+    @staticmethod
+    def _collect_query_metrics(query_handler):
+        """Database pool, breaker, replica, cache and single-flight series of a built query handler"""
+        pool = query_handler.db.pool_stats()
+        yield ('eyewear_db_pool_connections', 'gauge', 'Database pool connections by state',
+               [({'state': state}, pool[state]) for state in ('in_use', 'idle', 'waiting')])
+        yield ('eyewear_db_pool_size', 'gauge', 'Database pool size', [({}, pool['size'])])
+        breaker = query_handler.db.breaker
+        if breaker is not None:
+            from circuit_breaker import CLOSED, HALF_OPEN, OPEN
+            state = breaker.stats()
+            yield ('eyewear_db_breaker_state', 'gauge', 'Database circuit breaker state (1 = current)',
+                   [({'state': s}, int(state['state'] == s)) for s in (CLOSED, HALF_OPEN, OPEN)])
+            yield ('eyewear_db_breaker_rejected', 'counter', 'Queries failed fast by the open breaker',
+                   [({}, state['rejected'])])
+        if query_handler.db.replicas is not None:
+            replicas = query_handler.db.replicas.stats()
+            yield ('eyewear_db_replica_lag_seconds', 'gauge', 'Replication lag at the last check (-1 = unknown)',
+                   [({'replica': r['name']}, r['lag_seconds'] if r['lag_seconds'] is not None else -1)
+                    for r in replicas])
+        cache = query_handler.db.cache_stats()
+        if cache is not None:
+            yield ('eyewear_result_cache_entries', 'gauge', 'Cached report results', [({}, cache['entries'])])
+            yield ('eyewear_result_cache_lookups', 'counter', 'Result cache lookups by outcome',
+                   [({'result': 'hit'}, cache['hits']), ({'result': 'miss'}, cache['misses'])])
+            yield ('eyewear_result_cache_evictions', 'counter', 'Result cache evictions', [({}, cache['evictions'])])
+        flights = query_handler.single_flight.stats()
+        yield ('eyewear_single_flight_calls', 'counter', 'Report computations by whether they ran or joined another',
+               [({'outcome': 'executed'}, flights['executed']), ({'outcome': 'collapsed'}, flights['collapsed'])])
+
+    def shutdown(self):
+        """Stop the scheduler, hand the scheduler lease over, stop the reply workers and the metrics collector"""
+        from metrics import REGISTRY
+
+        REGISTRY.unregister_collector(self.collect_runtime_metrics)
+        if self.scheduler is not None and self.scheduler.running:
+            self.scheduler.shutdown()
+            print("Scheduler shut down")
+            from lease import get_default_lease
+            lease = get_default_lease()
+            if lease is not None:
+                # Let another worker take over the leader jobs at once
+                lease.release()
+        if self._reply_dispatcher is not None:
+            self._reply_dispatcher.shutdown(wait=False)
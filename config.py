@@ -13,11 +13,243 @@ DB_CONFIG = {
     'user': os.getenv('DB_USER', ''),
     'password': os.getenv('DB_PASSWORD', ''),
     'database': os.getenv('DB_NAME', 'eyewear_db'),
-    'charset': 'utf8mb4'
+    'charset': 'utf8mb4',
+    # Seconds to open a connection, and to wait on a single socket read/write (0 = no limit)
+    'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 5)),
+    'read_timeout': float(os.getenv('DB_READ_TIMEOUT', 60)) or None,
+    'write_timeout': float(os.getenv('DB_WRITE_TIMEOUT', 60)) or None,
 }
 
+# Database Connection Pool
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+# Seconds after which a connection is closed and reopened (0 = never)
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', 3600))
+# Idle seconds after which a connection is pinged before reuse (0 = always)
+DB_POOL_PING_INTERVAL = float(os.getenv('DB_POOL_PING_INTERVAL', 30))
+
+# Read Replicas (optional)
+# Comma-separated host[:port] list; replicas use DB_USER/DB_PASSWORD/DB_NAME, and the user
+# needs the REPLICATION CLIENT privilege for the lag check
+DB_REPLICAS = os.getenv('DB_REPLICAS', '')
+# 'round_robin' or 'least_latency' (lowest smoothed lag-check round trip)
+DB_REPLICA_STRATEGY = os.getenv('DB_REPLICA_STRATEGY', 'round_robin').lower()
+# Replicas more than this many seconds behind the primary are skipped
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 30))
+# Seconds between replication lag checks of each replica
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', 10))
+DB_REPLICA_POOL_SIZE = int(os.getenv('DB_REPLICA_POOL_SIZE', DB_POOL_SIZE))
+# Read 今日 (ranges that start today) from the primary, which has no replication lag
+DB_REPLICA_TODAY_ON_PRIMARY = os.getenv('DB_REPLICA_TODAY_ON_PRIMARY', 'true').lower() == 'true'
+
+# Concurrent Report Queries
+# Threads running independent report queries side by side (each borrows its own pooled connection)
+DB_QUERY_WORKERS = int(os.getenv('DB_QUERY_WORKERS', DB_POOL_SIZE))
+# Seconds a report waits for its concurrent queries before giving up
+DB_QUERY_TIMEOUT = float(os.getenv('DB_QUERY_TIMEOUT', 15))
+
+# Query Deadlines and Circuit Breaker
+# Seconds each command's database work may take, as command=seconds pairs; report
+# statements get the remaining time as MAX_EXECUTION_TIME (MySQL 5.7.8+)
+QUERY_DEADLINES = {
+    command.strip(): float(seconds)
+    for command, _, seconds in (
+        item.partition('=') for item in os.getenv(
+            'QUERY_DEADLINES', 'today=4,yesterday=4,this_month=8,last_month=8,recent_days=15'
+        ).split(',')
+    )
+    if command.strip() and seconds.strip()
+}
+# Consecutive database failures (timeouts, lost connections) that open the breaker (0 = no breaker)
+DB_BREAKER_FAILURES = int(os.getenv('DB_BREAKER_FAILURES', 5))
+# Seconds the breaker stays open before one trial query is let through
+DB_BREAKER_RESET_SECONDS = float(os.getenv('DB_BREAKER_RESET_SECONDS', 30))
+# Oldest last successful report served, with its age, when a query fails (0 = never)
+LAST_GOOD_MAX_AGE = float(os.getenv('LAST_GOOD_MAX_AGE', 6 * 3600))
+
+# Daily/Monthly Rollup Tables
+# Enable once schema.sql's rollup tables exist and have been backfilled
+ROLLUP_ENABLED = os.getenv('ROLLUP_ENABLED', 'false').lower() == 'true'
+# Closed days re-aggregated by each rollup refresh, to pick up late entries
+ROLLUP_REFRESH_LOOKBACK_DAYS = int(os.getenv('ROLLUP_REFRESH_LOOKBACK_DAYS', 3))
+# Seconds the rollup coverage (first/last refreshed day) is cached
+ROLLUP_COVERAGE_TTL = float(os.getenv('ROLLUP_COVERAGE_TTL', 60))
+
+# Monthly Partitions (see migrate.py)
+# Months beyond the current one that always have their own partition
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', 3))
+
+# Sales People Dimension (see migrations/003_sales_people_dimension.py)
+# Group reports by the integer sales_id and show the current name from sales_people
+SALES_DIMENSION_ENABLED = os.getenv('SALES_DIMENSION_ENABLED', 'false').lower() == 'true'
+# Seconds the sales_id -> name mapping is cached (unknown IDs reload it at once)
+SALES_DIRECTORY_TTL = float(os.getenv('SALES_DIRECTORY_TTL', 300))
+
+# Query Result Cache
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+# Maximum number of cached date-range results (least recently used are evicted)
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', 512))
+# Seconds a result for a range that includes today stays cached (0 = never cache)
+RESULT_CACHE_OPEN_TTL = float(os.getenv('RESULT_CACHE_OPEN_TTL', 10))
+# File through which the worker processes of a host pass on cache invalidations ('' = this process only)
+CACHE_INVALIDATION_FILE = os.getenv('CACHE_INVALIDATION_FILE', 'data/cache_invalidations')
+# The file is emptied once it grows past this many bytes (workers then clear their whole cache)
+CACHE_INVALIDATION_MAX_BYTES = int(os.getenv('CACHE_INVALIDATION_MAX_BYTES', 64 * 1024))
+
+# In-Memory Sales Cube (optional, requires numpy)
+CUBE_ENABLED = os.getenv('CUBE_ENABLED', 'false').lower() == 'true'
+# Closed days kept in memory; 400 covers 最近365天 and 上个月 with room to spare
+CUBE_DAYS = int(os.getenv('CUBE_DAYS', 400))
+# Seconds between refreshes
+CUBE_REFRESH_SECONDS = int(os.getenv('CUBE_REFRESH_SECONDS', 300))
+# Most recent closed days reloaded by each refresh, to pick up late entries
+CUBE_REFRESH_LOOKBACK_DAYS = int(os.getenv('CUBE_REFRESH_LOOKBACK_DAYS', 3))
+
+# Incremental Today Counters
+# Serve 今日 from in-memory counters fed by polling new rows (needs the created_at indexes in schema.sql)
+TODAY_COUNTERS_ENABLED = os.getenv('TODAY_COUNTERS_ENABLED', 'false').lower() == 'true'
+# Seconds between polls for new rows
+TODAY_REFRESH_SECONDS = int(os.getenv('TODAY_REFRESH_SECONDS', 15))
+# Counters older than this many seconds are not served; 今日 falls back to SQL
+TODAY_MAX_STALENESS = float(os.getenv('TODAY_MAX_STALENESS', 60))
+# Seconds between full re-aggregations, which correct updates, deletes and late commits
+TODAY_RESYNC_SECONDS = float(os.getenv('TODAY_RESYNC_SECONDS', 600))
+# Leads are re-read from this many seconds before the last seen created_at, de-duplicated by leads_id
+TODAY_LEADS_OVERLAP_SECONDS = int(os.getenv('TODAY_LEADS_OVERLAP_SECONDS', 5))
+# Orders are re-read from this many seconds before the last seen created_at, de-duplicated by
+# order_id, so an order committed after later ones (a slow transaction) is still counted
+TODAY_ORDERS_OVERLAP_SECONDS = int(os.getenv('TODAY_ORDERS_OVERLAP_SECONDS', 30))
+
+# Pre-Rendered Menu Report Snapshots (今日 / 昨日 / 本月)
+SNAPSHOT_ENABLED = os.getenv('SNAPSHOT_ENABLED', 'false').lower() == 'true'
+# Minutes between re-renders
+SNAPSHOT_INTERVAL_MINUTES = int(os.getenv('SNAPSHOT_INTERVAL_MINUTES', 5))
+# Snapshots older than this many seconds are not served; the query runs live instead
+SNAPSHOT_MAX_AGE = float(os.getenv('SNAPSHOT_MAX_AGE', 2 * 60 * SNAPSHOT_INTERVAL_MINUTES))
+
+# Embedded Analytic Backend (local replica of closed days; see backends.py)
+# '' = off, 'sqlite' (built in), 'duckdb' (requires duckdb) or 'parquet' (archive.py, requires pyarrow)
+EMBEDDED_BACKEND = os.getenv('EMBEDDED_BACKEND', '').lower()
+EMBEDDED_DB_PATH = os.getenv('EMBEDDED_DB_PATH', 'data/replica.db')
+# Query types answered from the replica: combined_stats, stats_by_date, daily_sales_rows
+EMBEDDED_ROUTES = [r.strip() for r in os.getenv('EMBEDDED_ROUTES', 'combined_stats,stats_by_date').split(',') if r.strip()]
+# Ranges shorter than this many days stay on MySQL
+EMBEDDED_MIN_DAYS = int(os.getenv('EMBEDDED_MIN_DAYS', 7))
+# Closed days copied on first sync, counting back from yesterday
+EMBEDDED_HISTORY_DAYS = int(os.getenv('EMBEDDED_HISTORY_DAYS', 1830))
+# Minutes between syncs, and most recent closed days re-copied by each one to pick up late entries
+EMBEDDED_SYNC_MINUTES = int(os.getenv('EMBEDDED_SYNC_MINUTES', 60))
+EMBEDDED_SYNC_LOOKBACK_DAYS = int(os.getenv('EMBEDDED_SYNC_LOOKBACK_DAYS', 3))
+
+# Parquet Archive (EMBEDDED_BACKEND=parquet)
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'data/archive')
+# Days are archived once this many days old and never rewritten afterwards
+ARCHIVE_SETTLE_DAYS = int(os.getenv('ARCHIVE_SETTLE_DAYS', 3))
+ARCHIVE_COMPRESSION = os.getenv('ARCHIVE_COMPRESSION', 'zstd')
+
 # WeChat Configuration
 WECHAT_WEBHOOK_URL = os.getenv('WECHAT_WEBHOOK_URL', '')
 
+# WeChat HTTP Client
+# Seconds to establish a connection / to wait for a response
+WECHAT_CONNECT_TIMEOUT = float(os.getenv('WECHAT_CONNECT_TIMEOUT', 3))
+WECHAT_READ_TIMEOUT = float(os.getenv('WECHAT_READ_TIMEOUT', 10))
+# Keep-alive connections kept per host
+WECHAT_HTTP_POOL_SIZE = int(os.getenv('WECHAT_HTTP_POOL_SIZE', 10))
+# Retries on connection errors, 5xx responses and errcode -1 (system busy)
+WECHAT_SEND_RETRIES = int(os.getenv('WECHAT_SEND_RETRIES', 3))
+# Base seconds of the jittered exponential backoff between those retries
+WECHAT_RETRY_BACKOFF = float(os.getenv('WECHAT_RETRY_BACKOFF', 0.5))
+# Retries and base backoff seconds when WeChat reports rate limiting (errcode 45009)
+WECHAT_RATE_LIMIT_RETRIES = int(os.getenv('WECHAT_RATE_LIMIT_RETRIES', 4))
+WECHAT_RATE_LIMIT_BACKOFF = float(os.getenv('WECHAT_RATE_LIMIT_BACKOFF', 15))
+# Total seconds one send may spend waiting out rate limiting
+WECHAT_RATE_LIMIT_MAX_WAIT = float(os.getenv('WECHAT_RATE_LIMIT_MAX_WAIT', 60))
+
+# WeChat Outbound Queue
+# Group robot webhooks accept about 20 messages per minute; at most this many are sent in any 60 seconds
+WECHAT_WEBHOOK_RATE_PER_MINUTE = float(os.getenv('WECHAT_WEBHOOK_RATE_PER_MINUTE', 20))
+# Content limits in UTF-8 bytes; longer messages are split at line boundaries
+WECHAT_TEXT_MAX_BYTES = int(os.getenv('WECHAT_TEXT_MAX_BYTES', 2048))
+WECHAT_MARKDOWN_MAX_BYTES = int(os.getenv('WECHAT_MARKDOWN_MAX_BYTES', 4096))
+
+# WeChat Work App (used to push replies computed in the background)
+WECHAT_CORP_ID = os.getenv('WECHAT_CORP_ID', '')
+WECHAT_CORP_SECRET = os.getenv('WECHAT_CORP_SECRET', '')
+WECHAT_AGENT_ID = os.getenv('WECHAT_AGENT_ID', '')
+# 'sync': reply inside the callback; 'async': acknowledge at once and push the report when ready
+WECHAT_REPLY_MODE = os.getenv('WECHAT_REPLY_MODE', 'sync').lower()
+# Threads computing reports in async reply mode
+REPLY_WORKERS = int(os.getenv('REPLY_WORKERS', 4))
+
+# Callback Deduplication (WeChat Work re-delivers a slow callback up to 3 times)
+# Seconds a message ID is remembered
+DEDUP_TTL = float(os.getenv('DEDUP_TTL', 60))
+DEDUP_MAX_ENTRIES = int(os.getenv('DEDUP_MAX_ENTRIES', 1024))
+# Directory where the worker processes of a host claim messages in async reply mode,
+# so a re-delivery reaching another worker is not pushed twice ('' = this process only)
+DEDUP_SHARED_DIR = os.getenv('DEDUP_SHARED_DIR', 'data/dedup')
+# Seconds a re-delivery waits for the original computation before acknowledging
+DEDUP_WAIT_TIMEOUT = float(os.getenv('DEDUP_WAIT_TIMEOUT', 4))
+
+# Metrics (/metrics, Prometheus text format)
+# Latency histograms and error counters; false turns every observation into a no-op
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+# Label every series with the worker's pid; each worker keeps its own figures
+METRICS_PID_LABEL = os.getenv('METRICS_PID_LABEL', 'true').lower() == 'true'
+
+# Debugging (off by default)
+# Token expected in the X-Debug-Token header of /debug/* requests; empty disables those endpoints
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN', '')
+# Longest profile /debug/profile will take, and seconds between its stack samples
+DEBUG_PROFILE_MAX_SECONDS = float(os.getenv('DEBUG_PROFILE_MAX_SECONDS', 60))
+DEBUG_PROFILE_INTERVAL = float(os.getenv('DEBUG_PROFILE_INTERVAL', 0.005))
+# Log statements slower than this many milliseconds, with parameters and row count (0 = off)
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 0))
+# Slow statements kept for /debug/slow_queries
+SLOW_QUERY_LOG_SIZE = int(os.getenv('SLOW_QUERY_LOG_SIZE', 100))
+
 # Server Configuration
 FLASK_PORT = int(os.getenv('FLASK_PORT', 5000))
+
+# Startup Warm-Up (readiness at /ready)
+# Open pooled connections and render the menu reports once before the first callbacks
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', 'true').lower() == 'true'
+WARMUP_CONNECTIONS = int(os.getenv('WARMUP_CONNECTIONS', 2))
+
+# Multi-Worker Serving (gunicorn.conf.py)
+GUNICORN_WORKERS = int(os.getenv('GUNICORN_WORKERS', 4))
+GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', 8))
+# Which worker runs the once-only jobs (daily report, rollups, partitions, replica sync):
+# 'file' (flock on SCHEDULER_LOCK_FILE, one host), 'mysql' (GET_LOCK, any number of hosts)
+# or 'none' (every process runs them; only for a single process)
+SCHEDULER_LEASE = os.getenv('SCHEDULER_LEASE', 'file').lower()
+SCHEDULER_LOCK_FILE = os.getenv('SCHEDULER_LOCK_FILE', 'data/scheduler.lock')
+SCHEDULER_LOCK_NAME = os.getenv('SCHEDULER_LOCK_NAME', 'eyewear_bot_scheduler')
+# Seconds between attempts to take over the lease (and, for 'mysql', checks it is still held)
+SCHEDULER_LEASE_SECONDS = int(os.getenv('SCHEDULER_LEASE_SECONDS', 15))
+# Hours after 12:05 AM in which a new leader still sends a daily report the previous one missed
+DAILY_REPORT_CATCHUP_HOURS = float(os.getenv('DAILY_REPORT_CATCHUP_HOURS', 6))
+
+# Native asyncio Serving (asgi.py; requires starlette, aiomysql and httpx)
+# Connections in each aiomysql pool (primary and every replica) the event loop runs report queries on
+ASYNC_DB_POOL_SIZE = int(os.getenv('ASYNC_DB_POOL_SIZE', 20))
+
+
+def check_config():
+    """
+    Reject settings that cannot work together; called when an app is built
+
+    Raises:
+        ValueError: Describing the first conflict found
+    """
+    if ROLLUP_ENABLED and not SALES_DIMENSION_ENABLED:
+        # Since migration 003 the rollup tables are keyed by sales_id only
+        raise ValueError("ROLLUP_ENABLED 需要同时启用 SALES_DIMENSION_ENABLED（汇总表按 sales_id 汇总）")
+    if WECHAT_REPLY_MODE == 'async' and not (WECHAT_CORP_ID and WECHAT_CORP_SECRET and WECHAT_AGENT_ID):
+        # Replies are pushed to the sender through the app; the group robot would show them to everyone
+        raise ValueError("WECHAT_REPLY_MODE=async 需要配置 WECHAT_CORP_ID、WECHAT_CORP_SECRET 和 WECHAT_AGENT_ID")
+    if EMBEDDED_BACKEND == 'duckdb' and GUNICORN_WORKERS > 1:
+        # A DuckDB file open for writing is locked against every other process, readers included
+        raise ValueError("EMBEDDED_BACKEND=duckdb 仅支持单进程访问，请设置 GUNICORN_WORKERS=1 或改用 sqlite")
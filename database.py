@@ -1,21 +1,846 @@
 """
 Database operations module
 """
+import contextvars
+import functools
 import pymysql
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from config import DB_CONFIG
+from config import (
+    DB_CONFIG,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_POOL_MAX_LIFETIME,
+    DB_POOL_PING_INTERVAL,
+    DB_QUERY_WORKERS,
+    DB_QUERY_TIMEOUT,
+    ROLLUP_ENABLED,
+    ROLLUP_COVERAGE_TTL,
+    RESULT_CACHE_ENABLED,
+    EMBEDDED_ROUTES,
+    EMBEDDED_MIN_DAYS,
+    DB_REPLICA_TODAY_ON_PRIMARY,
+)
+from cache import get_default_cache, get_default_invalidation_log
+from sales_cube import get_default_cube
+from sales_directory import get_default_sales_directory
+from backends import get_default_backend
+from replicas import get_default_replica_set
+from circuit_breaker import get_default_db_breaker
+from deadlines import remaining, execution_time_ms
+from metrics import DB_QUERY_SECONDS, DB_READS
+from slowlog import TimedConnection, get_default_slow_query_log
+
+
+# Report statements shared with the EXPLAIN check in migrate.py. ``{sales}``
+# is the sales person column (see Database.sales_column).
+# Fused leads/orders totals: each side is grouped by sales WITH ROLLUP, so the
+# per-sales rows and the total come back together in one round trip.
+COMBINED_STATS_SQL = """
+    (SELECT 'leads' AS source, {sales} AS sales, COUNT(*) AS row_count, NULL AS total_sales
+     FROM leads
+     WHERE leads_date >= %s AND leads_date <= %s
+     GROUP BY {sales} WITH ROLLUP)
+    UNION ALL
+    (SELECT 'orders' AS source, {sales} AS sales, COUNT(*) AS row_count, SUM(sales_price) AS total_sales
+     FROM sales_orders
+     WHERE order_date >= %s AND order_date <= %s
+     GROUP BY {sales} WITH ROLLUP)
+"""
+
+LEADS_BY_DAY_SQL = """
+    SELECT DATE(leads_date) as day, COUNT(*) as leads_count
+    FROM leads
+    WHERE leads_date >= %s AND leads_date <= %s
+    GROUP BY day
+"""
+
+ORDERS_BY_DAY_SQL = """
+    SELECT DATE(order_date) as day, COUNT(*) as orders_count, SUM(sales_price) as total_sales
+    FROM sales_orders
+    WHERE order_date >= %s AND order_date <= %s
+    GROUP BY day
+"""
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection becomes available in time"""
+
+
+class QueryTimeoutError(Exception):
+    """Raised when concurrent report queries do not finish in time"""
+
+
+# Errors that mean the database is unreachable, overloaded or too slow; they
+# count towards opening the circuit breaker
+DB_FAILURES = (pymysql.err.OperationalError, pymysql.err.InterfaceError, PoolTimeoutError, QueryTimeoutError)
+
+
+# pymysql error codes for a connection that could not be opened or was lost
+CONNECTION_ERROR_CODES = (2003, 2006, 2013)
+
+# MySQL error code for a table that does not exist (migration not applied)
+ER_NO_SUCH_TABLE = 1146
+
+
+def _is_missing_table(error):
+    """Whether a pymysql error means the table it used does not exist"""
+    return isinstance(error, pymysql.err.ProgrammingError) and bool(error.args) \
+        and error.args[0] == ER_NO_SUCH_TABLE
+
+
+def _is_connection_error(error):
+    """Whether a DB_FAILURES error means the server could not be reached"""
+    if isinstance(error, pymysql.err.InterfaceError):
+        return True
+    return isinstance(error, pymysql.err.OperationalError) and bool(error.args) \
+        and error.args[0] in CONNECTION_ERROR_CODES
+
+
+class _PooledConnection:
+    """A pymysql connection plus the bookkeeping the pool needs"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        # Session MAX_EXECUTION_TIME in milliseconds (0 = server default)
+        self.max_execution_time = 0
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of pymysql connections
+
+    Connections are opened lazily up to ``size``, validated with a ping when
+    they have been idle longer than ``ping_interval`` seconds, and recycled
+    once they are older than ``max_lifetime`` seconds. Borrowers wait at most
+    ``timeout`` seconds for a free connection. With a ``slow_query_log`` every
+    statement run on the pool's connections is timed.
+    """
+
+    def __init__(self, config, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT,
+                 max_lifetime=DB_POOL_MAX_LIFETIME, ping_interval=DB_POOL_PING_INTERVAL,
+                 slow_query_log=None):
+        # Report queries are read-only; autocommit keeps a reused connection
+        # from serving an old REPEATABLE READ snapshot.
+        self.config = dict(config, autocommit=True)
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+        self.slow_query_log = slow_query_log
+        self._idle = deque()
+        self._in_use = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        if self.slow_query_log is not None:
+            return _PooledConnection(TimedConnection(slow_query_log=self.slow_query_log, **self.config))
+        return _PooledConnection(pymysql.connect(**self.config))
+
+    def _is_expired(self, pooled, now):
+        return self.max_lifetime > 0 and now - pooled.created_at > self.max_lifetime
+
+    def _close(self, pooled):
+        try:
+            pooled.conn.close()
+        except Exception:
+            pass
+
+    def _validate(self, pooled):
+        """Return the connection if it is still usable, otherwise close it"""
+        now = time.monotonic()
+        if self._is_expired(pooled, now):
+            self._close(pooled)
+            return None
+        if now - pooled.last_used >= self.ping_interval:
+            try:
+                pooled.conn.ping(reconnect=False)
+            except Exception:
+                self._close(pooled)
+                return None
+        return pooled
+
+    def acquire(self):
+        """
+        Borrow a connection from the pool
+
+        Returns:
+            _PooledConnection: Must be handed back with ``release``
+
+        Raises:
+            PoolTimeoutError: If no connection is free within ``timeout``,
+                or before the current query deadline
+        """
+        timeout = self.timeout
+        left = remaining()
+        if left is not None:
+            timeout = max(min(timeout, left), 0)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._waiting += 1
+            try:
+                while True:
+                    if self._idle:
+                        pooled = self._idle.pop()
+                        break
+                    if self._in_use < self.size:
+                        pooled = None
+                        break
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        raise PoolTimeoutError(
+                            f"No database connection available after {timeout:.1f}s "
+                            f"(pool size {self.size})"
+                        )
+                    self._cond.wait(wait)
+                self._in_use += 1
+            finally:
+                self._waiting -= 1
+
+        # Validation and connecting happen outside the lock so a slow
+        # handshake never blocks other borrowers.
+        try:
+            if pooled is not None:
+                pooled = self._validate(pooled)
+            if pooled is None:
+                pooled = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return pooled
+
+    def release(self, pooled, discard=False):
+        """
+        Return a borrowed connection to the pool
+
+        Args:
+            pooled: Connection obtained from ``acquire``
+            discard: Close the connection instead of keeping it idle
+        """
+        now = time.monotonic()
+        if discard or self._is_expired(pooled, now):
+            self._close(pooled)
+            pooled = None
+        else:
+            pooled.last_used = now
+        with self._cond:
+            self._in_use -= 1
+            if pooled is not None:
+                self._idle.append(pooled)
+            self._cond.notify()
+
+    def warm(self, count=None):
+        """
+        Open connections ahead of the first requests
+
+        Args:
+            count: Connections to have open, at most (and by default) the pool size
+
+        Returns:
+            int: Connections borrowed and handed back
+        """
+        count = self.size if count is None else min(count, self.size)
+        borrowed = []
+        try:
+            while len(borrowed) < count:
+                borrowed.append(self.acquire())
+        finally:
+            for pooled in borrowed:
+                self.release(pooled)
+        return len(borrowed)
+
+    def _apply_deadline(self, pooled):
+        """Limit the connection's statements to the time left before the query deadline"""
+        ms = execution_time_ms()
+        if ms != pooled.max_execution_time:
+            with pooled.conn.cursor() as cursor:
+                cursor.execute("SET SESSION MAX_EXECUTION_TIME = %s", (ms,))
+            pooled.max_execution_time = ms
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a ``with`` block"""
+        pooled = self.acquire()
+        broken = False
+        try:
+            self._apply_deadline(pooled)
+            yield pooled.conn
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.release(pooled, discard=broken)
+
+    def stats(self):
+        """
+        Get pool usage
+
+        Returns:
+            dict: Pool size and how many connections are in use, idle and waiting
+        """
+        with self._cond:
+            return {
+                'size': self.size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+            }
+
+    def close(self):
+        """Close every idle connection"""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for pooled in idle:
+            self._close(pooled)
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool():
+    """Return the process-wide pool shared by every Database instance"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool(DB_CONFIG, slow_query_log=get_default_slow_query_log())
+        return _default_pool
+
+
+_query_executor = None
+_query_executor_lock = threading.Lock()
+
+
+def get_query_executor():
+    """Return the process-wide thread pool for concurrent report queries"""
+    global _query_executor
+    with _query_executor_lock:
+        if _query_executor is None:
+            _query_executor = ThreadPoolExecutor(
+                max_workers=max(DB_QUERY_WORKERS, 1),
+                thread_name_prefix='db-query',
+            )
+        return _query_executor
+
+
+def _fold_rollup_rows(rows):
+    """
+    Split the rows of the fused leads/orders ROLLUP query into the
+    ``get_leads_stats`` and ``get_orders_stats`` result shapes
+
+    The sales column is NOT NULL in both tables, so a NULL ``sales`` marks
+    the ROLLUP super-aggregate row that carries the total.
+
+    Args:
+        rows: Rows with ``source``, ``sales``, ``row_count`` and ``total_sales``
+
+    Returns:
+        tuple: (leads_stats, orders_stats)
+    """
+    leads_stats = {'total_leads': 0, 'by_sales': []}
+    orders_stats = {'total_orders': 0, 'by_sales': []}
+    for row in rows:
+        if row['source'] == 'leads':
+            if row['sales'] is None:
+                leads_stats['total_leads'] = row['row_count']
+            else:
+                leads_stats['by_sales'].append({
+                    'sales': row['sales'],
+                    'leads_count': row['row_count'],
+                })
+        else:
+            if row['sales'] is None:
+                orders_stats['total_orders'] = row['row_count']
+            else:
+                orders_stats['by_sales'].append({
+                    'sales': row['sales'],
+                    'orders_count': row['row_count'],
+                    'total_sales': row['total_sales'],
+                })
+    # Ties are broken by name so every query path lists sales people in the same order
+    leads_stats['by_sales'].sort(key=lambda r: (-r['leads_count'], r['sales']))
+    orders_stats['by_sales'].sort(key=lambda r: (-r['orders_count'], r['sales']))
+    return leads_stats, orders_stats
+
+
+def _build_combined_rows(rows):
+    """
+    Turn per-sales rows (``sales``, ``leads_count``, ``orders_count``,
+    ``total_sales``) into the ``get_leads_stats`` / ``get_orders_stats``
+    result shapes
+
+    A sales person only appears in a breakdown when they have at least one
+    lead (or order) in it, matching the GROUP BY queries on the raw tables.
+
+    Returns:
+        tuple: (leads_stats, orders_stats)
+    """
+    leads_by_sales = []
+    orders_by_sales = []
+    for row in rows:
+        leads_count = int(row['leads_count'] or 0)
+        orders_count = int(row['orders_count'] or 0)
+        if leads_count:
+            leads_by_sales.append({'sales': row['sales'], 'leads_count': leads_count})
+        if orders_count:
+            orders_by_sales.append({
+                'sales': row['sales'],
+                'orders_count': orders_count,
+                'total_sales': row['total_sales'],
+            })
+    # Same ordering as _fold_rollup_rows
+    leads_by_sales.sort(key=lambda r: (-r['leads_count'], r['sales']))
+    orders_by_sales.sort(key=lambda r: (-r['orders_count'], r['sales']))
+    return (
+        {'total_leads': sum(r['leads_count'] for r in leads_by_sales), 'by_sales': leads_by_sales},
+        {'total_orders': sum(r['orders_count'] for r in orders_by_sales), 'by_sales': orders_by_sales},
+    )
+
+
+def _stats_to_rows(stats):
+    """Turn a ``get_combined_stats`` result back into per-sales rows"""
+    rows = {}
+    for item in stats['leads']['by_sales']:
+        rows[item['sales']] = {'sales': item['sales'], 'leads_count': item['leads_count'],
+                               'orders_count': 0, 'total_sales': 0}
+    for item in stats['orders']['by_sales']:
+        row = rows.setdefault(item['sales'], {'sales': item['sales'], 'leads_count': 0})
+        row['orders_count'] = item['orders_count']
+        row['total_sales'] = item['total_sales']
+    return list(rows.values())
+
+
+def _sum_rows_by_sales(rows):
+    """Add up per-sales rows that come from several sources"""
+    totals = {}
+    for row in rows:
+        total = totals.get(row['sales'])
+        if total is None:
+            totals[row['sales']] = dict(row)
+        else:
+            total['leads_count'] += row['leads_count']
+            total['orders_count'] += row['orders_count']
+            total['total_sales'] = (total['total_sales'] or 0) + (row['total_sales'] or 0)
+    return list(totals.values())
+
+
+def _merge_daily_totals(leads_by_day, orders_by_day):
+    """Per-day summary lines of ``get_stats_by_date`` from the leads and orders totals"""
+    days = set(list(leads_by_day.keys()) + list(orders_by_day.keys()))
+    result = {}
+    for d in days:
+        leads_cnt = leads_by_day.get(d, 0)
+        orders_info = orders_by_day.get(d, {'orders_count': 0, 'total_sales': 0.0})
+        result[d] = f"线索:{leads_cnt} 订单:{orders_info['orders_count']} 销售额:¥{orders_info['total_sales']}"
+    return result
+
+
+def _month_end(day):
+    """Return the last day of the month containing ``day``"""
+    next_month = (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return next_month - timedelta(days=1)
+
+
+def _plan_rollup_segments(start_date, end_date, first_day, last_day):
+    """
+    Split a date range into the pieces answered by each rollup level
+
+    Days inside [first_day, last_day] come from the rollups: whole calendar
+    months from ``monthly_sales_stats`` and the partial months at either edge
+    from ``daily_sales_stats``. Days outside it (normally just today) are
+    scanned from the raw tables.
+
+    Args:
+        start_date: Start date (inclusive)
+        end_date: End date (inclusive)
+        first_day: First day covered by the rollups
+        last_day: Last day covered by the rollups
+
+    Returns:
+        tuple: (month_range, day_ranges, raw_ranges) where month_range is
+        (first_month, last_month) or None and the others are lists of
+        inclusive (start, end) date pairs
+    """
+    one_day = timedelta(days=1)
+    lo = max(start_date, first_day)
+    hi = min(end_date, last_day)
+    if lo > hi:
+        return None, [], [(start_date, end_date)]
+
+    raw_ranges = []
+    if start_date < lo:
+        raw_ranges.append((start_date, lo - one_day))
+    if hi < end_date:
+        raw_ranges.append((hi + one_day, end_date))
+
+    month = lo if lo.day == 1 else _month_end(lo) + one_day
+    months = []
+    while month <= hi and _month_end(month) <= hi:
+        months.append(month)
+        month = _month_end(month) + one_day
+
+    if not months:
+        return None, [(lo, hi)], raw_ranges
+
+    day_ranges = []
+    if lo < months[0]:
+        day_ranges.append((lo, months[0] - one_day))
+    if _month_end(months[-1]) < hi:
+        day_ranges.append((_month_end(months[-1]) + one_day, hi))
+    return (months[0], months[-1]), day_ranges, raw_ranges
+
+
+def _cached_range_query(method):
+    """
+    Serve a ``(self, start_date, end_date)`` query method from the
+    instance's result cache when possible
+    """
+    @functools.wraps(method)
+    def wrapper(self, start_date, end_date):
+        self.apply_shared_invalidations()
+        if self.cache is None:
+            return method(self, start_date, end_date)
+        key = (method.__name__, start_date, end_date)
+        hit, value = self.cache.get(key)
+        if hit:
+            return value
+        value = method(self, start_date, end_date)
+        self.cache.put(key, value, start_date, end_date)
+        return value
+    return wrapper
 
 
 class Database:
     """Database connection and query handler"""
     
-    def __init__(self):
+    def __init__(self, pool=None, cache=None, cube=None, sales_directory=None, backend=None, replicas=None,
+                 breaker=None):
         self.config = DB_CONFIG
+        self._pool = pool
+        # Fails queries fast after repeated database failures (None when disabled)
+        self.breaker = breaker if breaker is not None else get_default_db_breaker()
+        # Read replicas for report queries (None when DB_REPLICAS is empty)
+        self.replicas = replicas if replicas is not None else get_default_replica_set()
+        if cache is None and RESULT_CACHE_ENABLED:
+            cache = get_default_cache()
+        self.cache = cache
+        self.cube = cube if cube is not None else get_default_cube()
+        # Passes invalidations on to the other worker processes (None when off)
+        self.invalidations = get_default_invalidation_log()
+        # With the sales_people dimension, reports group by the integer
+        # sales_id and names are looked up just before results are built
+        self.sales_directory = sales_directory if sales_directory is not None else get_default_sales_directory()
+        self.sales_column = 'sales_id' if self.sales_directory is not None else 'sales'
+        # Embedded replica answering the closed days of long ranges (None when off)
+        self.backend = backend if backend is not None else get_default_backend()
+        self._rollup_coverage = None
+        self._rollup_coverage_at = 0.0
+
+    @property
+    def pool(self):
+        """Connection pool used by this instance"""
+        if self._pool is None:
+            self._pool = get_default_pool()
+        return self._pool
     
     def get_connection(self):
-        """Create and return a database connection"""
-        return pymysql.connect(**self.config)
+        """
+        Borrow a pooled database connection
+
+        Usage:
+            with db.get_connection() as conn:
+                ...
+
+        The connection goes back to the pool when the block exits.
+
+        Raises:
+            CircuitOpenError: While the circuit breaker is open
+        """
+        return self._guarded_connection(self.pool, self.breaker)
+
+    @contextmanager
+    def _guarded_connection(self, pool, breaker, replica=None):
+        """
+        Borrow from ``pool``, reporting the outcome to its circuit breaker
+
+        A connection error on a replica also marks its lag unknown, so no
+        more reads go there until its next lag check succeeds.
+        """
+        if breaker is not None:
+            breaker.before_call()
+        try:
+            with pool.connection() as conn:
+                yield conn
+        except DB_FAILURES as e:
+            if breaker is not None:
+                breaker.record_failure()
+            if replica is not None and _is_connection_error(e):
+                replica.lag = None
+                replica.error = str(e)
+            raise
+        except BaseException:
+            if breaker is not None:
+                breaker.record_abandoned()
+            raise
+        if breaker is not None:
+            breaker.record_success()
+
+    def _read_replica(self, start_date=None):
+        if self.replicas is None:
+            return None
+        if DB_REPLICA_TODAY_ON_PRIMARY and start_date is not None and start_date >= datetime.now().date():
+            DB_READS.inc(target='primary_fresh')
+            return None
+        replica = self.replicas.choose()
+        if replica is None:
+            DB_READS.inc(target='primary_fallback')
+            return None
+        DB_READS.inc(target='replica')
+        return replica
+
+    def get_read_connection(self, start_date=None):
+        """
+        Borrow a connection for a read-only report query
+
+        Goes to a read replica when replicas are configured and one is
+        within DB_REPLICA_MAX_LAG, else to the primary. Ranges starting
+        today (今日) stay on the primary with DB_REPLICA_TODAY_ON_PRIMARY.
+        Each replica has its own circuit breaker, so a failing replica
+        does not stop reads from the primary or the other replicas.
+
+        Args:
+            start_date: First day the query reads, if it reads a date range
+
+        Raises:
+            CircuitOpenError: While the circuit breaker of the chosen server is open
+        """
+        replica = self._read_replica(start_date)
+        if replica is None:
+            return self._guarded_connection(self.pool, self.breaker)
+        return self._guarded_connection(replica.pool, replica.breaker, replica)
+
+    def pool_stats(self):
+        """Get connection pool usage (in use / idle / waiting)"""
+        return self.pool.stats()
+
+    def run_concurrently(self, calls, timeout=DB_QUERY_TIMEOUT):
+        """
+        Run independent queries side by side on the shared query thread pool
+
+        Each call borrows its own pooled connection, so the total latency is
+        that of the slowest query rather than the sum of all of them.
+
+        Args:
+            calls: dict mapping a name to a (callable, args) pair
+            timeout: Seconds to wait for all calls to finish (shortened to
+                the current query deadline)
+
+        Returns:
+            dict: The result of each call under its name
+
+        Raises:
+            QueryTimeoutError: If the calls do not all finish within timeout
+            Exception: The first error raised by any call
+        """
+        executor = get_query_executor()
+        left = remaining()
+        if left is not None:
+            timeout = max(min(timeout, left), 0)
+        # Each call runs in the caller's context, so it keeps the query deadline
+        futures = {name: executor.submit(contextvars.copy_context().run, func, *args)
+                   for name, (func, args) in calls.items()}
+        deadline = time.monotonic() + timeout
+        results = {}
+        try:
+            for name, future in futures.items():
+                try:
+                    results[name] = future.result(timeout=max(deadline - time.monotonic(), 0))
+                except FutureTimeoutError:
+                    raise QueryTimeoutError(f"Query '{name}' did not finish within {timeout:.1f}s")
+        except BaseException:
+            for future in futures.values():
+                future.cancel()
+            raise
+        return results
+
+    def _sql(self, sql):
+        """Fill the sales person column into a statement"""
+        return sql.replace('{sales}', self.sales_column)
+
+    def _load_sales_people(self):
+        with self.get_read_connection() as conn:
+            with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute("SELECT sales_id, name FROM sales_people")
+                return {row['sales_id']: row['name'] for row in cursor.fetchall()}
+
+    def resolve_sales_names(self, rows):
+        """
+        Replace the sales IDs in rows' ``sales`` field with display names
+
+        A no-op when the sales_people dimension is disabled (``sales``
+        already holds the name). NULL keys (ROLLUP totals) are left alone.
+
+        Args:
+            rows: Row dicts, modified in place
+
+        Returns:
+            list: The same rows
+        """
+        if self.sales_directory is None:
+            return rows
+        sales_ids = {row['sales'] for row in rows if row['sales'] is not None}
+        if not sales_ids:
+            return rows
+        names = self.sales_directory.resolve(sales_ids, self._load_sales_people)
+        for row in rows:
+            if row['sales'] is not None:
+                row['sales'] = names.get(row['sales'], f"#{row['sales']}")
+        return rows
+
+    @DB_QUERY_SECONDS.time(method='rename_sales_person')
+    def rename_sales_person(self, old_name, new_name):
+        """
+        Rename a sales person without splitting their history
+
+        The new name becomes the display name and an alias, so rows written
+        under either name count for the same sales_id. Register the rename
+        before the source system starts writing the new name; rows arriving
+        first would create a separate sales person.
+
+        Args:
+            old_name: Current name (or any alias) of the sales person
+            new_name: Name to show from now on
+
+        Returns:
+            int: The sales person's sales_id
+
+        Raises:
+            ValueError: If old_name is unknown or new_name belongs to
+                another sales person
+        """
+        with self.get_connection() as conn:
+            with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute("SELECT sales_id FROM sales_aliases WHERE alias = %s", (old_name,))
+                row = cursor.fetchone()
+                if row is None:
+                    raise ValueError(f"未找到销售人员: {old_name}")
+                sales_id = row['sales_id']
+                cursor.execute("SELECT sales_id FROM sales_aliases WHERE alias = %s", (new_name,))
+                other = cursor.fetchone()
+                if other is not None and other['sales_id'] != sales_id:
+                    raise ValueError(f"名称 {new_name} 已属于其他销售人员 (sales_id={other['sales_id']})")
+                conn.begin()
+                try:
+                    cursor.execute("UPDATE sales_people SET name = %s WHERE sales_id = %s", (new_name, sales_id))
+                    cursor.execute("INSERT IGNORE INTO sales_aliases (alias, sales_id) VALUES (%s, %s)",
+                                   (new_name, sales_id))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+
+        if self.sales_directory is not None:
+            self.sales_directory.invalidate()
+        # Cached reports carry the old name
+        self.invalidate_cache()
+        return sales_id
+
+    def cache_stats(self):
+        """Get result cache counters, or None when caching is disabled"""
+        return self.cache.stats() if self.cache is not None else None
+
+    def invalidate_cache(self, start_date=None, end_date=None):
+        """
+        Drop cached results overlapping a date range
+
+        Call this after back-dating orders or loading late leads for days
+        that are already closed. With no arguments the whole cache is cleared.
+        The other worker processes drop theirs before their next lookup.
+
+        Args:
+            start_date: First changed day (inclusive)
+            end_date: Last changed day (inclusive), defaults to start_date
+
+        Returns:
+            int: Number of cached results removed in this process
+        """
+        if self.invalidations is not None:
+            self.invalidations.publish(start_date, end_date)
+        return self._drop_cached(start_date, end_date)
+
+    def apply_shared_invalidations(self):
+        """Drop what other worker processes invalidated since the last check"""
+        if self.invalidations is None:
+            return
+        for start_date, end_date in self.invalidations.poll():
+            self._drop_cached(start_date, end_date)
+
+    def _drop_cached(self, start_date, end_date):
+        if self.cube is not None and start_date is not None:
+            self.cube.invalidate(start_date, end_date)
+        if self.cache is None:
+            return 0
+        return self.cache.invalidate(start_date, end_date)
     
+    def _backend_split(self, query_type, start_date, end_date):
+        """
+        Decide which part of a range the embedded backend answers
+
+        Returns:
+            tuple: (backend_end, rest) where backend_end is the last day read
+            from the backend (None to skip it) and rest is the (start, end)
+            pair still read from MySQL, or None
+        """
+        if self.backend is None or query_type not in EMBEDDED_ROUTES:
+            return None, (start_date, end_date)
+        if (end_date - start_date).days + 1 < EMBEDDED_MIN_DAYS:
+            return None, (start_date, end_date)
+        coverage = self.backend.coverage()
+        if coverage is None or not coverage[0] <= start_date <= coverage[1]:
+            return None, (start_date, end_date)
+        backend_end = min(end_date, coverage[1])
+        if backend_end < end_date:
+            return backend_end, (backend_end + timedelta(days=1), end_date)
+        return backend_end, None
+
+    @DB_QUERY_SECONDS.time(method='export_fact_rows')
+    def export_fact_rows(self, start_date, end_date):
+        """
+        Read the report columns of the raw rows in a date range, for
+        copying to an embedded backend
+
+        Returns:
+            tuple: (leads, orders) where leads are (leads_date, sales,
+            leads_id) tuples and orders are (order_date, sales, price in
+            cents, order_id) tuples; ``sales`` is the sales key
+        """
+        with self.get_read_connection(start_date) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self._sql("""
+                    SELECT leads_date, {sales}, leads_id
+                    FROM leads
+                    WHERE leads_date >= %s AND leads_date <= %s
+                """), (start_date, end_date))
+                leads = cursor.fetchall()
+                cursor.execute(self._sql("""
+                    SELECT order_date, {sales}, ROUND(sales_price * 100), order_id
+                    FROM sales_orders
+                    WHERE order_date >= %s AND order_date <= %s
+                """), (start_date, end_date))
+                orders = cursor.fetchall()
+        return leads, orders
+
+    @DB_QUERY_SECONDS.time(method='get_leads_stats')
     def get_leads_stats(self, start_date, end_date):
         """
         Get leads statistics for a date range
@@ -27,8 +852,7 @@ class Database:
         Returns:
             dict: Statistics including total leads and breakdown by sales
         """
-        conn = self.get_connection()
-        try:
+        with self.get_read_connection(start_date) as conn:
             with conn.cursor(pymysql.cursors.DictCursor) as cursor:
                 # Total leads count
                 sql_total = """
@@ -40,15 +864,15 @@ class Database:
                 total_result = cursor.fetchone()
                 
                 # Leads by sales person
-                sql_by_sales = """
-                    SELECT sales, COUNT(*) as leads_count
+                sql_by_sales = self._sql("""
+                    SELECT {sales} AS sales, COUNT(*) as leads_count
                     FROM leads
                     WHERE leads_date >= %s AND leads_date <= %s
-                    GROUP BY sales
+                    GROUP BY {sales}
                     ORDER BY leads_count DESC
-                """
+                """)
                 cursor.execute(sql_by_sales, (start_date, end_date))
-                by_sales_result = cursor.fetchall()
+                by_sales_result = self.resolve_sales_names(cursor.fetchall())
                 # Ensure total_sales is integer
                 for row in by_sales_result:
                     if 'total_sales' in row:
@@ -58,9 +882,8 @@ class Database:
                     'total_leads': total_result['total_leads'] if total_result else 0,
                     'by_sales': by_sales_result
                 }
-        finally:
-            conn.close()
     
+    @DB_QUERY_SECONDS.time(method='get_orders_stats')
     def get_orders_stats(self, start_date, end_date):
         """
         Get sales orders statistics for a date range
@@ -72,8 +895,7 @@ class Database:
         Returns:
             dict: Statistics including total orders and breakdown by sales
         """
-        conn = self.get_connection()
-        try:
+        with self.get_read_connection(start_date) as conn:
             with conn.cursor(pymysql.cursors.DictCursor) as cursor:
                 # Total orders count
                 sql_total = """
@@ -85,26 +907,30 @@ class Database:
                 total_result = cursor.fetchone()
                 
                 # Orders by sales person (joined with leads table)
-                sql_by_sales = """
-                    SELECT so.sales, COUNT(*) as orders_count, SUM(so.sales_price) as total_sales
+                sql_by_sales = self._sql("""
+                    SELECT so.{sales} AS sales, COUNT(*) as orders_count, SUM(so.sales_price) as total_sales
                     FROM sales_orders so
                     WHERE so.order_date >= %s AND so.order_date <= %s
-                    GROUP BY so.sales
+                    GROUP BY so.{sales}
                     ORDER BY orders_count DESC
-                """
+                """)
                 cursor.execute(sql_by_sales, (start_date, end_date))
-                by_sales_result = cursor.fetchall()
+                by_sales_result = self.resolve_sales_names(cursor.fetchall())
                 
                 return {
                     'total_orders': total_result['total_orders'] if total_result else 0,
                     'by_sales': by_sales_result
                 }
-        finally:
-            conn.close()
     
+    @DB_QUERY_SECONDS.time(method='get_combined_stats')
+    @_cached_range_query
     def get_combined_stats(self, start_date, end_date):
         """
         Get combined leads and orders statistics for a date range
+
+        Both tables are aggregated in a single statement: each side is
+        grouped by sales WITH ROLLUP, so the per-sales rows and the total
+        come back together in one round trip.
         
         Args:
             start_date: Start date (inclusive)
@@ -113,9 +939,32 @@ class Database:
         Returns:
             dict: Combined statistics
         """
-        leads_stats = self.get_leads_stats(start_date, end_date)
-        orders_stats = self.get_orders_stats(start_date, end_date)
-        
+        stats = self._get_combined_stats_from_cube(start_date, end_date)
+        if stats is not None:
+            return stats
+
+        backend_end, rest = self._backend_split('combined_stats', start_date, end_date)
+        if backend_end is not None:
+            rows = self.resolve_sales_names(self.backend.sales_rows(start_date, backend_end))
+            if rest is not None:
+                rows = _sum_rows_by_sales(rows + _stats_to_rows(self.get_combined_stats(*rest)))
+            leads_stats, orders_stats = _build_combined_rows(rows)
+            return {
+                'leads': leads_stats,
+                'orders': orders_stats,
+                'start_date': start_date.strftime('%Y-%m-%d'),
+                'end_date': end_date.strftime('%Y-%m-%d')
+            }
+
+        coverage = self._get_rollup_coverage() if ROLLUP_ENABLED else None
+        if coverage and start_date <= coverage[1] and end_date >= coverage[0]:
+            return self._get_combined_stats_from_rollups(start_date, end_date, coverage)
+
+        with self.get_read_connection(start_date) as conn:
+            with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute(self._sql(COMBINED_STATS_SQL), (start_date, end_date, start_date, end_date))
+                leads_stats, orders_stats = _fold_rollup_rows(self.resolve_sales_names(cursor.fetchall()))
+
         return {
             'leads': leads_stats,
             'orders': orders_stats,
@@ -123,43 +972,571 @@ class Database:
             'end_date': end_date.strftime('%Y-%m-%d')
         }
 
+    @DB_QUERY_SECONDS.time(method='get_stats_by_date')
+    @_cached_range_query
     def get_stats_by_date(self, start_date, end_date):
         """
         Get aggregated stats grouped by date between start_date and end_date.
 
         Returns a dict mapping 'YYYY-MM-DD' -> summary string or dict.
         """
-        conn = self.get_connection()
-        try:
+        closed_end = min(end_date, datetime.now().date() - timedelta(days=1))
+        coverage = self._get_rollup_coverage() if ROLLUP_ENABLED else None
+        backend_end, rest = self._backend_split('stats_by_date', start_date, end_date)
+        cube_totals = None
+        if self.cube is not None and start_date <= closed_end:
+            cube_totals = self.cube.daily_totals(start_date, closed_end)
+        if cube_totals is not None:
+            leads_by_day, orders_by_day = cube_totals
+            if closed_end < end_date:
+                open_leads, open_orders = self._get_daily_totals(closed_end + timedelta(days=1), end_date)
+                leads_by_day.update(open_leads)
+                orders_by_day.update(open_orders)
+        elif backend_end is not None:
+            leads_by_day, orders_by_day = self.backend.daily_totals(start_date, backend_end)
+            if rest is not None:
+                open_leads, open_orders = self._get_daily_totals(*rest)
+                leads_by_day.update(open_leads)
+                orders_by_day.update(open_orders)
+        elif coverage and start_date <= coverage[1] and end_date >= coverage[0]:
+            leads_by_day, orders_by_day = self._get_daily_totals_from_rollups(start_date, end_date, coverage)
+        else:
+            leads_by_day, orders_by_day = self._get_daily_totals(start_date, end_date)
+
+        return _merge_daily_totals(leads_by_day, orders_by_day)
+
+    def _get_daily_totals(self, start_date, end_date):
+        """
+        Get per-day leads and orders totals from the raw tables
+
+        Returns:
+            tuple: (leads_by_day, orders_by_day) keyed by 'YYYY-MM-DD'
+        """
+        with self.get_read_connection(start_date) as conn:
             with conn.cursor(pymysql.cursors.DictCursor) as cursor:
                 # Leads per day
-                sql_leads = """
-                    SELECT DATE(leads_date) as day, COUNT(*) as leads_count
-                    FROM leads
-                    WHERE leads_date >= %s AND leads_date <= %s
-                    GROUP BY day
-                """
-                cursor.execute(sql_leads, (start_date, end_date))
+                cursor.execute(LEADS_BY_DAY_SQL, (start_date, end_date))
                 leads_by_day = {row['day'].strftime('%Y-%m-%d'): row['leads_count'] for row in cursor.fetchall()}
 
                 # Orders per day and total sales
-                sql_orders = """
-                    SELECT DATE(order_date) as day, COUNT(*) as orders_count, SUM(sales_price) as total_sales
-                    FROM sales_orders
-                    WHERE order_date >= %s AND order_date <= %s
-                    GROUP BY day
-                """
-                cursor.execute(sql_orders, (start_date, end_date))
+                cursor.execute(ORDERS_BY_DAY_SQL, (start_date, end_date))
                 orders_by_day = {row['day'].strftime('%Y-%m-%d'): {'orders_count': row['orders_count'], 'total_sales': int(row['total_sales'] or 0)} for row in cursor.fetchall()}
 
-                # Merge results
-                days = set(list(leads_by_day.keys()) + list(orders_by_day.keys()))
-                result = {}
-                for d in days:
-                    leads_cnt = leads_by_day.get(d, 0)
-                    orders_info = orders_by_day.get(d, {'orders_count': 0, 'total_sales': 0.0})
-                    result[d] = f"线索:{leads_cnt} 订单:{orders_info['orders_count']} 销售额:¥{orders_info['total_sales']}"
+        return leads_by_day, orders_by_day
 
-                return result
-        finally:
-            conn.close()
+    def _get_combined_stats_from_cube(self, start_date, end_date):
+        """
+        Answer a range from the in-memory cube, adding today from SQL
+
+        Returns:
+            dict: Combined statistics, or None if the cube does not cover
+            the closed part of the range
+        """
+        if self.cube is None:
+            return None
+        closed_end = min(end_date, datetime.now().date() - timedelta(days=1))
+        if start_date > closed_end:
+            return None
+        rows = self.cube.range_rows(start_date, closed_end)
+        if rows is None:
+            return None
+
+        rows = self.resolve_sales_names(rows)
+        if closed_end < end_date:
+            open_stats = self.get_combined_stats(closed_end + timedelta(days=1), end_date)
+            rows = _sum_rows_by_sales(rows + _stats_to_rows(open_stats))
+        leads_stats, orders_stats = _build_combined_rows(rows)
+
+        return {
+            'leads': leads_stats,
+            'orders': orders_stats,
+            'start_date': start_date.strftime('%Y-%m-%d'),
+            'end_date': end_date.strftime('%Y-%m-%d')
+        }
+
+    @DB_QUERY_SECONDS.time(method='get_daily_sales_rows')
+    def get_daily_sales_rows(self, start_date, end_date):
+        """
+        Get leads, orders and revenue per (day, sales) for a date range
+
+        Long ranges are read from the embedded backend when routed there.
+        Otherwise covered days are read from ``daily_sales_stats`` when the
+        rollups are enabled and the rest is aggregated from the raw tables,
+        in one statement.
+
+        Returns:
+            list: Rows with ``day``, ``sales``, ``leads_count``,
+            ``orders_count`` and ``total_sales``; ``sales`` is the sales
+            key (the ID when the sales_people dimension is enabled, see
+            ``resolve_sales_names``)
+        """
+        backend_end, rest = self._backend_split('daily_sales_rows', start_date, end_date)
+        if backend_end is not None:
+            rows = self.backend.daily_sales_rows(start_date, backend_end)
+            if rest is not None:
+                rows.extend(self.get_daily_sales_rows(*rest))
+            return rows
+
+        coverage = self._get_rollup_coverage() if ROLLUP_ENABLED else None
+        parts = []
+        params = []
+        raw_ranges = [(start_date, end_date)]
+        if coverage:
+            lo, hi = max(start_date, coverage[0]), min(end_date, coverage[1])
+            if lo <= hi:
+                parts.append("""
+                    SELECT day, sales_id AS sales, leads_count, orders_count, total_sales
+                    FROM daily_sales_stats
+                    WHERE day >= %s AND day <= %s
+                """)
+                params.extend((lo, hi))
+                raw_ranges = []
+                if start_date < lo:
+                    raw_ranges.append((start_date, lo - timedelta(days=1)))
+                if hi < end_date:
+                    raw_ranges.append((hi + timedelta(days=1), end_date))
+        for raw_range in raw_ranges:
+            parts.append("""
+                SELECT leads_date AS day, {sales} AS sales, COUNT(*) AS leads_count, 0 AS orders_count, 0 AS total_sales
+                FROM leads
+                WHERE leads_date >= %s AND leads_date <= %s
+                GROUP BY leads_date, {sales}
+            """)
+            parts.append("""
+                SELECT order_date AS day, {sales} AS sales, 0 AS leads_count, COUNT(*) AS orders_count,
+                       SUM(sales_price) AS total_sales
+                FROM sales_orders
+                WHERE order_date >= %s AND order_date <= %s
+                GROUP BY order_date, {sales}
+            """)
+            params.extend(raw_range)
+            params.extend(raw_range)
+
+        sql = (
+            "SELECT day, sales, SUM(leads_count) AS leads_count, SUM(orders_count) AS orders_count, "
+            "SUM(total_sales) AS total_sales FROM ("
+            + " UNION ALL ".join(parts)
+            + ") AS t GROUP BY day, sales"
+        )
+        with self.get_read_connection(start_date) as conn:
+            with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute(self._sql(sql), params)
+                return cursor.fetchall()
+
+    @DB_QUERY_SECONDS.time(method='get_today_baseline')
+    def get_today_baseline(self, day, leads_overlap_seconds, orders_overlap_seconds):
+        """
+        Get the starting point for incrementally maintained counters
+
+        Every read runs in one consistent snapshot, so the high-water
+        marks, the totals and the ID lists describe the same moment: a row
+        committed meanwhile is in none of them and is picked up by the
+        next delta.
+
+        Args:
+            day: Day being counted (today)
+            leads_overlap_seconds: How far before the lead high-water mark
+                to list lead IDs, for de-duplicating the next delta
+            orders_overlap_seconds: The same for orders
+
+        Returns:
+            dict: ``order_hwm_id``, ``order_hwm_created_at``,
+            ``lead_hwm_created_at``, per-sales ``rows`` for the day,
+            ``recent_lead_ids`` (leads_id -> created_at) and
+            ``recent_order_ids`` (order_id -> created_at)
+        """
+        with self.get_connection() as conn:
+            with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+                try:
+                    cursor.execute("SELECT MAX(order_id) AS max_id, MAX(created_at) AS max_created FROM sales_orders")
+                    order_hwm = cursor.fetchone()
+                    cursor.execute("SELECT MAX(created_at) AS max_created FROM leads")
+                    lead_hwm = cursor.fetchone()['max_created']
+
+                    cursor.execute(self._sql("""
+                        SELECT sales, SUM(leads_count) AS leads_count, SUM(orders_count) AS orders_count,
+                               SUM(total_sales) AS total_sales
+                        FROM (
+                            SELECT {sales} AS sales, COUNT(*) AS leads_count, 0 AS orders_count, 0 AS total_sales
+                            FROM leads
+                            WHERE leads_date = %s
+                            GROUP BY {sales}
+                            UNION ALL
+                            SELECT {sales} AS sales, 0 AS leads_count, COUNT(*) AS orders_count, SUM(sales_price) AS total_sales
+                            FROM sales_orders
+                            WHERE order_date = %s
+                            GROUP BY {sales}
+                        ) AS t
+                        GROUP BY sales
+                    """), (day, day))
+                    rows = cursor.fetchall()
+
+                    recent_lead_ids = {}
+                    if lead_hwm is not None:
+                        cursor.execute(
+                            "SELECT leads_id, created_at FROM leads WHERE created_at >= %s",
+                            (lead_hwm - timedelta(seconds=leads_overlap_seconds),)
+                        )
+                        recent_lead_ids = {row['leads_id']: row['created_at'] for row in cursor.fetchall()}
+
+                    recent_order_ids = {}
+                    if order_hwm['max_created'] is not None:
+                        cursor.execute(
+                            "SELECT order_id, created_at FROM sales_orders WHERE created_at >= %s",
+                            (order_hwm['max_created'] - timedelta(seconds=orders_overlap_seconds),)
+                        )
+                        recent_order_ids = {row['order_id']: row['created_at'] for row in cursor.fetchall()}
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+
+        return {
+            'order_hwm_id': order_hwm['max_id'] or 0,
+            'order_hwm_created_at': order_hwm['max_created'],
+            'lead_hwm_created_at': lead_hwm,
+            'rows': self.resolve_sales_names(rows),
+            'recent_lead_ids': recent_lead_ids,
+            'recent_order_ids': recent_order_ids,
+        }
+
+    @DB_QUERY_SECONDS.time(method='get_rows_since')
+    def get_rows_since(self, order_created_at, lead_created_at):
+        """
+        Get orders and leads added since the given high-water marks
+
+        Both are read by created_at from a little before the marks, so a
+        row committed after newer ones is still seen; callers drop the rows
+        they already counted by ID.
+
+        Args:
+            order_created_at: Lower bound for sales_orders.created_at (inclusive)
+            lead_created_at: Lower bound for leads.created_at (inclusive), or
+                None to skip leads
+
+        Returns:
+            tuple: (orders, leads) lists of row dicts in insertion order
+        """
+        with self.get_connection() as conn:
+            with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute(self._sql("""
+                    SELECT order_id, order_date, {sales} AS sales, sales_price, created_at
+                    FROM sales_orders
+                    WHERE created_at >= %s
+                    ORDER BY created_at, order_id
+                """), (order_created_at,))
+                orders = cursor.fetchall()
+                leads = []
+                if lead_created_at is not None:
+                    cursor.execute(self._sql("""
+                        SELECT leads_id, leads_date, {sales} AS sales, created_at
+                        FROM leads
+                        WHERE created_at >= %s
+                        ORDER BY created_at
+                    """), (lead_created_at,))
+                    leads = cursor.fetchall()
+        self.resolve_sales_names(orders + leads)
+        return orders, leads
+
+    def _get_rollup_coverage(self):
+        """
+        Get the first and last day whose rollup rows are complete
+
+        That is the last unbroken run of days in rollup_refresh_log: a day
+        missing from the log (the refresh job did not run, or failed) ends
+        the coverage, so days before it are scanned from the raw tables
+        rather than read from incomplete rollups. Cached for
+        ROLLUP_COVERAGE_TTL seconds. Today is never treated as covered, even
+        if a refresh was run for it by hand.
+
+        Returns:
+            tuple: (first_day, last_day), or None if nothing is covered yet
+        """
+        now = time.monotonic()
+        if now - self._rollup_coverage_at >= ROLLUP_COVERAGE_TTL:
+            with self.get_connection() as conn:
+                with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                    # The run starts at the latest day whose previous day is not logged
+                    cursor.execute("""
+                        SELECT
+                            (SELECT MAX(l.day)
+                             FROM rollup_refresh_log AS l
+                             LEFT JOIN rollup_refresh_log AS p ON p.day = l.day - INTERVAL 1 DAY
+                             WHERE p.day IS NULL) AS first_day,
+                            (SELECT MAX(day) FROM rollup_refresh_log) AS last_day
+                    """)
+                    row = cursor.fetchone()
+            if row and row['first_day'] is not None:
+                self._rollup_coverage = (row['first_day'], row['last_day'])
+            else:
+                self._rollup_coverage = None
+            self._rollup_coverage_at = now
+
+        if self._rollup_coverage is None:
+            return None
+        first_day, last_day = self._rollup_coverage
+        last_day = min(last_day, datetime.now().date() - timedelta(days=1))
+        if last_day < first_day:
+            return None
+        return first_day, last_day
+
+    def get_last_rollup_day(self):
+        """
+        Returns:
+            date: Last day in rollup_refresh_log, or None before the first refresh
+        """
+        with self.get_connection() as conn:
+            with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute("SELECT MAX(day) AS last_day FROM rollup_refresh_log")
+                row = cursor.fetchone()
+        return row['last_day'] if row else None
+
+    def _get_combined_stats_from_rollups(self, start_date, end_date, coverage):
+        """
+        Get combined statistics from month rows, edge-day rows and raw rows
+        for the days the rollups do not cover, in a single statement
+
+        Args:
+            start_date: Start date (inclusive)
+            end_date: End date (inclusive)
+            coverage: (first_day, last_day) from ``_get_rollup_coverage``
+
+        Returns:
+            dict: Combined statistics, same shape as ``get_combined_stats``
+        """
+        month_range, day_ranges, raw_ranges = _plan_rollup_segments(start_date, end_date, *coverage)
+        parts = []
+        params = []
+        if month_range:
+            parts.append("""
+                SELECT sales_id AS sales, leads_count, orders_count, total_sales
+                FROM monthly_sales_stats
+                WHERE month >= %s AND month <= %s
+            """)
+            params.extend(month_range)
+        for day_range in day_ranges:
+            parts.append("""
+                SELECT sales_id AS sales, leads_count, orders_count, total_sales
+                FROM daily_sales_stats
+                WHERE day >= %s AND day <= %s
+            """)
+            params.extend(day_range)
+        for raw_range in raw_ranges:
+            parts.append("""
+                SELECT {sales} AS sales, COUNT(*) AS leads_count, 0 AS orders_count, 0 AS total_sales
+                FROM leads
+                WHERE leads_date >= %s AND leads_date <= %s
+                GROUP BY {sales}
+            """)
+            parts.append("""
+                SELECT {sales} AS sales, 0 AS leads_count, COUNT(*) AS orders_count, SUM(sales_price) AS total_sales
+                FROM sales_orders
+                WHERE order_date >= %s AND order_date <= %s
+                GROUP BY {sales}
+            """)
+            params.extend(raw_range)
+            params.extend(raw_range)
+
+        sql = (
+            "SELECT sales, SUM(leads_count) AS leads_count, SUM(orders_count) AS orders_count, "
+            "SUM(total_sales) AS total_sales FROM ("
+            + " UNION ALL ".join(parts)
+            + ") AS t GROUP BY sales"
+        )
+        with self.get_read_connection(start_date) as conn:
+            with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute(self._sql(sql), params)
+                leads_stats, orders_stats = _build_combined_rows(self.resolve_sales_names(cursor.fetchall()))
+
+        return {
+            'leads': leads_stats,
+            'orders': orders_stats,
+            'start_date': start_date.strftime('%Y-%m-%d'),
+            'end_date': end_date.strftime('%Y-%m-%d')
+        }
+
+    def _get_daily_totals_from_rollups(self, start_date, end_date, coverage):
+        """
+        Get per-day leads and orders totals, reading covered days from
+        ``daily_sales_stats`` and the rest from the raw tables
+
+        Returns:
+            tuple: (leads_by_day, orders_by_day) keyed by 'YYYY-MM-DD'
+        """
+        first_day, last_day = coverage
+        lo, hi = max(start_date, first_day), min(end_date, last_day)
+        parts = []
+        params = []
+        if lo <= hi:
+            parts.append("""
+                SELECT day, SUM(leads_count) AS leads_count, SUM(orders_count) AS orders_count,
+                       SUM(total_sales) AS total_sales
+                FROM daily_sales_stats
+                WHERE day >= %s AND day <= %s
+                GROUP BY day
+            """)
+            params.extend((lo, hi))
+            raw_ranges = []
+            if start_date < lo:
+                raw_ranges.append((start_date, lo - timedelta(days=1)))
+            if hi < end_date:
+                raw_ranges.append((hi + timedelta(days=1), end_date))
+        else:
+            raw_ranges = [(start_date, end_date)]
+        for raw_range in raw_ranges:
+            parts.append("""
+                SELECT leads_date AS day, COUNT(*) AS leads_count, 0 AS orders_count, 0 AS total_sales
+                FROM leads
+                WHERE leads_date >= %s AND leads_date <= %s
+                GROUP BY leads_date
+            """)
+            parts.append("""
+                SELECT order_date AS day, 0 AS leads_count, COUNT(*) AS orders_count,
+                       SUM(sales_price) AS total_sales
+                FROM sales_orders
+                WHERE order_date >= %s AND order_date <= %s
+                GROUP BY order_date
+            """)
+            params.extend(raw_range)
+            params.extend(raw_range)
+
+        sql = (
+            "SELECT day, SUM(leads_count) AS leads_count, SUM(orders_count) AS orders_count, "
+            "SUM(total_sales) AS total_sales FROM ("
+            + " UNION ALL ".join(parts)
+            + ") AS t GROUP BY day"
+        )
+        with self.get_read_connection(start_date) as conn:
+            with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute(sql, params)
+                rows = cursor.fetchall()
+
+        leads_by_day = {}
+        orders_by_day = {}
+        for row in rows:
+            day = row['day'].strftime('%Y-%m-%d')
+            if row['leads_count']:
+                leads_by_day[day] = int(row['leads_count'])
+            if row['orders_count']:
+                orders_by_day[day] = {
+                    'orders_count': int(row['orders_count']),
+                    'total_sales': int(row['total_sales'] or 0),
+                }
+        return leads_by_day, orders_by_day
+
+    @DB_QUERY_SECONDS.time(method='refresh_rollups')
+    def refresh_rollups(self, start_date, end_date):
+        """
+        Rebuild the daily rollup rows for every day in a range, then the
+        monthly rows of every month those days fall in
+
+        Intended for closed days only. Re-running it for a day is safe and
+        picks up rows that arrived late or were back-dated.
+
+        Args:
+            start_date: First day to refresh (inclusive)
+            end_date: Last day to refresh (inclusive)
+
+        Returns:
+            int: Number of days refreshed
+        """
+        days = 0
+        months = set()
+        day = start_date
+        with self.get_connection() as conn:
+            with conn.cursor() as cursor:
+                while day <= end_date:
+                    conn.begin()
+                    try:
+                        cursor.execute("DELETE FROM daily_sales_stats WHERE day = %s", (day,))
+                        cursor.execute("""
+                            INSERT INTO daily_sales_stats (day, sales_id, leads_count, orders_count, total_sales)
+                            SELECT %s, sales, SUM(leads_count), SUM(orders_count), SUM(total_sales)
+                            FROM (
+                                SELECT sales_id AS sales, COUNT(*) AS leads_count, 0 AS orders_count, 0 AS total_sales
+                                FROM leads
+                                WHERE leads_date = %s
+                                GROUP BY sales_id
+                                UNION ALL
+                                SELECT sales_id AS sales, 0 AS leads_count, COUNT(*) AS orders_count, SUM(sales_price) AS total_sales
+                                FROM sales_orders
+                                WHERE order_date = %s
+                                GROUP BY sales_id
+                            ) AS t
+                            GROUP BY sales
+                        """, (day, day, day))
+                        cursor.execute("""
+                            INSERT INTO rollup_refresh_log (day) VALUES (%s)
+                            ON DUPLICATE KEY UPDATE refreshed_at = CURRENT_TIMESTAMP
+                        """, (day,))
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    months.add(day.replace(day=1))
+                    days += 1
+                    day += timedelta(days=1)
+
+                for month in sorted(months):
+                    conn.begin()
+                    try:
+                        cursor.execute("DELETE FROM monthly_sales_stats WHERE month = %s", (month,))
+                        cursor.execute("""
+                            INSERT INTO monthly_sales_stats (month, sales_id, leads_count, orders_count, total_sales)
+                            SELECT %s, sales_id, SUM(leads_count), SUM(orders_count), SUM(total_sales)
+                            FROM daily_sales_stats
+                            WHERE day >= %s AND day <= %s
+                            GROUP BY sales_id
+                        """, (month, month, _month_end(month)))
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+
+        self._rollup_coverage_at = 0.0
+        # A refresh only changes anything when rows arrived late
+        self.invalidate_cache(start_date, end_date)
+        return days
+
+    def claim_report_run(self, report, day):
+        """
+        Record that a scheduled report for a day is being sent
+
+        The claim lives in report_runs on the primary, so a leader that took
+        over from a crashed one can tell whether that day's report went out.
+
+        Args:
+            report: Report name, e.g. 'daily_report'
+            day: Day the report covers
+
+        Returns:
+            bool: True for the first claim of (report, day), False when it
+            was already claimed. Also True when report_runs does not exist
+            yet (migration 004 not applied): the report is sent without
+            the once-per-day guarantee rather than not at all.
+        """
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    claimed = cursor.execute(
+                        "INSERT IGNORE INTO report_runs (report, day) VALUES (%s, %s)", (report, day)
+                    )
+        except pymysql.err.ProgrammingError as e:
+            if not _is_missing_table(e):
+                raise
+            print(f"Warning: report_runs table is missing, run 'python migrate.py up'; "
+                  f"sending {report} for {day} without a claim")
+            return True
+        return claimed == 1
+
+    def release_report_run(self, report, day):
+        """Withdraw a claim whose report could not be sent, so it is tried again"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("DELETE FROM report_runs WHERE report = %s AND day = %s", (report, day))
+        except pymysql.err.ProgrammingError as e:
+            # Nothing was claimed without report_runs
+            if not _is_missing_table(e):
+                raise
@@ -0,0 +1,60 @@
+"""
+Per-query deadlines
+
+A report command runs inside ``deadline(seconds)``; everything it does on
+the database shares that budget. Pool waits are cut short, and each
+statement gets the remaining time as MySQL's MAX_EXECUTION_TIME, so the
+server itself abandons a SELECT that would overrun. The deadline lives in a
+context variable: it follows the command into asyncio tasks and, through
+``contextvars.copy_context``, into the concurrent-query threads.
+"""
+import contextvars
+import time
+from contextlib import contextmanager
+
+_deadline = contextvars.ContextVar('query_deadline', default=None)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Bound the database work done inside the block
+
+    Args:
+        seconds: Time allowed, or None for no bound. A nested block never
+            extends the deadline of the one around it.
+    """
+    if seconds is None:
+        yield
+        return
+    at = time.monotonic() + seconds
+    outer = _deadline.get()
+    token = _deadline.set(at if outer is None else min(at, outer))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """
+    Returns:
+        float: Seconds left before the current deadline (negative once it
+        has passed), or None outside a deadline
+    """
+    at = _deadline.get()
+    if at is None:
+        return None
+    return at - time.monotonic()
+
+
+def execution_time_ms():
+    """
+    Returns:
+        int: MAX_EXECUTION_TIME for the next statement in milliseconds (at
+        least 1), or 0 outside a deadline (no limit)
+    """
+    left = remaining()
+    if left is None:
+        return 0
+    return max(int(left * 1000), 1)
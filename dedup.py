@@ -0,0 +1,152 @@
+"""
+Callback deduplication module
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from config import DEDUP_MAX_ENTRIES, DEDUP_TTL, DEDUP_SHARED_DIR
+
+
+def message_key(msg):
+    """
+    Build the dedup key for a callback message
+
+    Messages carry a MsgId; events do not, so they are keyed by sender and
+    CreateTime, which WeChat Work keeps identical across re-deliveries.
+
+    Args:
+        msg: Message parsed by wechatpy
+
+    Returns:
+        str: Dedup key
+    """
+    msg_id = getattr(msg, 'id', None)
+    if msg_id:
+        return f"msg:{msg_id}"
+    return f"event:{msg.source}:{msg.create_time}"
+
+
+class MessageDeduplicator:
+    """
+    Bounded, time-expiring store of callback replies keyed by message
+
+    The first delivery of a message claims a Future and fills it with the
+    reply; re-deliveries get the same Future back, so they can wait for the
+    in-flight computation or reuse the rendered reply instead of querying
+    the database again.
+
+    Futures live in one process. WeChat Work may send a re-delivery to
+    another gunicorn worker, so in async reply mode, where each claim
+    leads to a pushed message, ``claim_shared`` also claims the message in
+    ``shared_dir`` for every worker of the host.
+    """
+
+    def __init__(self, max_entries=DEDUP_MAX_ENTRIES, ttl=DEDUP_TTL, shared_dir=DEDUP_SHARED_DIR):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared_dir = shared_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._swept_at = time.time()
+        self.duplicates = 0
+
+    def claim(self, key):
+        """
+        Look up or register a message
+
+        Args:
+            key: Key from ``message_key``
+
+        Returns:
+            tuple: (future, is_new). When is_new is True the caller must
+            complete the future with ``set_result`` or ``set_exception``.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.duplicates += 1
+                return entry['future'], False
+            future = Future()
+            future.set_running_or_notify_cancel()
+            self._entries[key] = {'future': future, 'created_at': now, 'pushed': False}
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return future, True
+
+    def request_push(self, key):
+        """
+        Mark that a message's reply should be pushed once it is ready
+
+        Used when a re-delivery gives up waiting, so that only one of the
+        retries arranges the push.
+
+        Returns:
+            bool: True for the first caller, False afterwards
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['pushed']:
+                return False
+            entry['pushed'] = True
+            return True
+
+    def claim_shared(self, key):
+        """
+        Claim a message for this process among the workers sharing ``shared_dir``
+
+        Args:
+            key: Key from ``message_key``
+
+        Returns:
+            bool: False when another worker (or this one) already claimed
+            it within ``ttl``; always True without a shared directory
+        """
+        if not self.shared_dir:
+            return True
+        os.makedirs(self.shared_dir, exist_ok=True)
+        self._sweep_shared()
+        path = os.path.join(self.shared_dir, hashlib.sha1(key.encode()).hexdigest())
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            return True
+        except FileExistsError:
+            with self._lock:
+                self.duplicates += 1
+            return False
+
+    def _sweep_shared(self):
+        """Remove claim files older than ``ttl``, at most once per ``ttl``"""
+        now = time.time()
+        with self._lock:
+            if now - self._swept_at < self.ttl:
+                return
+            self._swept_at = now
+        for entry in os.scandir(self.shared_dir):
+            try:
+                if now - entry.stat().st_mtime >= self.ttl:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                # Swept by another worker
+                pass
+
+    def _expire(self, now):
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry['created_at'] < self.ttl:
+                break
+            del self._entries[key]
+
+    def stats(self):
+        """
+        Get store size and how many re-deliveries were absorbed
+
+        Returns:
+            dict: Entry and duplicate counts
+        """
+        with self._lock:
+            return {'entries': len(self._entries), 'duplicates': self.duplicates}
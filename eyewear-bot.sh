@@ -2,6 +2,8 @@
 
 SERVICE=eyewear-bot
 LOGFILE=/opt/projects/logs/eyewear-bot.log
+APP_DIR=/opt/projects/eyewear-bot
+VENV=/opt/projects/venv
 
 function start_service() {
     echo "Starting $SERVICE..."
@@ -15,6 +17,17 @@ function restart_service() {
     sudo systemctl status $SERVICE --no-pager
 }
 
+function reload_service() {
+    # Gunicorn replaces its workers one by one; the scheduler lease moves to a new worker
+    echo "Reloading $SERVICE..."
+    sudo systemctl reload $SERVICE
+}
+
+function serve_foreground() {
+    # Run in the foreground with the production entry point (no systemd)
+    cd $APP_DIR && exec $VENV/bin/gunicorn -c gunicorn.conf.py app:app
+}
+
 function status_service() {
     sudo systemctl status $SERVICE --no-pager
 }
@@ -30,6 +43,12 @@ case "$1" in
     restart)
         restart_service
         ;;
+    reload)
+        reload_service
+        ;;
+    serve)
+        serve_foreground
+        ;;
     status)
         status_service
         ;;
@@ -37,7 +56,7 @@ case "$1" in
         log_service
         ;;
     *)
-        echo "Usage: $0 {start|restart|status|log}"
+        echo "Usage: $0 {start|restart|reload|status|log|serve}"
         exit 1
         ;;
 esac
\ No newline at end of file
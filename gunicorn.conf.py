@@ -0,0 +1,23 @@
+"""
+Gunicorn configuration for production serving
+
+    gunicorn -c gunicorn.conf.py app:app
+
+Each worker process imports app.py itself and starts its own scheduler;
+only the worker holding the scheduler lease runs the leader jobs (see
+lease.py). The app must not be preloaded: the scheduler's threads and the
+pooled connections would be created in the master and not survive the fork.
+"""
+from config import FLASK_PORT, GUNICORN_WORKERS, GUNICORN_THREADS
+
+bind = f"0.0.0.0:{FLASK_PORT}"
+workers = GUNICORN_WORKERS
+# Threads per worker; report queries spend their time waiting on MySQL and WeChat
+worker_class = 'gthread'
+threads = GUNICORN_THREADS
+preload_app = False
+# WeChat Work gives a callback 5 seconds; anything far past that is stuck
+timeout = 60
+graceful_timeout = 30
+accesslog = '-'
+errorlog = '-'
@@ -0,0 +1,155 @@
+"""
+Scheduler leader lease
+
+With several worker processes (gunicorn), only the process holding the
+lease runs the jobs that must happen once: the daily report, rollup and
+partition maintenance, the embedded replica sync. The others keep trying,
+so when the leader dies one of them takes over on its next attempt.
+
+- ``FileLease``: an exclusive ``flock`` on a local file; the kernel drops
+  it when the holding process exits, however it exits. One host only.
+- ``MySQLLease``: a ``GET_LOCK`` named lock held by a dedicated
+  connection; released by MySQL when that connection goes away, so it also
+  works across hosts.
+"""
+import fcntl
+import os
+import threading
+import pymysql
+from config import DB_CONFIG, SCHEDULER_LEASE, SCHEDULER_LOCK_FILE, SCHEDULER_LOCK_NAME
+
+
+class FileLease:
+    """Leadership held through an exclusive flock on ``path``"""
+
+    def __init__(self, path=SCHEDULER_LOCK_FILE):
+        self.path = path
+        self._fd = None
+        self._lock = threading.Lock()
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def acquire(self):
+        """
+        Try to take the lease without blocking
+
+        Returns:
+            bool: True if this process holds the lease
+        """
+        with self._lock:
+            if self._fd is not None:
+                return True
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            # Holder's PID, for whoever wonders which worker is the leader
+            os.ftruncate(fd, 0)
+            os.write(fd, f"{os.getpid()}\n".encode())
+            self._fd = fd
+            return True
+
+    def renew(self):
+        """A flock lasts as long as the descriptor; nothing can take it away"""
+        return self.held
+
+    def release(self):
+        with self._lock:
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+                os.close(self._fd)
+                self._fd = None
+
+
+class MySQLLease:
+    """Leadership held through a MySQL named lock on a dedicated connection"""
+
+    def __init__(self, name=SCHEDULER_LOCK_NAME, config=DB_CONFIG):
+        self.name = name
+        self.config = dict(config, autocommit=True)
+        self._conn = None
+        self._held = False
+        self._lock = threading.Lock()
+
+    @property
+    def held(self):
+        return self._held
+
+    def _scalar(self, sql):
+        with self._conn.cursor() as cursor:
+            cursor.execute(sql, (self.name,))
+            return cursor.fetchone()[0]
+
+    def _drop_connection(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+        self._held = False
+
+    def acquire(self):
+        """
+        Try to take the lease without blocking
+
+        Returns:
+            bool: True if this process holds the lease
+        """
+        with self._lock:
+            if self._held:
+                return True
+            try:
+                if self._conn is None:
+                    self._conn = pymysql.connect(**self.config)
+                self._held = self._scalar("SELECT GET_LOCK(%s, 0)") == 1
+            except Exception:
+                self._drop_connection()
+            return self._held
+
+    def renew(self):
+        """
+        Check the lock is still ours (the connection may have been dropped)
+
+        Returns:
+            bool: False once leadership is lost
+        """
+        with self._lock:
+            if not self._held:
+                return False
+            try:
+                self._held = self._scalar("SELECT IS_USED_LOCK(%s) = CONNECTION_ID()") == 1
+            except Exception:
+                self._drop_connection()
+            return self._held
+
+    def release(self):
+        with self._lock:
+            if self._held:
+                try:
+                    self._scalar("SELECT RELEASE_LOCK(%s)")
+                except Exception:
+                    pass
+            self._drop_connection()
+
+
+_default_lease = None
+_default_lease_lock = threading.Lock()
+
+
+def get_default_lease():
+    """Return the process-wide lease, or None when SCHEDULER_LEASE is 'none' (single process)"""
+    global _default_lease
+    if SCHEDULER_LEASE == 'none':
+        return None
+    with _default_lease_lock:
+        if _default_lease is None:
+            _default_lease = MySQLLease() if SCHEDULER_LEASE == 'mysql' else FileLease()
+        return _default_lease
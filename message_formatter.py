@@ -2,6 +2,7 @@
 Message formatter module
 """
 from datetime import datetime
+from metrics import FORMAT_SECONDS
 
 
 def format_stats_message(stats, title="数据统计报告"):
@@ -73,6 +74,7 @@ def format_stats_message(stats, title="数据统计报告"):
     return "\n".join(message_parts)
 
 
+@FORMAT_SECONDS.time(formatter='daily')
 def format_daily_report(stats):
     """
     Format daily report message
@@ -86,6 +88,7 @@ def format_daily_report(stats):
     return format_stats_message(stats, "每日数据报告 - 前一日")
 
 
+@FORMAT_SECONDS.time(formatter='today')
 def format_today_report(stats):
     """
     Format today's report message
@@ -99,6 +102,41 @@ def format_today_report(stats):
     return format_stats_message(stats, "今日数据报告")
 
 
+def format_data_age_note(age_seconds):
+    """
+    Format a note telling how old the figures in a report are
+    
+    Args:
+        age_seconds: Seconds since the data was last refreshed
+        
+    Returns:
+        str: Note to append to a report
+    """
+    return f"⏱ 数据更新于 {int(age_seconds)} 秒前"
+
+
+def format_stale_note(age_seconds):
+    """
+    Format the warning on a last known good report, served because the
+    database could not be queried
+
+    Args:
+        age_seconds: Seconds since the report was computed
+
+    Returns:
+        str: Note to append to a report
+    """
+    age_seconds = int(age_seconds)
+    if age_seconds < 60:
+        age = f"{age_seconds} 秒"
+    elif age_seconds < 3600:
+        age = f"{age_seconds // 60} 分钟"
+    else:
+        age = f"{age_seconds // 3600} 小时 {age_seconds % 3600 // 60} 分钟"
+    return f"⚠️ 数据库暂时无法查询，以上为 {age}前的数据"
+
+
+@FORMAT_SECONDS.time(formatter='recent_days')
 def format_recent_days_report(stats, days):
     """
     Format recent days report message
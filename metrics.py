@@ -0,0 +1,302 @@
+"""
+In-process metrics registry, exported in the Prometheus text format
+
+Histograms and counters are updated on the request path, so each labelled
+series keeps its own small lock and an observation is a bisect plus a few
+additions. Figures that other components already track (pool usage, cache
+hit counters, queue depth) are read through collector callbacks only when
+/metrics is scraped.
+
+Every worker process keeps its own figures and a scrape through the load
+balancer reaches one of them, so with METRICS_PID_LABEL each series carries
+the worker's ``pid`` and Prometheus keeps the workers' series apart.
+"""
+import bisect
+import functools
+import os
+import threading
+import time
+from config import METRICS_ENABLED, METRICS_PID_LABEL
+
+# Seconds; covers a cache hit (sub-millisecond) up to a DB_QUERY_TIMEOUT stall
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base class: a named family of series keyed by label values"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _new_series(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **kwargs):
+        """
+        Get the series for a set of label values
+
+        Args:
+            values / kwargs: One value per label name, positionally or by name
+
+        Returns:
+            The series, created on first use
+        """
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(v) for v in values)
+        series = self._series.get(key)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(key, self._new_series())
+        return series
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._series.items())
+
+
+class _CounterSeries:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """Monotonic count, e.g. errors by where they happened"""
+
+    kind = 'counter'
+
+    def _new_series(self):
+        return _CounterSeries()
+
+    def inc(self, amount=1, **labels):
+        """Add to the series for ``labels``"""
+        self.labels(**labels).inc(amount)
+
+    def render(self, extra=()):
+        for key, series in self._items():
+            yield f"{self.name}_total{_format_labels(self.labelnames, key, extra)} {_format_value(series.value)}"
+
+
+class _HistogramSeries:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        if not METRICS_ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class _Timer:
+    """Context manager / decorator observing elapsed seconds into a series"""
+
+    def __init__(self, series):
+        self.series = series
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.series.observe(time.perf_counter() - self.started)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.series.observe(time.perf_counter() - started)
+        return wrapper
+
+
+class Histogram(_Metric):
+    """Latency distribution in seconds with fixed buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_series(self):
+        return _HistogramSeries(self.buckets)
+
+    def observe(self, value, **labels):
+        """Record one value in the series for ``labels``"""
+        self.labels(**labels).observe(value)
+
+    def time(self, **labels):
+        """
+        Time a block or function
+
+        Usage:
+            with DB_QUERY_SECONDS.time(method='get_combined_stats'):
+                ...
+
+            @WECHAT_SEND_SECONDS.time(channel='webhook')
+            def send(...):
+                ...
+        """
+        return _Timer(self.labels(**labels))
+
+    def render(self, extra=()):
+        for key, series in self._items():
+            counts, total = series.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [*extra, ('le', _format_value(float(bound)))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key, extra)
+            yield f"{self.name}_sum{labels} {_format_value(round(total, 6))}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry:
+    """Holds the metric families and collector callbacks of the process"""
+
+    def __init__(self, pid_label=False):
+        """
+        Args:
+            pid_label: Add the process ID as a ``pid`` label to every series
+        """
+        self.pid_label = pid_label
+        self._metrics = {}
+        # Collector callbacks by key
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collect, key=None):
+        """
+        Add a callback read at scrape time
+
+        Args:
+            collect: Callable returning an iterable of
+                (name, kind, documentation, [(labels dict, value), ...]),
+                kind being 'gauge' or 'counter'
+            key: Collectors registered under the same key replace each
+                other, e.g. the components of the most recently built app;
+                defaults to the callable itself
+        """
+        with self._lock:
+            self._collectors[collect if key is None else key] = collect
+
+    def unregister_collector(self, collect):
+        """Remove a collector, whatever key it was registered under"""
+        with self._lock:
+            for key, registered in list(self._collectors.items()):
+                if registered == collect:
+                    del self._collectors[key]
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format
+
+        Returns:
+            str: Exposition text (version 0.0.4)
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+            collectors = list(self._collectors.values())
+        extra = [('pid', os.getpid())] if self.pid_label else []
+        lines = []
+        for metric in metrics:
+            # Counters are exposed as <name>_total, and so is their family (as prometheus_client does)
+            family = metric.name + '_total' if metric.kind == 'counter' else metric.name
+            lines.append(f"# HELP {family} {metric.documentation}")
+            lines.append(f"# TYPE {family} {metric.kind}")
+            lines.extend(metric.render(extra))
+        for collect in collectors:
+            try:
+                families = list(collect())
+            except Exception as e:
+                lines.append(f"# collector {getattr(collect, '__name__', collect)} failed: {str(e)}")
+                continue
+            for name, kind, documentation, samples in families:
+                family = name + '_total' if kind == 'counter' else name
+                lines.append(f"# HELP {family} {documentation}")
+                lines.append(f"# TYPE {family} {kind}")
+                for labels, value in samples:
+                    label_text = _format_labels(list(labels), list(labels.values()), extra)
+                    lines.append(f"{family}{label_text} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry(pid_label=METRICS_PID_LABEL)
+
+CALLBACK_DECRYPT_SECONDS = REGISTRY.histogram(
+    'eyewear_callback_decrypt_seconds', 'Time to verify and decrypt a WeChat Work callback')
+REPLY_ENCRYPT_SECONDS = REGISTRY.histogram(
+    'eyewear_reply_encrypt_seconds', 'Time to render and encrypt a passive reply')
+QUERY_SECONDS = REGISTRY.histogram(
+    'eyewear_query_seconds', 'QueryHandler.process_query time by command branch', ['command'])
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'eyewear_db_query_seconds', 'Database method time, including cache hits', ['method'])
+FORMAT_SECONDS = REGISTRY.histogram(
+    'eyewear_format_seconds', 'Report formatting time', ['formatter'])
+WECHAT_SEND_SECONDS = REGISTRY.histogram(
+    'eyewear_wechat_send_seconds', 'Outbound WeChat send time, including retries', ['channel'])
+DB_READS = REGISTRY.counter(
+    'eyewear_db_reads', 'Report connections by where they were served', ['target'])
+SLOW_QUERIES = REGISTRY.counter(
+    'eyewear_slow_queries', 'Statements slower than SLOW_QUERY_MS')
+ERRORS = REGISTRY.counter(
+    'eyewear_errors', 'Errors by where they were caught', ['where'])
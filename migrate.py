@@ -0,0 +1,405 @@
+"""
+Versioned schema migrations, partition maintenance and EXPLAIN checks
+
+Usage:
+    python migrate.py status                   # applied / pending migrations
+    python migrate.py up                       # apply pending migrations in order
+    python migrate.py baseline                 # mark all as applied (database created from schema.sql)
+    python migrate.py partitions               # add monthly partitions ahead of time
+    python migrate.py partitions --copy-rows   # ... even when p_future already holds rows
+    python migrate.py duplicates               # leads_id values stored under more than one date
+    python migrate.py explain --save plans.json
+    python migrate.py explain --compare plans.json
+
+Migrations live in ``migrations/`` as ``NNN_description.sql`` or
+``NNN_description.py`` and run in file name order. A ``.py`` migration
+defines ``upgrade(cursor)`` and may use the helpers in this module. MySQL
+commits DDL implicitly, so each migration is recorded in
+``schema_migrations`` as soon as it succeeds and a failed run stops at the
+failing migration; fix it and run ``up`` again.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+import pymysql
+from config import DB_CONFIG, PARTITION_MONTHS_AHEAD
+from database import Database, ConnectionPool, COMBINED_STATS_SQL, LEADS_BY_DAY_SQL, ORDERS_BY_DAY_SQL
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# Tables partitioned by month, with their partitioning column
+PARTITIONED_TABLES = {
+    'leads': 'leads_date',
+    'sales_orders': 'order_date',
+}
+
+# Report statements checked by `explain`, with the number of (start, end) pairs they take
+EXPLAIN_QUERIES = {
+    'combined_stats': (COMBINED_STATS_SQL, 2),
+    'leads_by_day': (LEADS_BY_DAY_SQL, 1),
+    'orders_by_day': (ORDERS_BY_DAY_SQL, 1),
+}
+
+# EXPLAIN columns kept in saved plans
+EXPLAIN_FIELDS = ('table', 'partitions', 'type', 'key', 'rows', 'Extra')
+
+
+def list_migrations():
+    """
+    Find migration files
+
+    Returns:
+        list: (version, path) tuples sorted by version, where version is the
+        file name without extension
+    """
+    if not os.path.isdir(MIGRATIONS_DIR):
+        return []
+    migrations = []
+    for name in sorted(os.listdir(MIGRATIONS_DIR)):
+        version, ext = os.path.splitext(name)
+        if ext in ('.sql', '.py') and version[:1].isdigit():
+            migrations.append((version, os.path.join(MIGRATIONS_DIR, name)))
+    return migrations
+
+
+def split_sql(text):
+    """
+    Split a SQL script into statements
+
+    Statements end with ``;`` at the end of a line; ``--`` comment lines are
+    dropped. Triggers and procedures need a ``.py`` migration instead.
+    """
+    statements = []
+    current = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith('--'):
+            continue
+        current.append(line)
+        if stripped.endswith(';'):
+            statements.append('\n'.join(current).rstrip().rstrip(';'))
+            current = []
+    if current:
+        statements.append('\n'.join(current))
+    return statements
+
+
+def ensure_migrations_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version VARCHAR(100) PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+
+
+def applied_versions(cursor):
+    ensure_migrations_table(cursor)
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def run_migration(cursor, path):
+    """Run one migration file"""
+    if path.endswith('.sql'):
+        with open(path, encoding='utf-8') as f:
+            for statement in split_sql(f.read()):
+                cursor.execute(statement)
+        return
+    spec = importlib.util.spec_from_file_location(os.path.basename(path)[:-3], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.upgrade(cursor)
+
+
+def index_exists(cursor, table, index):
+    """Whether ``table`` has an index named ``index``"""
+    cursor.execute("""
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+        LIMIT 1
+    """, (table, index))
+    return cursor.fetchone() is not None
+
+
+def table_exists(cursor, table):
+    """Whether ``table`` exists in the current database"""
+    cursor.execute("""
+        SELECT 1 FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+    """, (table,))
+    return cursor.fetchone() is not None
+
+
+def column_exists(cursor, table, column):
+    """Whether ``table`` has a column named ``column``"""
+    cursor.execute("""
+        SELECT 1 FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+    """, (table, column))
+    return cursor.fetchone() is not None
+
+
+def foreign_keys(cursor, table):
+    """Names of the foreign keys defined on ``table``"""
+    cursor.execute("""
+        SELECT CONSTRAINT_NAME FROM information_schema.TABLE_CONSTRAINTS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND CONSTRAINT_TYPE = 'FOREIGN KEY'
+    """, (table,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _partitions(cursor, table):
+    """(name, upper bound) of each partition in order; empty when not partitioned"""
+    cursor.execute("""
+        SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """, (table,))
+    return [(row[0], row[1]) for row in cursor.fetchall()]
+
+
+def is_partitioned(cursor, table):
+    """Whether ``table`` is partitioned"""
+    return bool(_partitions(cursor, table))
+
+
+def _next_month(day):
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def month_partitions(first_month, last_month):
+    """
+    Partition definitions for every month from ``first_month`` through
+    ``last_month``, followed by the catch-all ``p_future``
+
+    Returns:
+        str: Comma-separated ``PARTITION ...`` clauses
+    """
+    clauses = []
+    month = first_month.replace(day=1)
+    while month <= last_month:
+        upper = _next_month(month)
+        clauses.append(f"PARTITION p{month.strftime('%Y%m')} VALUES LESS THAN ('{upper.isoformat()}')")
+        month = upper
+    clauses.append("PARTITION p_future VALUES LESS THAN (MAXVALUE)")
+    return ', '.join(clauses)
+
+
+def ensure_future_partitions(cursor, table, months_ahead=PARTITION_MONTHS_AHEAD, copy_rows=False):
+    """
+    Split monthly partitions out of ``p_future`` up to ``months_ahead``
+    months after the current one
+
+    Does nothing for tables that are not partitioned. Splitting an empty
+    ``p_future`` moves no rows; one that already holds rows (a database
+    created from schema.sql and loaded before the first run) would be
+    copied row by row under a table lock, so it is skipped with a warning
+    unless ``copy_rows`` is set.
+
+    Args:
+        cursor: Cursor on the database
+        table: Table from PARTITIONED_TABLES
+        months_ahead: Months after the current one to cover
+        copy_rows: Split ``p_future`` even when it holds rows
+
+    Returns:
+        int: Number of partitions added
+    """
+    partitions = _partitions(cursor, table)
+    if not partitions or partitions[-1][0] != 'p_future':
+        return 0
+    bounds = [desc.strip("'") for _, desc in partitions[:-1] if desc and desc != 'MAXVALUE']
+    if not bounds:
+        return 0
+    first_month = datetime.strptime(bounds[-1], '%Y-%m-%d').date()
+    last_month = datetime.now().date().replace(day=1)
+    for _ in range(months_ahead):
+        last_month = _next_month(last_month)
+    if first_month > last_month:
+        return 0
+    if not copy_rows:
+        cursor.execute(f"SELECT 1 FROM {table} PARTITION (p_future) LIMIT 1")
+        if cursor.fetchone() is not None:
+            logging.warning(f"{table} 的 p_future 分区已有数据，拆分会复制这些行并锁表，已跳过；"
+                            f"请在低峰期执行 python migrate.py partitions --copy-rows")
+            return 0
+    clauses = month_partitions(first_month, last_month)
+    cursor.execute(f"ALTER TABLE {table} REORGANIZE PARTITION p_future INTO ({clauses})")
+    return clauses.count('PARTITION') - 1
+
+
+def duplicate_lead_ids(cursor, limit=100):
+    """
+    Lead IDs stored under more than one leads_date
+
+    The partitioned primary key (leads_id, leads_date) no longer makes
+    leads_id unique on its own, so a lead re-inserted under a new date
+    is counted twice.
+
+    Returns:
+        list: (leads_id, rows, first date, last date), at most ``limit``
+    """
+    cursor.execute("""
+        SELECT leads_id, COUNT(*), MIN(leads_date), MAX(leads_date) FROM leads
+        GROUP BY leads_id HAVING COUNT(*) > 1
+        ORDER BY leads_id LIMIT %s
+    """, (limit,))
+    return [tuple(row) for row in cursor.fetchall()]
+
+
+def explain_plans(cursor, start_date, end_date, sales_column='sales'):
+    """
+    EXPLAIN the report statements for a date range
+
+    Returns:
+        dict: Query name -> list of plan rows limited to ``EXPLAIN_FIELDS``
+    """
+    plans = {}
+    for name, (sql, pairs) in EXPLAIN_QUERIES.items():
+        cursor.execute("EXPLAIN " + sql.replace('{sales}', sales_column), (start_date, end_date) * pairs)
+        plans[name] = [{field: row.get(field) for field in EXPLAIN_FIELDS} for row in cursor.fetchall()]
+    return plans
+
+
+def compare_plans(before, after):
+    """
+    Describe how each query's plan changed
+
+    Returns:
+        list: Report lines, one per changed field plus a line per query
+    """
+    lines = []
+    for name in EXPLAIN_QUERIES:
+        old_rows = before.get(name, [])
+        new_rows = after.get(name, [])
+        changes = []
+        for i in range(max(len(old_rows), len(new_rows))):
+            old = old_rows[i] if i < len(old_rows) else {}
+            new = new_rows[i] if i < len(new_rows) else {}
+            label = new.get('table') or old.get('table') or f'#{i + 1}'
+            for field in EXPLAIN_FIELDS[1:]:
+                if old.get(field) != new.get(field):
+                    changes.append(f"    {label}.{field}: {old.get(field)} -> {new.get(field)}")
+        old_rows_read = sum(int(row.get('rows') or 0) for row in old_rows)
+        new_rows_read = sum(int(row.get('rows') or 0) for row in new_rows)
+        lines.append(f"{name}: 估算扫描行数 {old_rows_read} -> {new_rows_read}" + ("" if changes else "（执行计划无变化）"))
+        lines.extend(changes)
+    return lines
+
+
+def cmd_status(db, args):
+    with db.get_connection() as conn:
+        with conn.cursor() as cursor:
+            applied = applied_versions(cursor)
+    for version, _ in list_migrations():
+        print(f"{'✓' if version in applied else ' '} {version}")
+
+
+def cmd_up(db, args):
+    with db.get_connection() as conn:
+        with conn.cursor() as cursor:
+            applied = applied_versions(cursor)
+            pending = [(v, p) for v, p in list_migrations() if v not in applied]
+            if not pending:
+                print("No pending migrations")
+            for version, path in pending:
+                print(f"Applying {version} ...")
+                run_migration(cursor, path)
+                cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (version,))
+                print(f"✓ {version}")
+
+
+def cmd_baseline(db, args):
+    with db.get_connection() as conn:
+        with conn.cursor() as cursor:
+            applied = applied_versions(cursor)
+            for version, _ in list_migrations():
+                if version not in applied:
+                    cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (version,))
+                    print(f"✓ {version} (marked as applied)")
+
+
+def cmd_partitions(db, args):
+    with db.get_connection() as conn:
+        with conn.cursor() as cursor:
+            for table in PARTITIONED_TABLES:
+                added = ensure_future_partitions(cursor, table, args.months_ahead, args.copy_rows)
+                print(f"{table}: {added} partition(s) added")
+
+
+def cmd_duplicates(db, args):
+    with db.get_connection() as conn:
+        with conn.cursor() as cursor:
+            duplicates = duplicate_lead_ids(cursor, args.limit)
+    if not duplicates:
+        print("No duplicate leads_id")
+    for leads_id, rows, first_date, last_date in duplicates:
+        print(f"{leads_id}: {rows} rows, {first_date} ~ {last_date}")
+
+
+def cmd_explain(db, args):
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            saved = json.load(f)
+        start_date, end_date = saved['start_date'], saved['end_date']
+    else:
+        end_date = args.end or datetime.now().date().isoformat()
+        start_date = args.start or (datetime.fromisoformat(end_date) - timedelta(days=29)).date().isoformat()
+
+    with db.get_connection() as conn:
+        with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            plans = explain_plans(cursor, start_date, end_date, db.sales_column)
+
+    if args.compare:
+        print(f"EXPLAIN {start_date} ~ {end_date}（{args.compare} -> 当前）")
+        for line in compare_plans(saved['plans'], plans):
+            print(line)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'start_date': start_date, 'end_date': end_date, 'plans': plans},
+                      f, ensure_ascii=False, indent=2, default=str)
+        print(f"Plans saved to {args.save}")
+    if not args.compare and not args.save:
+        print(json.dumps(plans, ensure_ascii=False, indent=2, default=str))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Schema migrations for the eyewear bot')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('status', help='List applied and pending migrations')
+    sub.add_parser('up', help='Apply pending migrations')
+    sub.add_parser('baseline', help='Mark every migration as applied')
+    partitions = sub.add_parser('partitions', help='Add monthly partitions ahead of time')
+    partitions.add_argument('--months-ahead', type=int, default=PARTITION_MONTHS_AHEAD)
+    partitions.add_argument('--copy-rows', action='store_true',
+                            help='Split p_future even when it already holds rows (locks the table while they are copied)')
+    duplicates = sub.add_parser('duplicates', help='List leads_id values stored under more than one date')
+    duplicates.add_argument('--limit', type=int, default=100)
+    explain = sub.add_parser('explain', help='Show, save or compare EXPLAIN plans of the report queries')
+    explain.add_argument('--start', help='Range start (YYYY-MM-DD), default 30 days before --end')
+    explain.add_argument('--end', help='Range end (YYYY-MM-DD), default today')
+    explain.add_argument('--save', help='Write the plans to this JSON file')
+    explain.add_argument('--compare', help='Compare with plans saved earlier (reuses their date range)')
+    args = parser.parse_args(argv)
+
+    commands = {
+        'status': cmd_status,
+        'up': cmd_up,
+        'baseline': cmd_baseline,
+        'partitions': cmd_partitions,
+        'duplicates': cmd_duplicates,
+        'explain': cmd_explain,
+    }
+    # Schema changes can run far longer than DB_READ_TIMEOUT allows a report
+    pool = ConnectionPool(dict(DB_CONFIG, read_timeout=None, write_timeout=None), size=1)
+    commands[args.command](Database(pool=pool), args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
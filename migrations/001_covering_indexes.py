@@ -0,0 +1,26 @@
+"""
+Composite covering indexes for the report aggregations
+
+The reports filter on the date column, group on sales and sum sales_price.
+With single-column indexes MySQL has to read the base row of every order
+in range; (order_date, sales, sales_price) and (leads_date, sales) answer
+those queries from the index alone. The single-column date indexes become
+prefixes of the new ones and are dropped. Also adds leads.created_at, used
+by the today counters, on databases created before it was in schema.sql.
+"""
+from migrate import index_exists
+
+
+def upgrade(cursor):
+    if not index_exists(cursor, 'sales_orders', 'idx_order_date_sales_price'):
+        cursor.execute("ALTER TABLE sales_orders ADD INDEX idx_order_date_sales_price (order_date, sales, sales_price)")
+    if index_exists(cursor, 'sales_orders', 'idx_order_date'):
+        cursor.execute("ALTER TABLE sales_orders DROP INDEX idx_order_date")
+
+    if not index_exists(cursor, 'leads', 'idx_leads_date_sales'):
+        cursor.execute("ALTER TABLE leads ADD INDEX idx_leads_date_sales (leads_date, sales)")
+    if index_exists(cursor, 'leads', 'idx_leads_date'):
+        cursor.execute("ALTER TABLE leads DROP INDEX idx_leads_date")
+
+    if not index_exists(cursor, 'leads', 'idx_created_at'):
+        cursor.execute("ALTER TABLE leads ADD INDEX idx_created_at (created_at)")
@@ -0,0 +1,48 @@
+"""
+RANGE partitioning by month on leads and sales_orders
+
+Month and recent-days reports then only open the partitions of the months
+they touch. MySQL requires the partitioning column in every unique key and
+does not allow foreign keys on partitioned InnoDB tables, so the primary
+keys become (leads_id, leads_date) / (order_id, order_date) and the
+sales_orders -> leads foreign key is dropped (idx_leads_id stays). From
+then on leads_id alone is not unique: check with ``migrate.py duplicates``.
+
+Each table is rebuilt once; run it in a quiet period. Partitions cover the
+first month with data through PARTITION_MONTHS_AHEAD months from now, with
+p_start / p_future catching anything outside.
+"""
+from datetime import datetime
+from config import PARTITION_MONTHS_AHEAD
+from migrate import PARTITIONED_TABLES, foreign_keys, is_partitioned, month_partitions, _next_month
+
+
+def upgrade(cursor):
+    for name in foreign_keys(cursor, 'sales_orders'):
+        cursor.execute(f"ALTER TABLE sales_orders DROP FOREIGN KEY `{name}`")
+
+    primary_keys = {
+        'leads': '(leads_id, leads_date)',
+        'sales_orders': '(order_id, order_date)',
+    }
+    last_month = datetime.now().date().replace(day=1)
+    for _ in range(PARTITION_MONTHS_AHEAD):
+        last_month = _next_month(last_month)
+
+    for table, column in PARTITIONED_TABLES.items():
+        if is_partitioned(cursor, table):
+            continue
+        cursor.execute(f"SELECT MIN({column}) FROM {table}")
+        first_day = cursor.fetchone()[0] or datetime.now().date()
+        first_month = first_day.replace(day=1)
+        cursor.execute(f"""
+            ALTER TABLE {table}
+            DROP PRIMARY KEY, ADD PRIMARY KEY {primary_keys[table]}
+        """)
+        cursor.execute(f"""
+            ALTER TABLE {table}
+            PARTITION BY RANGE COLUMNS({column}) (
+                PARTITION p_start VALUES LESS THAN ('{first_month.isoformat()}'),
+                {month_partitions(first_month, last_month)}
+            )
+        """)
@@ -0,0 +1,134 @@
+"""
+Integer sales person dimension
+
+Reports grouped and indexed on the VARCHAR(100) ``sales`` name, so every
+index carried the utf8mb4 string and GROUP BY compared strings. This adds:
+
+- ``sales_people`` (sales_id -> current display name)
+- ``sales_aliases`` (every name a sales person has been written under ->
+  sales_id), so a renamed sales person keeps one history
+- ``sales_id`` on leads and sales_orders, filled from ``sales`` by
+  BEFORE INSERT / UPDATE triggers, so the systems writing the fact tables
+  do not change
+- covering indexes on sales_id in place of the ones on sales
+- rollup tables keyed by sales_id; they are emptied and must be
+  backfilled again (see README)
+
+Set SALES_DIMENSION_ENABLED=true once this has run. Creating the triggers
+needs the TRIGGER privilege (and log_bin_trust_function_creators=1 when
+binary logging is on). The backfill UPDATE touches every row; run it in a
+quiet period.
+"""
+from migrate import column_exists, index_exists, table_exists
+
+RESOLVE_PROCEDURE = """
+    CREATE PROCEDURE resolve_sales_id(IN p_name VARCHAR(100), OUT p_sales_id INT)
+    BEGIN
+        SET p_sales_id = NULL;
+        SELECT sales_id INTO p_sales_id FROM sales_aliases WHERE alias = p_name;
+        IF p_sales_id IS NULL THEN
+            INSERT INTO sales_people (name) VALUES (p_name)
+                ON DUPLICATE KEY UPDATE sales_id = LAST_INSERT_ID(sales_id);
+            SET p_sales_id = LAST_INSERT_ID();
+            INSERT IGNORE INTO sales_aliases (alias, sales_id) VALUES (p_name, p_sales_id);
+        END IF;
+    END
+"""
+
+INSERT_TRIGGER = """
+    CREATE TRIGGER {table}_sales_id_insert BEFORE INSERT ON {table}
+    FOR EACH ROW
+    BEGIN
+        DECLARE v_sales_id INT;
+        IF NEW.sales_id = 0 THEN
+            CALL resolve_sales_id(NEW.sales, v_sales_id);
+            SET NEW.sales_id = v_sales_id;
+        END IF;
+    END
+"""
+
+UPDATE_TRIGGER = """
+    CREATE TRIGGER {table}_sales_id_update BEFORE UPDATE ON {table}
+    FOR EACH ROW
+    BEGIN
+        DECLARE v_sales_id INT;
+        IF NEW.sales <> OLD.sales AND NEW.sales_id = OLD.sales_id THEN
+            CALL resolve_sales_id(NEW.sales, v_sales_id);
+            SET NEW.sales_id = v_sales_id;
+        END IF;
+    END
+"""
+
+# table -> (old covering index, new covering index, its columns)
+COVERING_INDEXES = {
+    'leads': ('idx_leads_date_sales', 'idx_leads_date_sales_id', '(leads_date, sales_id)'),
+    'sales_orders': ('idx_order_date_sales_price', 'idx_order_date_sales_id_price',
+                     '(order_date, sales_id, sales_price)'),
+}
+
+
+def upgrade(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sales_people (
+            sales_id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uk_name (name)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sales_aliases (
+            alias VARCHAR(100) PRIMARY KEY,
+            sales_id INT NOT NULL,
+            INDEX idx_sales_id (sales_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+    cursor.execute("""
+        INSERT IGNORE INTO sales_people (name)
+        SELECT sales FROM leads UNION SELECT sales FROM sales_orders
+    """)
+    cursor.execute("INSERT IGNORE INTO sales_aliases (alias, sales_id) SELECT name, sales_id FROM sales_people")
+
+    # Triggers go in before the backfill so rows inserted meanwhile get an ID too
+    for table in ('leads', 'sales_orders'):
+        if not column_exists(cursor, table, 'sales_id'):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN sales_id INT NOT NULL DEFAULT 0 AFTER sales")
+    cursor.execute("DROP PROCEDURE IF EXISTS resolve_sales_id")
+    cursor.execute(RESOLVE_PROCEDURE)
+    for table in ('leads', 'sales_orders'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {table}_sales_id_insert")
+        cursor.execute(INSERT_TRIGGER.format(table=table))
+        cursor.execute(f"DROP TRIGGER IF EXISTS {table}_sales_id_update")
+        cursor.execute(UPDATE_TRIGGER.format(table=table))
+        cursor.execute(f"""
+            UPDATE {table} t JOIN sales_aliases a ON a.alias = t.sales
+            SET t.sales_id = a.sales_id
+            WHERE t.sales_id = 0
+        """)
+
+    for table, (old_index, new_index, columns) in COVERING_INDEXES.items():
+        changes = []
+        if not index_exists(cursor, table, new_index):
+            changes.append(f"ADD INDEX {new_index} {columns}")
+        if not index_exists(cursor, table, 'idx_sales_id'):
+            changes.append("ADD INDEX idx_sales_id (sales_id)")
+        for index in (old_index, 'idx_sales'):
+            if index_exists(cursor, table, index):
+                changes.append(f"DROP INDEX {index}")
+        if changes:
+            cursor.execute(f"ALTER TABLE {table} " + ", ".join(changes))
+
+    # Rollup rows are rebuilt from the fact tables, keyed by sales_id
+    if table_exists(cursor, 'rollup_refresh_log'):
+        cursor.execute("TRUNCATE TABLE rollup_refresh_log")
+    for table, key in (('daily_sales_stats', 'day'), ('monthly_sales_stats', 'month')):
+        if not column_exists(cursor, table, 'sales'):
+            continue
+        cursor.execute(f"TRUNCATE TABLE {table}")
+        cursor.execute(f"""
+            ALTER TABLE {table}
+            DROP PRIMARY KEY,
+            DROP COLUMN sales,
+            ADD COLUMN sales_id INT NOT NULL AFTER {key},
+            ADD PRIMARY KEY ({key}, sales_id)
+        """)
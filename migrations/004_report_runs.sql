@@ -0,0 +1,8 @@
+-- Scheduled reports already sent, so a new scheduler leader can send one
+-- the previous leader missed (see daily_report_job in scheduler.py)
+CREATE TABLE IF NOT EXISTS `report_runs` (
+  `report` VARCHAR(50) NOT NULL,
+  `day` DATE NOT NULL,
+  `sent_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`report`, `day`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
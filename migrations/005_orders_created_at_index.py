@@ -0,0 +1,14 @@
+"""
+Index sales_orders.created_at for the today counters
+
+The counters used to poll orders by order_id, which misses an order whose
+transaction commits after one with a higher ID. They now re-read orders
+from a little before the last seen created_at, like leads, and need this
+index to do that without scanning the table.
+"""
+from migrate import index_exists
+
+
+def upgrade(cursor):
+    if not index_exists(cursor, 'sales_orders', 'idx_created_at'):
+        cursor.execute("ALTER TABLE sales_orders ADD INDEX idx_created_at (created_at)")
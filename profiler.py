@@ -0,0 +1,102 @@
+"""
+On-demand sampling profiler
+
+Nothing runs until a profile is requested: the requesting thread then reads
+every other thread's stack with ``sys._current_frames()`` at a fixed
+interval for a bounded time and returns the samples as collapsed stacks
+(``thread;outer (file.py:12);inner (file.py:34) <count>``), the input format
+of flamegraph.pl, speedscope and inferno.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from config import DEBUG_PROFILE_INTERVAL
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profile is requested while another one is running"""
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def collapse_stack(frame, thread_name):
+    """
+    Render one stack as a collapsed-stack key, outermost frame first
+
+    Args:
+        frame: Innermost frame of the thread
+        thread_name: Name used as the root frame
+
+    Returns:
+        str: Semicolon-separated frames
+    """
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name)
+    return ';'.join(reversed(labels))
+
+
+class SamplingProfiler:
+    """Samples the stacks of the process's threads; one profile at a time"""
+
+    def __init__(self, interval=DEBUG_PROFILE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    def profile(self, seconds, interval=None):
+        """
+        Sample every other thread for ``seconds``
+
+        Args:
+            seconds: How long to sample
+            interval: Seconds between samples, defaults to the profiler's
+
+        Returns:
+            tuple: (Counter of collapsed stack -> samples, number of sampling rounds)
+
+        Raises:
+            ProfilerBusyError: If a profile is already running
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError("已有性能分析正在运行")
+        try:
+            interval = self.interval if interval is None else interval
+            own = threading.get_ident()
+            stacks = Counter()
+            rounds = 0
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident != own:
+                        stacks[collapse_stack(frame, names.get(ident, str(ident)))] += 1
+                rounds += 1
+                time.sleep(interval)
+            return stacks, rounds
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def render(stacks):
+        """Collapsed-stack text, most frequent stacks first"""
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+_default_profiler = None
+_default_profiler_lock = threading.Lock()
+
+
+def get_default_profiler():
+    """Return the process-wide profiler"""
+    global _default_profiler
+    with _default_profiler_lock:
+        if _default_profiler is None:
+            _default_profiler = SamplingProfiler()
+        return _default_profiler
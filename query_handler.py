@@ -3,24 +3,154 @@ Query handler module for processing user queries
 """
 import re
 import logging
+import pymysql
 from datetime import datetime, timedelta
-from database import Database
+from config import QUERY_DEADLINES
+from database import Database, DB_FAILURES, PoolTimeoutError, QueryTimeoutError
+from circuit_breaker import CircuitOpenError
+from deadlines import deadline
 from wechat_bot import WeChatBot
-from message_formatter import format_today_report, format_recent_days_report
+from singleflight import SingleFlight, FollowerTimeoutError
+from message_formatter import (
+    format_today_report,
+    format_recent_days_report,
+    format_data_age_note,
+    format_stale_note,
+)
+from today_counters import get_default_today_counters
+from snapshots import get_default_snapshot_store, get_default_last_good_store
+from metrics import QUERY_SECONDS, ERRORS
+
+# MySQL error raised when a statement exceeds MAX_EXECUTION_TIME
+ER_QUERY_TIMEOUT = 3024
+
+
+def parse_query(query_text):
+    """
+    Work out which report a query asks for
+
+    Args:
+        query_text: Stripped query text
+
+    Returns:
+        tuple: (command, args); command is 'today', 'yesterday',
+        'this_month', 'last_month' or 'recent_days' (args: (days,)), or
+        None when the text is not a known command
+    """
+    # 今日/今天
+    if query_text in ["今日", "今天"]:
+        return 'today', ()
+    # 昨日/昨天
+    if query_text in ["昨日", "昨天"]:
+        return 'yesterday', ()
+    # 本月
+    if query_text in ["本月"]:
+        return 'this_month', ()
+    # 上个月
+    if query_text in ["上个月", "上月"]:
+        return 'last_month', ()
+    # 最近n日/最近n天
+    match = re.match(r'最近(\d+)(日|天)', query_text)
+    if match:
+        return 'recent_days', (int(match.group(1)),)
+    return None, ()
+
+
+def report_range(command, days=None, today=None):
+    """
+    Date range a report command covers
+
+    Args:
+        command: Command from ``parse_query``
+        days: Number of days for 'recent_days'
+        today: Reference day, defaults to today
+
+    Returns:
+        tuple: (start_date, end_date), both inclusive
+    """
+    today = today or datetime.now().date()
+    if command == 'today':
+        return today, today
+    if command == 'yesterday':
+        yesterday = today - timedelta(days=1)
+        return yesterday, yesterday
+    if command == 'this_month':
+        return today.replace(day=1), today
+    if command == 'last_month':
+        last_day_last_month = today.replace(day=1) - timedelta(days=1)
+        return last_day_last_month.replace(day=1), last_day_last_month
+    if command == 'recent_days':
+        return today - timedelta(days=days - 1), today
+    raise ValueError(f"unknown command: {command}")
+
+
+def describe_error(error):
+    """
+    Reason shown to the user for a failed query (the details are logged)
+
+    Args:
+        error: Exception raised while building the report
+
+    Returns:
+        str: Short message
+    """
+    if isinstance(error, CircuitOpenError):
+        return "数据库暂时不可用，请稍后再试"
+    if isinstance(error, (QueryTimeoutError, PoolTimeoutError, FollowerTimeoutError)) or (
+            isinstance(error, pymysql.err.OperationalError) and error.args and error.args[0] == ER_QUERY_TIMEOUT):
+        return "查询超时，请稍后再试或缩小查询范围"
+    if isinstance(error, DB_FAILURES):
+        return "数据库连接异常，请稍后再试"
+    return "服务内部错误，请稍后再试"
+
+
+def last_good_key(command, args=()):
+    """Key of a query's last good report, e.g. 'today' or 'recent_days:7'"""
+    return ':'.join([command, *map(str, args)])
+
+
+# Single-range report commands and their names in error messages; the
+# sync and async handlers both build these through QueryHandler.build_report
+REPORT_LABELS = {
+    'today': '今日',
+    'yesterday': '昨日',
+    'this_month': '本月',
+    'last_month': '上个月',
+}
+
+
+def report_label(command, args=()):
+    """Report name in error messages, e.g. '今日' or '最近7日'"""
+    if command == 'recent_days':
+        return f"最近{args[0]}日"
+    return REPORT_LABELS[command]
 
 
 class QueryHandler:
     """Handler for processing user queries from WeChat"""
 
+    # Reports behind the TODAY_ORDER / YESTERDAY_ORDER / THIS_MONTH_ORDER menu keys
+    SNAPSHOT_REPORTS = ('today', 'yesterday', 'this_month')
+
     def __init__(self):
         self.db = Database()
-        self.bot = WeChatBot()
-        # 日志初始化（只初始化一次即可）
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s %(levelname)s %(message)s',
-        )
-    
+        self._bot = None
+        # Identical queries arriving together share one computation
+        self.single_flight = SingleFlight()
+        # In-memory counters for 今日, refreshed by the scheduler (None when disabled)
+        self.today_counters = get_default_today_counters()
+        # Pre-rendered 今日/昨日/本月 reports, refreshed by the scheduler (None when disabled)
+        self.snapshots = get_default_snapshot_store()
+        # Last successful report per query, served while the database fails (None when disabled)
+        self.last_good = get_default_last_good_store()
+
+    @property
+    def bot(self):
+        """Group robot client, created on first use"""
+        if self._bot is None:
+            self._bot = WeChatBot()
+        return self._bot
+
     def process_query(self, query_text):
         """
         Process a query from user
@@ -33,80 +163,192 @@ class QueryHandler:
         query_text = query_text.strip()
         logging.info(f"收到 query_text: {query_text}")
 
-        # 今日/今天
-        if query_text in ["今日", "今天"]:
-            logging.info("分支: 今日/今天查询")
-            return self.handle_today_query()
-
-        # 昨日/昨天
-        if query_text in ["昨日", "昨天"]:
-            logging.info("分支: 昨日/昨天查询")
-            return self.handle_yesterday_query()
-
-        # 本月
-        if query_text in ["本月"]:
-            logging.info("分支: 本月查询")
-            return self.handle_this_month_query()
-
-        # 上个月
-        if query_text in ["上个月", "上月"]:
-            logging.info("分支: 上个月查询")
-            return self.handle_last_month_query()
-
-        # 最近n日/最近n天
-        match = re.match(r'最近(\d+)(日|天)', query_text)
-        if match:
-            days = int(match.group(1))
-            logging.info(f"分支: 最近{days}{match.group(2)}查询")
-            return self.handle_recent_days_query(days, include_date_group=True)
-
-        # Unknown query
-        logging.info("分支: 未知查询格式")
-        return self.handle_unknown_query()
+        command, args = parse_query(query_text)
+        if command is None:
+            # Unknown query
+            logging.info("分支: 未知查询格式")
+            with QUERY_SECONDS.time(command='unknown'):
+                return self.handle_unknown_query()
+
+        logging.info(f"分支: {query_text}查询")
+        if command == 'recent_days':
+            return self._run_shared(command, self.handle_recent_days_query, *args, include_date_group=True)
+        handler = getattr(self, f"handle_{command}_query")
+        return self._run_shared(command, handler, *args)
     
-    def handle_this_month_query(self):
+    def _run_shared(self, command, handler, *args, **kwargs):
         """
-        查询本月数据（从当月1号到今天）
+        Run a query handler, sharing the result with identical concurrent queries
+
+        Every handler's date range follows from the command, its arguments
+        and today's date, so those make up the coalescing key. The time spent,
+        including waiting on a shared call, is recorded under the command.
+        The database work, and a caller's wait on a shared call, are bounded
+        by the command's QUERY_DEADLINES entry.
         """
-        try:
-            today = datetime.now().date()
-            start_date = today.replace(day=1)
-            stats = self.db.get_combined_stats(start_date, today)
-            message = format_recent_days_report(stats, (today - start_date).days + 1)
+        key = (command, args, tuple(sorted(kwargs.items())), datetime.now().date())
+        limit = QUERY_DEADLINES.get(command)
+
+        def run():
+            with deadline(limit):
+                return handler(*args, **kwargs)
+
+        with QUERY_SECONDS.time(command=command):
+            try:
+                return self.single_flight.do(key, run, timeout=limit)
+            except FollowerTimeoutError as e:
+                return self._failure_reply(last_good_key(command, args), report_label(command, args), e)
+
+    def _with_age_note(self, message, age):
+        """Append how old the figures are, for reports not read live"""
+        if age is None:
             return message
+        return message + "\n" + format_data_age_note(age)
+
+    def _remember(self, key, message, age=None):
+        """
+        Keep a successfully computed report as the query's last good one
+
+        Returns:
+            str: The report with its age note
+        """
+        if self.last_good is not None:
+            self.last_good.put(key, message, age)
+        return self._with_age_note(message, age)
+
+    def _failure_reply(self, key, label, error):
+        """
+        Reply for a failed query: its last good report, marked with its
+        age, or else a short error message
+
+        Args:
+            key: Key from ``last_good_key``
+            label: Report name for the error message, e.g. '今日'
+            error: Exception raised while building the report
+        """
+        logging.error(f"{label}查询异常: {str(error)}")
+        ERRORS.inc(where='query')
+        if self.last_good is not None:
+            last = self.last_good.get(key)
+            if last is not None:
+                message, age = last
+                logging.info(f"返回最近一次成功的报表: {key}")
+                return message + "\n" + format_stale_note(age)
+        return f"查询{label}数据时出错: {describe_error(error)}"
+
+    def _snapshot(self, command):
+        """
+        The stored snapshot of a menu report
+
+        Returns:
+            tuple: (message, age_seconds), or None when the command has no
+            valid snapshot
+        """
+        if self.snapshots is None or command not in self.SNAPSHOT_REPORTS:
+            return None
+        snapshot = self.snapshots.get(command)
+        if snapshot is not None:
+            logging.info(f"命中快照: {command}")
+        return snapshot
+
+    def _counted_report(self, command, today=None):
+        """
+        今日 from the in-memory counters when they are fresh
+
+        Returns:
+            tuple: (message, age_seconds), or None when the report needs the database
+        """
+        if command != 'today' or self.today_counters is None:
+            return None
+        stats, age = self.today_counters.get_stats(today)
+        if stats is None:
+            return None
+        return format_today_report(stats), age
+
+    @staticmethod
+    def render_report(command, stats, start_date, end_date):
+        """Format the combined stats of a single-range report command"""
+        if command in ('today', 'yesterday'):
+            return format_today_report(stats)
+        return format_recent_days_report(stats, (end_date - start_date).days + 1)
+
+    def build_report(self, command, today=None):
+        """
+        Build the report of a command in REPORT_LABELS, from the in-memory
+        counters when they can answer it
+
+        Args:
+            command: Command from ``parse_query``
+            today: Reference day, defaults to today
+
+        Returns:
+            tuple: (message, age_seconds), age None when read live
+        """
+        counted = self._counted_report(command, today)
+        if counted is not None:
+            return counted
+        start_date, end_date = report_range(command, today=today)
+        stats = self.db.get_combined_stats(start_date, end_date)
+        return self.render_report(command, stats, start_date, end_date), None
+
+    def handle_report_query(self, command):
+        """
+        Answer a command in REPORT_LABELS: from its snapshot, or built
+        live, or else from its last good report
+
+        Returns:
+            str: Report with an age note when not read live
+        """
+        key = last_good_key(command)
+        try:
+            snapshot = self._snapshot(command)
+            if snapshot is not None:
+                return self._remember(key, *snapshot)
+            return self._remember(key, *self.build_report(command))
         except Exception as e:
-            logging.error(f"handle_this_month_query 异常: {str(e)}")
-            return f"查询本月数据时出错: {str(e)}"
+            return self._failure_reply(key, report_label(command), e)
+
+    def refresh_snapshots(self):
+        """
+        Re-render the standard menu reports into the snapshot store
+
+        Returns:
+            int: Number of snapshots stored
+        """
+        if self.snapshots is None:
+            return 0
+        # Every report of one refresh is built for, and stored under, the same day
+        today = datetime.now().date()
+        stored = 0
+        for command in self.SNAPSHOT_REPORTS:
+            try:
+                message, age = self.build_report(command, today)
+                self.snapshots.put(command, message, age, day=today)
+                stored += 1
+            except Exception as e:
+                logging.error(f"快照 {command} 生成失败: {str(e)}")
+                ERRORS.inc(where='snapshot')
+        return stored
+
+    def handle_this_month_query(self):
+        """
+        查询本月数据（从当月1号到今天）
+        """
+        return self.handle_report_query('this_month')
 
     def handle_last_month_query(self):
         """
         查询上个月数据（从上月1号到上月最后一天）
         """
-        try:
-            today = datetime.now().date()
-            first_day_this_month = today.replace(day=1)
-            last_day_last_month = first_day_this_month - timedelta(days=1)
-            first_day_last_month = last_day_last_month.replace(day=1)
-            stats = self.db.get_combined_stats(first_day_last_month, last_day_last_month)
-            message = format_recent_days_report(stats, (last_day_last_month - first_day_last_month).days + 1)
-            return message
-        except Exception as e:
-            logging.error(f"handle_last_month_query 异常: {str(e)}")
-            return f"查询上个月数据时出错: {str(e)}"
-    
+        return self.handle_report_query('last_month')
+
     def handle_today_query(self):
         """
         Handle today's data query
         Returns:
             str: Formatted today's statistics
         """
-        try:
-            today = datetime.now().date()
-            stats = self.db.get_combined_stats(today, today)
-            message = format_today_report(stats)
-            return message
-        except Exception as e:
-            return f"查询今日数据时出错: {str(e)}"
+        return self.handle_report_query('today')
 
     def handle_yesterday_query(self):
         """
@@ -114,14 +356,28 @@ class QueryHandler:
         Returns:
             str: Formatted yesterday's statistics
         """
-        try:
-            yesterday = datetime.now().date() - timedelta(days=1)
-            stats = self.db.get_combined_stats(yesterday, yesterday)
-            message = format_today_report(stats)
-            return message
-        except Exception as e:
-            return f"查询昨日数据时出错: {str(e)}"
+        return self.handle_report_query('yesterday')
     
+    @staticmethod
+    def check_days(days):
+        """Error message for an out-of-range 最近n日, or None"""
+        if days <= 0:
+            return "请输入有效的天数（大于0）"
+        if days > 365:
+            return "查询天数不能超过365天"
+        return None
+
+    @staticmethod
+    def format_recent_days_message(stats, days, date_stats=None):
+        """最近n日 report, followed by the per-day lines (newest first) when given"""
+        message = format_recent_days_report(stats, days)
+        # 增加日期分组（倒序）
+        if date_stats is not None:
+            message += "\n\n📅 按日期分组（倒序）："
+            for d in sorted(date_stats.keys(), reverse=True):
+                message += f"\n{d}: {date_stats[d]}"
+        return message
+
     def handle_recent_days_query(self, days, include_date_group=False):
         """
         Handle recent days data query
@@ -131,23 +387,19 @@ class QueryHandler:
             str: Formatted statistics for recent days
         """
         try:
-            if days <= 0:
-                return "请输入有效的天数（大于0）"
-            if days > 365:
-                return "查询天数不能超过365天"
-            end_date = datetime.now().date()
-            start_date = end_date - timedelta(days=days-1)
-            stats = self.db.get_combined_stats(start_date, end_date)
-            message = format_recent_days_report(stats, days)
-            # 增加日期分组（倒序）
+            invalid = self.check_days(days)
+            if invalid:
+                return invalid
+            start_date, end_date = report_range('recent_days', days)
+            # 汇总和按日期分组相互独立，并发查询
+            calls = {'stats': (self.db.get_combined_stats, (start_date, end_date))}
             if hasattr(self.db, 'get_stats_by_date'):
-                date_stats = self.db.get_stats_by_date(start_date, end_date)
-                message += "\n\n📅 按日期分组（倒序）："
-                for d in sorted(date_stats.keys(), reverse=True):
-                    message += f"\n{d}: {date_stats[d]}"
-            return message
+                calls['by_date'] = (self.db.get_stats_by_date, (start_date, end_date))
+            results = self.db.run_concurrently(calls)
+            message = self.format_recent_days_message(results['stats'], days, results.get('by_date'))
+            return self._remember(last_good_key('recent_days', (days,)), message)
         except Exception as e:
-            return f"查询最近{days}日数据时出错: {str(e)}"
+            return self._failure_reply(last_good_key('recent_days', (days,)), report_label('recent_days', (days,)), e)
     
     def handle_unknown_query(self):
         """
@@ -0,0 +1,232 @@
+"""
+Read replica selection
+
+Report queries are read-only, so they can be served by MySQL replicas
+instead of the primary that takes checkout writes. Each replica gets its own
+connection pool; its replication lag is checked every ``check_interval``
+seconds by the scheduler's replica_check job, so choosing a replica only
+reads the last results and never waits on a slow replica. A replica whose
+lag is unknown (unreachable, replication stopped, not a replica at all,
+or not checked for ``STALE_CHECK_INTERVALS`` intervals) or above
+``max_lag``, or whose own circuit breaker is not closed, is skipped; when
+none is usable, reads go to the primary. A successful lag check is the
+trial call that closes a half-open replica breaker.
+"""
+import logging
+import threading
+import time
+import pymysql
+from config import (
+    DB_CONFIG,
+    DB_REPLICAS,
+    DB_REPLICA_STRATEGY,
+    DB_REPLICA_MAX_LAG,
+    DB_REPLICA_CHECK_INTERVAL,
+    DB_REPLICA_POOL_SIZE,
+    DB_BREAKER_FAILURES,
+)
+from circuit_breaker import CircuitBreaker, CLOSED, HALF_OPEN
+
+STRATEGIES = ('round_robin', 'least_latency')
+
+# Weight of the newest round trip in a replica's smoothed latency
+LATENCY_SMOOTHING = 0.3
+
+# Missed check intervals after which a replica's last lag result no longer counts
+STALE_CHECK_INTERVALS = 3
+
+
+def parse_replicas(spec, base=DB_CONFIG):
+    """
+    Turn DB_REPLICAS into connection configs
+
+    Args:
+        spec: Comma-separated ``host[:port]`` list
+        base: Config the replicas share with the primary (user, database...)
+
+    Returns:
+        list: One config dict per replica
+    """
+    configs = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.partition(':')
+        configs.append(dict(base, host=host, port=int(port) if port else base.get('port', 3306)))
+    return configs
+
+
+def replication_lag(cursor):
+    """
+    Seconds the server behind ``cursor`` is behind its source
+
+    Returns:
+        float: The lag, or None when replication is stopped or the server is
+        not a replica
+    """
+    try:
+        cursor.execute("SHOW REPLICA STATUS")
+        column = 'Seconds_Behind_Source'
+    except pymysql.err.ProgrammingError:
+        # MySQL before 8.0.22
+        cursor.execute("SHOW SLAVE STATUS")
+        column = 'Seconds_Behind_Master'
+    row = cursor.fetchone()
+    if not row or row.get(column) is None:
+        return None
+    return float(row[column])
+
+
+class Replica:
+    """One replica's pool, circuit breaker and last lag check"""
+
+    def __init__(self, name, pool, breaker=None):
+        self.name = name
+        self.pool = pool
+        # Opened by this replica's failures only (None when disabled)
+        self.breaker = breaker
+        # None until checked, and while replication is not usable
+        self.lag = None
+        # Smoothed round trip of the lag check, in seconds
+        self.latency = None
+        self.checked_at = None
+        self.error = None
+        self.reads = 0
+
+
+class ReplicaSet:
+    """
+    Picks the replica for each read-only query
+
+    ``round_robin`` spreads reads evenly over the usable replicas;
+    ``least_latency`` sends them to the one answering its lag checks fastest.
+    """
+
+    def __init__(self, replicas, strategy=DB_REPLICA_STRATEGY, max_lag=DB_REPLICA_MAX_LAG,
+                 check_interval=DB_REPLICA_CHECK_INTERVAL):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"DB_REPLICA_STRATEGY 必须是 {' / '.join(STRATEGIES)}: {strategy}")
+        self.replicas = list(replicas)
+        self.strategy = strategy
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._next = 0
+        self._lock = threading.Lock()
+        # Held by the one thread running lag checks; the others use the last results
+        self._check_lock = threading.Lock()
+
+    def check(self, replica):
+        """Measure a replica's replication lag and round trip"""
+        started = time.monotonic()
+        try:
+            with replica.pool.connection() as conn:
+                with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                    lag = replication_lag(cursor)
+        except Exception as e:
+            replica.lag = None
+            replica.error = str(e)
+            logging.warning(f"只读副本 {replica.name} 检查失败: {str(e)}")
+        else:
+            elapsed = time.monotonic() - started
+            if lag is not None and replica.breaker is not None and replica.breaker.state == HALF_OPEN:
+                replica.breaker.record_success()
+            replica.lag = lag
+            replica.error = None if lag is not None else '复制未运行'
+            if replica.latency is None:
+                replica.latency = elapsed
+            else:
+                replica.latency += LATENCY_SMOOTHING * (elapsed - replica.latency)
+        replica.checked_at = time.monotonic()
+
+    def refresh(self, force=False):
+        """
+        Re-check the replicas whose last check is older than check_interval
+
+        Args:
+            force: Check every replica, waiting for a check already running
+        """
+        if not self._check_lock.acquire(blocking=force):
+            return
+        try:
+            now = time.monotonic()
+            for replica in self.replicas:
+                if force or replica.checked_at is None or now - replica.checked_at >= self.check_interval:
+                    self.check(replica)
+        finally:
+            self._check_lock.release()
+
+    def is_usable(self, replica):
+        """Lag recently checked and within max_lag, and the replica's breaker closed"""
+        if replica.lag is None or replica.lag > self.max_lag:
+            return False
+        if time.monotonic() - replica.checked_at > STALE_CHECK_INTERVALS * self.check_interval:
+            return False
+        return replica.breaker is None or replica.breaker.state == CLOSED
+
+    def usable(self):
+        return [r for r in self.replicas if self.is_usable(r)]
+
+    def choose(self):
+        """
+        Returns:
+            Replica: Where the next read-only query should go, or None to
+            use the primary
+        """
+        candidates = self.usable()
+        if not candidates:
+            return None
+        if self.strategy == 'least_latency':
+            replica = min(candidates, key=lambda r: r.latency)
+        else:
+            with self._lock:
+                replica = candidates[self._next % len(candidates)]
+                self._next += 1
+        replica.reads += 1
+        return replica
+
+    def stats(self):
+        """
+        Returns:
+            list: Lag, latency, reads and pool usage of each replica
+        """
+        return [
+            {
+                'name': r.name,
+                'lag_seconds': r.lag,
+                'latency_ms': round(r.latency * 1000, 2) if r.latency is not None else None,
+                'usable': self.is_usable(r),
+                'error': r.error,
+                'breaker': r.breaker.stats() if r.breaker is not None else None,
+                'reads': r.reads,
+                'pool': r.pool.stats(),
+            }
+            for r in self.replicas
+        ]
+
+
+_default_replica_set = None
+_default_replica_set_lock = threading.Lock()
+
+
+def get_default_replica_set():
+    """Return the process-wide replica set, or None when DB_REPLICAS is empty"""
+    global _default_replica_set
+    configs = parse_replicas(DB_REPLICAS)
+    if not configs:
+        return None
+    with _default_replica_set_lock:
+        if _default_replica_set is None:
+            from database import ConnectionPool
+            from slowlog import get_default_slow_query_log
+
+            replicas = []
+            for config in configs:
+                name = f"{config['host']}:{config['port']}"
+                replicas.append(Replica(
+                    name,
+                    ConnectionPool(config, size=DB_REPLICA_POOL_SIZE, slow_query_log=get_default_slow_query_log()),
+                    CircuitBreaker(f"只读副本 {name}") if DB_BREAKER_FAILURES > 0 else None,
+                ))
+            _default_replica_set = ReplicaSet(replicas)
+        return _default_replica_set
@@ -0,0 +1,112 @@
+"""
+Background reply module for the acknowledge-then-push callback mode
+"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import REPLY_WORKERS
+from wechat_bot import WeChatAppClient
+from metrics import ERRORS
+
+
+class ReplyDispatcher:
+    """
+    Computes query replies on a worker pool and pushes them to the user
+
+    The WeChat Work callback only has to acknowledge the message; the report
+    is rendered in the background and delivered to the sender through the
+    app message API. Replies are never sent to the group robot: a report
+    asked for in a private chat is not for the whole group.
+    """
+
+    def __init__(self, query_handler, workers=REPLY_WORKERS, app_client=None):
+        self.query_handler = query_handler
+        self.app_client = app_client or WeChatAppClient()
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='reply')
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        # Recent time-to-reply samples in seconds, for percentiles
+        self._reply_times = deque(maxlen=512)
+
+    def submit(self, touser, query_text):
+        """
+        Queue a query whose reply is pushed to ``touser`` when ready
+
+        Args:
+            touser: WeChat Work user ID that sent the query
+            query_text: Query text, as passed to ``QueryHandler.process_query``
+        """
+        received_at = time.monotonic()
+        with self._lock:
+            self._queued += 1
+        self._executor.submit(self._run, touser, query_text, received_at)
+
+    def _run(self, touser, query_text, received_at):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        delivered = False
+        try:
+            content = self.query_handler.process_query(query_text)
+            delivered = self.deliver(touser, content)
+        except Exception as e:
+            logging.error(f"后台回复异常: {str(e)}")
+            ERRORS.inc(where='async_reply')
+        finally:
+            with self._lock:
+                self._running -= 1
+                if delivered:
+                    self._completed += 1
+                    self._reply_times.append(time.monotonic() - received_at)
+                else:
+                    self._failed += 1
+
+    def deliver(self, touser, content):
+        """
+        Push a finished reply
+
+        Args:
+            touser: WeChat Work user ID
+            content: Reply text
+
+        Returns:
+            bool: True if the message was sent, False when it failed or the
+            app credentials are not configured
+        """
+        if not self.app_client.configured:
+            logging.warning(f"未配置企业微信应用凭据，无法推送回复给 {touser}")
+            return False
+        return self.app_client.send_text_message(touser, content)
+
+    def stats(self):
+        """
+        Get queue depth and time-to-reply figures
+
+        Returns:
+            dict: Queued/running/completed/failed counts and reply time
+            percentiles in seconds over recent replies
+        """
+        with self._lock:
+            samples = sorted(self._reply_times)
+            stats = {
+                'queued': self._queued,
+                'running': self._running,
+                'completed': self._completed,
+                'failed': self._failed,
+            }
+        if samples:
+            stats['reply_seconds'] = {
+                'p50': round(samples[len(samples) // 2], 3),
+                'p95': round(samples[min(int(len(samples) * 0.95), len(samples) - 1)], 3),
+                'max': round(samples[-1], 3),
+            }
+        return stats
+
+    def shutdown(self, wait=True):
+        """Stop accepting work, optionally waiting for queued replies"""
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,260 @@
+"""
+In-memory day x salesperson cube for range reports
+
+Optional: requires numpy. When numpy is not installed, or CUBE_ENABLED is
+off, Database answers every range with SQL as before.
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from config import CUBE_ENABLED, CUBE_DAYS, CUBE_REFRESH_LOOKBACK_DAYS
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional
+    np = None
+
+# Metric planes of the cube
+LEADS, ORDERS, REVENUE_CENTS = 0, 1, 2
+
+
+class SalesCube:
+    """
+    Leads, orders and revenue for the last ``days`` closed days, per sales person
+
+    Values live in a (metric, day, sales) int64 array with revenue stored in
+    cents, plus a running sum along the day axis with a leading zero row, so
+    the total of any day range [a, b] is ``cumsum[b + 1] - cumsum[a]`` for
+    every sales person at once. Today is never in the cube; Database merges
+    it in from SQL.
+    """
+
+    def __init__(self, days=CUBE_DAYS):
+        self.days = days
+        self.first_day = None
+        self.last_day = None
+        self.refreshed_at = None
+        self._sales = []
+        self._sales_index = {}
+        self._values = None
+        self._cumsum = None
+        self._dirty = set()
+        self._lock = threading.RLock()
+
+    @property
+    def ready(self):
+        """Whether the cube has been loaded"""
+        return self._cumsum is not None
+
+    def _covers(self, start_date, end_date):
+        """
+        Whether every day of [start_date, end_date] is in the cube and none
+        of them is invalidated but not yet reloaded; call with the lock held
+        """
+        if not (self.ready and self.first_day <= start_date and end_date <= self.last_day):
+            return False
+        return not any(start_date <= day <= end_date for day in self._dirty)
+
+    def invalidate(self, start_date, end_date=None):
+        """
+        Reload the given days on the next refresh (e.g. after back-dated orders);
+        until then ranges including them are left to SQL
+
+        Args:
+            start_date: First changed day (inclusive)
+            end_date: Last changed day (inclusive), defaults to start_date
+        """
+        end_date = end_date or start_date
+        with self._lock:
+            if not self.ready:
+                return
+            day = max(start_date, self.first_day)
+            while day <= min(end_date, self.last_day):
+                self._dirty.add(day)
+                day += timedelta(days=1)
+
+    def refresh(self, db):
+        """
+        Bring the cube up to date
+
+        The first call loads the whole window. Later calls slide the window
+        forward after midnight and reload only the most recent days (to pick
+        up late rows) plus any invalidated days. Cached results of days
+        whose figures changed are dropped from ``db.cache``, since results
+        of closed ranges are otherwise kept until evicted.
+
+        Args:
+            db: Database used to read per-day, per-sales rows
+
+        Returns:
+            int: Number of days reloaded
+        """
+        last_day = datetime.now().date() - timedelta(days=1)
+        first_day = last_day - timedelta(days=self.days - 1)
+        with self._lock:
+            # Days up to here were served before; a change to them can be cached
+            served_until = self.last_day if self.ready else None
+            if not self.ready or first_day > self.last_day:
+                values = np.zeros((3, self.days, len(self._sales)), dtype=np.int64)
+                reload_from = first_day
+            else:
+                shift = (first_day - self.first_day).days
+                values = np.zeros_like(self._values)
+                values[:, :self.days - shift, :] = self._values[:, shift:, :]
+                lookback = last_day - timedelta(days=max(CUBE_REFRESH_LOOKBACK_DAYS, 1) - 1)
+                reload_from = max(min(lookback, self.last_day + timedelta(days=1)), first_day)
+            dirty = sorted(day for day in self._dirty if day >= first_day)
+
+        # Query outside the lock so readers keep using the current arrays
+        ranges = [(reload_from, last_day)]
+        for day in dirty:
+            if day < reload_from:
+                ranges.append((day, day))
+        rows = []
+        for start_date, end_date in ranges:
+            rows.extend(db.get_daily_sales_rows(start_date, end_date))
+
+        with self._lock:
+            sales = list(self._sales)
+            sales_index = dict(self._sales_index)
+            for row in rows:
+                if row['sales'] not in sales_index:
+                    sales_index[row['sales']] = len(sales)
+                    sales.append(row['sales'])
+            if len(sales) > values.shape[2]:
+                values = np.pad(values, ((0, 0), (0, 0), (0, len(sales) - values.shape[2])))
+
+            before = {}
+            for start_date, end_date in ranges:
+                a = (start_date - first_day).days
+                b = (end_date - first_day).days
+                before[(a, b)] = values[:, a:b + 1, :].copy()
+                values[:, a:b + 1, :] = 0
+            for row in rows:
+                d = (row['day'] - first_day).days
+                s = sales_index[row['sales']]
+                values[LEADS, d, s] = int(row['leads_count'] or 0)
+                values[ORDERS, d, s] = int(row['orders_count'] or 0)
+                values[REVENUE_CENTS, d, s] = int(round((row['total_sales'] or 0) * 100))
+
+            cumsum = np.zeros((3, self.days + 1, len(sales)), dtype=np.int64)
+            np.cumsum(values, axis=1, out=cumsum[:, 1:, :])
+
+            self._sales = sales
+            self._sales_index = sales_index
+            self._values = values
+            self._cumsum = cumsum
+            self.first_day = first_day
+            self.last_day = last_day
+            self._dirty.difference_update(dirty)
+            self.refreshed_at = time.time()
+
+            changed = []
+            if served_until is not None:
+                for (a, b), old in before.items():
+                    for i in np.nonzero((values[:, a:b + 1, :] != old).any(axis=(0, 2)))[0]:
+                        day = first_day + timedelta(days=int(a + i))
+                        if day <= served_until:
+                            changed.append(day)
+
+        cache = getattr(db, 'cache', None)
+        if cache is not None:
+            for day in changed:
+                cache.invalidate(day, day)
+
+        return sum((end_date - start_date).days + 1 for start_date, end_date in ranges)
+
+    def range_rows(self, start_date, end_date):
+        """
+        Per-sales totals for a day range
+
+        Coverage is checked under the same lock as the read, so a refresh
+        sliding the window in between cannot shift the days read.
+
+        Args:
+            start_date: Start date (inclusive)
+            end_date: End date (inclusive)
+
+        Returns:
+            list: Rows with ``sales``, ``leads_count``, ``orders_count`` and
+            ``total_sales``, for sales people with any activity in the range,
+            or None when the cube does not cover the range
+        """
+        with self._lock:
+            if not self._covers(start_date, end_date):
+                return None
+            a = (start_date - self.first_day).days
+            b = (end_date - self.first_day).days
+            totals = self._cumsum[:, b + 1, :] - self._cumsum[:, a, :]
+            active = np.nonzero(totals[LEADS] | totals[ORDERS])[0]
+            return [
+                {
+                    'sales': self._sales[s],
+                    'leads_count': int(totals[LEADS, s]),
+                    'orders_count': int(totals[ORDERS, s]),
+                    'total_sales': Decimal(int(totals[REVENUE_CENTS, s])) / 100,
+                }
+                for s in active
+            ]
+
+    def daily_totals(self, start_date, end_date):
+        """
+        Per-day totals over all sales people for a day range
+
+        Returns:
+            tuple: (leads_by_day, orders_by_day) keyed by 'YYYY-MM-DD', in the
+            shape used by ``Database.get_stats_by_date``, or None when the
+            cube does not cover the range (checked as in ``range_rows``)
+        """
+        with self._lock:
+            if not self._covers(start_date, end_date):
+                return None
+            a = (start_date - self.first_day).days
+            b = (end_date - self.first_day).days
+            per_day = self._values[:, a:b + 1, :].sum(axis=2)
+        leads_by_day = {}
+        orders_by_day = {}
+        for i in range(per_day.shape[1]):
+            day = (start_date + timedelta(days=i)).strftime('%Y-%m-%d')
+            if per_day[LEADS, i]:
+                leads_by_day[day] = int(per_day[LEADS, i])
+            if per_day[ORDERS, i]:
+                orders_by_day[day] = {
+                    'orders_count': int(per_day[ORDERS, i]),
+                    'total_sales': int(per_day[REVENUE_CENTS, i]) // 100,
+                }
+        return leads_by_day, orders_by_day
+
+    def stats(self):
+        """
+        Get cube coverage and size
+
+        Returns:
+            dict: Covered days, sales people and seconds since the last refresh
+        """
+        with self._lock:
+            return {
+                'first_day': self.first_day.strftime('%Y-%m-%d') if self.first_day else None,
+                'last_day': self.last_day.strftime('%Y-%m-%d') if self.last_day else None,
+                'sales_people': len(self._sales),
+                'age_seconds': round(time.time() - self.refreshed_at, 1) if self.refreshed_at else None,
+            }
+
+
+_default_cube = None
+_default_cube_lock = threading.Lock()
+
+
+def get_default_cube():
+    """
+    Return the process-wide cube, or None when it is disabled or numpy is
+    not installed
+    """
+    global _default_cube
+    if not CUBE_ENABLED or np is None:
+        return None
+    with _default_cube_lock:
+        if _default_cube is None:
+            _default_cube = SalesCube()
+        return _default_cube
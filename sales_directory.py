@@ -0,0 +1,97 @@
+"""
+In-process cache of the sales_people dimension (sales_id -> display name)
+"""
+import threading
+import time
+from config import SALES_DIMENSION_ENABLED, SALES_DIRECTORY_TTL
+
+
+class SalesDirectory:
+    """
+    Maps integer sales IDs to the names shown in reports
+
+    The whole table is small, so it is loaded in one query and kept for
+    ``ttl`` seconds. An ID that is not in the mapping (a sales person added
+    since the last load) triggers an immediate reload.
+    """
+
+    def __init__(self, ttl=SALES_DIRECTORY_TTL):
+        self.ttl = ttl
+        self._names = {}
+        self._loaded_at = None
+        self._reloads = 0
+        self._lock = threading.Lock()
+
+    def resolve(self, sales_ids, load):
+        """
+        Get the names of the given sales IDs
+
+        Args:
+            sales_ids: IDs that need a name
+            load: Callable returning the full {sales_id: name} mapping
+
+        Returns:
+            dict: sales_id -> name, covering at least every known ID in
+            ``sales_ids``
+        """
+        names = self.lookup(sales_ids)
+        if names is not None:
+            return names
+        return self.store(load())
+
+    def lookup(self, sales_ids):
+        """
+        Get the cached mapping if it is fresh and knows every ID
+
+        Returns:
+            dict: sales_id -> name, or None when it has to be reloaded
+        """
+        with self._lock:
+            names = self._names
+            fresh = self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+        if fresh and all(sales_id in names for sales_id in sales_ids):
+            return names
+        return None
+
+    def store(self, names):
+        """Replace the mapping with a freshly loaded one and return it"""
+        with self._lock:
+            self._names = names
+            self._loaded_at = time.monotonic()
+            self._reloads += 1
+        return names
+
+    def invalidate(self):
+        """Reload the mapping on next use (e.g. after renaming a sales person)"""
+        with self._lock:
+            self._loaded_at = None
+
+    def stats(self):
+        """
+        Get mapping size and freshness
+
+        Returns:
+            dict: Number of sales people, reloads so far and seconds since
+            the last load
+        """
+        with self._lock:
+            return {
+                'sales_people': len(self._names),
+                'reloads': self._reloads,
+                'age_seconds': round(time.monotonic() - self._loaded_at, 1) if self._loaded_at else None,
+            }
+
+
+_default_directory = None
+_default_directory_lock = threading.Lock()
+
+
+def get_default_sales_directory():
+    """Return the process-wide directory, or None when the dimension is disabled"""
+    global _default_directory
+    if not SALES_DIMENSION_ENABLED:
+        return None
+    with _default_directory_lock:
+        if _default_directory is None:
+            _default_directory = SalesDirectory()
+        return _default_directory
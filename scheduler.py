@@ -1,17 +1,43 @@
 """
 Scheduled tasks module
 """
+import os
 from datetime import datetime, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
 from database import Database
 from wechat_bot import WeChatBot
 from message_formatter import format_daily_report
+from config import (
+    ROLLUP_ENABLED,
+    ROLLUP_REFRESH_LOOKBACK_DAYS,
+    DAILY_REPORT_CATCHUP_HOURS,
+    CUBE_REFRESH_SECONDS,
+    TODAY_REFRESH_SECONDS,
+    SNAPSHOT_ENABLED,
+    SNAPSHOT_INTERVAL_MINUTES,
+    EMBEDDED_SYNC_MINUTES,
+    DB_REPLICA_CHECK_INTERVAL,
+    SCHEDULER_LEASE_SECONDS,
+)
+from sales_cube import get_default_cube
+from today_counters import get_default_today_counters
+from backends import get_default_backend
+from lease import get_default_lease
+from replicas import get_default_replica_set
 
+# Jobs added by add_leader_jobs
+LEADER_JOB_IDS = ('daily_report', 'daily_report_catch_up', 'rollup_refresh', 'partition_maintenance',
+                  'replica_sync')
 
-def daily_report_job():
+
+def daily_report_job(force=False):
     """
-    Daily report job that runs at 12:01 AM
-    Reports previous day's statistics
+    Daily report job that runs at 12:05 AM
+    Reports previous day's statistics. The day is claimed in report_runs
+    before sending, so a leader catching up after a takeover does not send
+    it a second time; ``force`` (the manual trigger) sends regardless. The
+    claim is withdrawn if the message cannot be queued or later fails to
+    send.
     """
     print(f"Running daily report job at {datetime.now()}")
     
@@ -19,41 +45,374 @@ def daily_report_job():
         # Get yesterday's date
         yesterday = datetime.now().date() - timedelta(days=1)
         
-        # Get statistics
         db = Database()
+        if not force and not db.claim_report_run('daily_report', yesterday):
+            print(f"Daily report for {yesterday} already sent")
+            return
+    except Exception as e:
+        print(f"Error in daily report job: {str(e)}")
+        return
+
+    def release():
+        # Let the next attempt (manual trigger, a new leader) send it
+        try:
+            db.release_report_run('daily_report', yesterday)
+        except Exception as e:
+            print(f"Error in daily report job: {str(e)}")
+
+    queued = False
+    try:
+        # Get statistics
         stats = db.get_combined_stats(yesterday, yesterday)
         
         # Format and send message
         message = format_daily_report(stats)
         bot = WeChatBot()
-        bot.send_text_message(message)
-        
-        print("Daily report sent successfully")
+        queued = bot.enqueue_text_message(message, source='daily_report',
+                                          on_failed=None if force else release)
+        if queued:
+            print("Daily report queued for sending")
     except Exception as e:
         print(f"Error in daily report job: {str(e)}")
 
+    if not queued and not force:
+        release()
 
-def start_scheduler():
+
+def rollup_refresh_job():
     """
-    Start the background scheduler for periodic tasks
-    
-    Returns:
-        BackgroundScheduler: The scheduler instance
+    Rollup maintenance job that runs shortly after midnight
+    Aggregates every closed day since the last refreshed one into
+    daily_sales_stats / monthly_sales_stats, so days missed while no
+    leader ran are filled in, and re-aggregates at least the last
+    ROLLUP_REFRESH_LOOKBACK_DAYS closed days to pick up rows that arrive
+    late
     """
-    scheduler = BackgroundScheduler()
-    
-    # Schedule daily report at 12:01 AM
+    print(f"Running rollup refresh job at {datetime.now()}")
+
+    try:
+        yesterday = datetime.now().date() - timedelta(days=1)
+        start_date = yesterday - timedelta(days=max(ROLLUP_REFRESH_LOOKBACK_DAYS, 1) - 1)
+
+        db = Database()
+        last_day = db.get_last_rollup_day()
+        if last_day is not None:
+            start_date = min(start_date, last_day + timedelta(days=1))
+        days = db.refresh_rollups(start_date, yesterday)
+
+        print(f"Rollup refreshed for {days} day(s): {start_date} ~ {yesterday}")
+    except Exception as e:
+        print(f"Error in rollup refresh job: {str(e)}")
+
+
+def cube_refresh_job():
+    """
+    In-memory cube refresh job
+    Loads the cube on first run, then slides it forward and reloads the
+    most recent closed days
+    """
+    cube = get_default_cube()
+    if cube is None:
+        return
+
+    try:
+        days = cube.refresh(Database())
+        print(f"Sales cube refreshed ({days} day(s) reloaded): {cube.first_day} ~ {cube.last_day}")
+    except Exception as e:
+        print(f"Error in cube refresh job: {str(e)}")
+
+
+def today_counters_job():
+    """
+    Today counters refresh job
+    Applies rows added since the last poll; rebuilds the baseline after
+    midnight and periodically
+    """
+    counters = get_default_today_counters()
+    if counters is None:
+        return
+
+    try:
+        counters.refresh(Database())
+    except Exception as e:
+        print(f"Error in today counters job: {str(e)}")
+
+
+def replica_sync_job():
+    """
+    Embedded replica sync job
+    Copies closed days of leads / sales_orders into the local analytic
+    backend: the SQLite/DuckDB replica re-copies the most recent days to
+    pick up late entries, the Parquet archive appends settled days only
+    """
+    backend = get_default_backend()
+    if backend is None:
+        return
+
+    try:
+        days = backend.sync(Database())
+        print(f"Embedded replica synced ({days} day(s) copied): {backend.coverage()}")
+    except Exception as e:
+        print(f"Error in replica sync job: {str(e)}")
+
+
+def replica_check_job():
+    """
+    Read replica check job
+    Measures each replica's replication lag and round trip, so report
+    queries pick a replica from the last results without checking inline
+    """
+    replicas = get_default_replica_set()
+    if replicas is None:
+        return
+
+    try:
+        replicas.refresh(force=True)
+    except Exception as e:
+        print(f"Error in replica check job: {str(e)}")
+
+
+def snapshot_job(query_handler=None):
+    """
+    Menu report snapshot job
+    Re-renders the 今日 / 昨日 / 本月 reports so menu clicks and the matching
+    text commands are answered without touching MySQL. Runs on the app's
+    query handler when given, so it shares its connection pool and caches.
+    """
+    try:
+        if query_handler is None:
+            from query_handler import QueryHandler
+            query_handler = QueryHandler()
+        stored = query_handler.refresh_snapshots()
+        print(f"Report snapshots refreshed: {stored}")
+    except Exception as e:
+        print(f"Error in snapshot job: {str(e)}")
+
+
+def partition_maintenance_job():
+    """
+    Partition maintenance job that runs daily
+    Keeps PARTITION_MONTHS_AHEAD months of empty partitions ahead of the
+    current month on the partitioned tables; a no-op when they are not
+    partitioned
+    """
+    from migrate import PARTITIONED_TABLES, ensure_future_partitions
+
+    try:
+        with Database().get_connection() as conn:
+            with conn.cursor() as cursor:
+                for table in PARTITIONED_TABLES:
+                    added = ensure_future_partitions(cursor, table)
+                    if added:
+                        print(f"Added {added} partition(s) to {table}")
+    except Exception as e:
+        print(f"Error in partition maintenance job: {str(e)}")
+
+
+def add_leader_jobs(scheduler):
+    """
+    Schedule the jobs that must run in one process only: they send
+    messages or write to shared storage
+    """
+    # Schedule daily report at 12:05 AM
     scheduler.add_job(
         daily_report_job,
         'cron',
         hour=0,
         minute=5,
+        misfire_grace_time=max(int(DAILY_REPORT_CATCHUP_HOURS * 3600), 1),
         id='daily_report',
         name='Daily Report Job',
         replace_existing=True
     )
-    
+
+    # A leader taking over (or restarted) after 12:05 AM sends today's
+    # report if the previous leader did not; report_runs has the answer
+    now = datetime.now()
+    due = now.replace(hour=0, minute=5, second=0, microsecond=0)
+    if due <= now < due + timedelta(hours=DAILY_REPORT_CATCHUP_HOURS):
+        scheduler.add_job(
+            daily_report_job,
+            next_run_time=now,
+            misfire_grace_time=max(int(DAILY_REPORT_CATCHUP_HOURS * 3600), 1),
+            id='daily_report_catch_up',
+            name='Daily Report Catch-Up Job',
+            replace_existing=True
+        )
+
+    if ROLLUP_ENABLED:
+        # Refresh rollups before the daily report reads yesterday
+        scheduler.add_job(
+            rollup_refresh_job,
+            'cron',
+            hour=0,
+            minute=2,
+            id='rollup_refresh',
+            name='Rollup Refresh Job',
+            replace_existing=True
+        )
+
+    # Add next months' partitions well before rows arrive in them
+    scheduler.add_job(
+        partition_maintenance_job,
+        'cron',
+        hour=3,
+        minute=0,
+        id='partition_maintenance',
+        name='Partition Maintenance Job',
+        replace_existing=True
+    )
+
+    if get_default_backend() is not None:
+        scheduler.add_job(
+            replica_sync_job,
+            'interval',
+            minutes=EMBEDDED_SYNC_MINUTES,
+            next_run_time=datetime.now(),
+            id='replica_sync',
+            name='Embedded Replica Sync Job',
+            replace_existing=True
+        )
+
+
+def remove_leader_jobs(scheduler):
+    """Unschedule the leader jobs after the lease was lost"""
+    for job_id in LEADER_JOB_IDS:
+        if scheduler.get_job(job_id) is not None:
+            scheduler.remove_job(job_id)
+
+
+def add_worker_jobs(scheduler, query_handler=None):
+    """
+    Schedule the jobs that refresh this process's in-memory state
+
+    Args:
+        scheduler: Scheduler to add the jobs to
+        query_handler: The app's query handler, used by the snapshot jobs
+    """
+    if get_default_cube() is not None:
+        # Load the cube right away, then keep it current
+        scheduler.add_job(
+            cube_refresh_job,
+            'interval',
+            seconds=CUBE_REFRESH_SECONDS,
+            next_run_time=datetime.now(),
+            id='cube_refresh',
+            name='Sales Cube Refresh Job',
+            replace_existing=True
+        )
+
+    if get_default_today_counters() is not None:
+        scheduler.add_job(
+            today_counters_job,
+            'interval',
+            seconds=TODAY_REFRESH_SECONDS,
+            next_run_time=datetime.now(),
+            id='today_counters',
+            name='Today Counters Job',
+            replace_existing=True
+        )
+
+    if get_default_replica_set() is not None:
+        # Every process picks replicas from its own checks
+        scheduler.add_job(
+            replica_check_job,
+            'interval',
+            seconds=DB_REPLICA_CHECK_INTERVAL,
+            next_run_time=datetime.now(),
+            id='replica_check',
+            name='Replica Check Job',
+            replace_existing=True
+        )
+
+    if SNAPSHOT_ENABLED:
+        scheduler.add_job(
+            snapshot_job,
+            'interval',
+            args=[query_handler],
+            minutes=SNAPSHOT_INTERVAL_MINUTES,
+            next_run_time=datetime.now(),
+            id='report_snapshots',
+            name='Report Snapshot Job',
+            replace_existing=True
+        )
+        # Snapshots from the previous day stop being served at midnight
+        scheduler.add_job(
+            snapshot_job,
+            'cron',
+            args=[query_handler],
+            hour=0,
+            minute=0,
+            second=30,
+            id='report_snapshots_midnight',
+            name='Report Snapshot Midnight Job',
+            replace_existing=True
+        )
+
+
+def scheduler_lease_job(scheduler, lease):
+    """
+    Scheduler lease job
+    Followers try to take the lease and start the leader jobs when they
+    get it; the leader checks it still holds the lease and stops them
+    when it does not
+    """
+    try:
+        if lease.held:
+            if not lease.renew():
+                remove_leader_jobs(scheduler)
+                print(f"Scheduler lease lost (pid {os.getpid()}), leader jobs stopped")
+        elif lease.acquire():
+            add_leader_jobs(scheduler)
+            print(f"Scheduler lease taken over (pid {os.getpid()}), leader jobs started")
+    except Exception as e:
+        print(f"Error in scheduler lease job: {str(e)}")
+
+
+def is_scheduler_leader():
+    """Whether this process runs the leader jobs"""
+    lease = get_default_lease()
+    return lease is None or lease.held
+
+
+def start_scheduler(lease=None, query_handler=None):
+    """
+    Start the background scheduler for periodic tasks
+
+    Every process refreshes its own in-memory state; the leader jobs run
+    only in the process holding the scheduler lease (see lease.py).
+
+    Args:
+        lease: Lease deciding leadership, defaults to SCHEDULER_LEASE's
+        query_handler: The app's query handler, shared with the snapshot jobs
+
+    Returns:
+        BackgroundScheduler: The scheduler instance
+    """
+    scheduler = BackgroundScheduler()
+    add_worker_jobs(scheduler, query_handler)
+
+    if lease is None:
+        lease = get_default_lease()
+    if lease is None:
+        add_leader_jobs(scheduler)
+    else:
+        if lease.acquire():
+            add_leader_jobs(scheduler)
+        scheduler.add_job(
+            scheduler_lease_job,
+            'interval',
+            seconds=SCHEDULER_LEASE_SECONDS,
+            args=[scheduler, lease],
+            id='scheduler_lease',
+            name='Scheduler Lease Job',
+            replace_existing=True
+        )
+
     scheduler.start()
-    print("Scheduler started. Daily report scheduled for 12:01 AM")
-    
+    if lease is None or lease.held:
+        print(f"Scheduler started as leader (pid {os.getpid()}). Daily report scheduled for 12:05 AM")
+    else:
+        print(f"Scheduler started as follower (pid {os.getpid()})")
+
     return scheduler
@@ -1,28 +1,178 @@
 -- Database schema for eyewear bot
 -- This is a reference schema. Adjust according to your actual database structure.
 
+-- Sales people dimension: reports group on the integer sales_id and show
+-- the current name. Every name a sales person has been written under is an
+-- alias, so renaming someone (Database.rename_sales_person) keeps one history.
+-- Requires SALES_DIMENSION_ENABLED=true.
+CREATE TABLE IF NOT EXISTS `sales_people` (
+  `sales_id` INT AUTO_INCREMENT PRIMARY KEY,
+  `name` VARCHAR(100) NOT NULL,
+  `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  UNIQUE KEY `uk_name` (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `sales_aliases` (
+  `alias` VARCHAR(100) PRIMARY KEY,
+  `sales_id` INT NOT NULL,
+  INDEX `idx_sales_id` (`sales_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
 -- Create leads table
+-- Partitioned by month of leads_date so date-range reports only read the
+-- partitions they need. MySQL requires the partitioning column in every
+-- unique key, hence the composite primary key; leads_id stays the leading
+-- column so lookups by ID still use it. The key only makes (leads_id,
+-- leads_date) unique: MySQL no longer rejects the same leads_id on two
+-- dates, so the loader must not re-insert a lead under a new date (update
+-- it instead); `python migrate.py duplicates` lists any that slipped in.
+-- (leads_date, sales_id) covers the per-sales lead counts without reading rows.
+-- `sales` is the name as written by the source system; triggers below fill
+-- `sales_id` from it.
 CREATE TABLE IF NOT EXISTS `leads` (
-  `leads_id` VARCHAR(50) PRIMARY KEY,
+  `leads_id` VARCHAR(50) NOT NULL,
   `leads_date` DATE NOT NULL,
   `sales` VARCHAR(100) NOT NULL,
+  `sales_id` INT NOT NULL DEFAULT 0,
   `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-  INDEX `idx_leads_date` (`leads_date`),
-  INDEX `idx_sales` (`sales`)
-) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+  PRIMARY KEY (`leads_id`, `leads_date`),
+  INDEX `idx_leads_date_sales_id` (`leads_date`, `sales_id`),
+  INDEX `idx_sales_id` (`sales_id`),
+  INDEX `idx_created_at` (`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+PARTITION BY RANGE COLUMNS(`leads_date`) (
+  PARTITION `p_start` VALUES LESS THAN ('2024-01-01'),
+  PARTITION `p_future` VALUES LESS THAN (MAXVALUE)
+);
 
 -- Create sales_orders table
+-- Partitioned like leads; partitioned InnoDB tables cannot take part in
+-- foreign keys, so leads_id is only indexed.
+-- (order_date, sales_id, sales_price) covers the per-sales and per-day order
+-- counts and revenue without reading rows.
 CREATE TABLE IF NOT EXISTS `sales_orders` (
-  `order_id` INT AUTO_INCREMENT PRIMARY KEY,
+  `order_id` INT AUTO_INCREMENT NOT NULL,
   `order_date` DATE NOT NULL,
   `sales` VARCHAR(100) NOT NULL,
+  `sales_id` INT NOT NULL DEFAULT 0,
   `leads_id` VARCHAR(50) NOT NULL,
   `sales_price` DECIMAL(10, 2) NOT NULL,
   `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-  INDEX `idx_order_date` (`order_date`),
+  PRIMARY KEY (`order_id`, `order_date`),
+  INDEX `idx_order_date_sales_id_price` (`order_date`, `sales_id`, `sales_price`),
   INDEX `idx_leads_id` (`leads_id`),
-  INDEX `idx_sales` (`sales`),
-  FOREIGN KEY (`leads_id`) REFERENCES `leads`(`leads_id`)
+  INDEX `idx_sales_id` (`sales_id`),
+  INDEX `idx_created_at` (`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+PARTITION BY RANGE COLUMNS(`order_date`) (
+  PARTITION `p_start` VALUES LESS THAN ('2024-01-01'),
+  PARTITION `p_future` VALUES LESS THAN (MAXVALUE)
+);
+
+-- Fill sales_id from the sales name, registering new names as new sales people
+DROP PROCEDURE IF EXISTS `resolve_sales_id`;
+DELIMITER //
+CREATE PROCEDURE `resolve_sales_id`(IN p_name VARCHAR(100), OUT p_sales_id INT)
+BEGIN
+  SET p_sales_id = NULL;
+  SELECT `sales_id` INTO p_sales_id FROM `sales_aliases` WHERE `alias` = p_name;
+  IF p_sales_id IS NULL THEN
+    INSERT INTO `sales_people` (`name`) VALUES (p_name)
+      ON DUPLICATE KEY UPDATE `sales_id` = LAST_INSERT_ID(`sales_id`);
+    SET p_sales_id = LAST_INSERT_ID();
+    INSERT IGNORE INTO `sales_aliases` (`alias`, `sales_id`) VALUES (p_name, p_sales_id);
+  END IF;
+END //
+
+CREATE TRIGGER `leads_sales_id_insert` BEFORE INSERT ON `leads` FOR EACH ROW
+BEGIN
+  DECLARE v_sales_id INT;
+  IF NEW.sales_id = 0 THEN
+    CALL resolve_sales_id(NEW.sales, v_sales_id);
+    SET NEW.sales_id = v_sales_id;
+  END IF;
+END //
+
+CREATE TRIGGER `leads_sales_id_update` BEFORE UPDATE ON `leads` FOR EACH ROW
+BEGIN
+  DECLARE v_sales_id INT;
+  IF NEW.sales <> OLD.sales AND NEW.sales_id = OLD.sales_id THEN
+    CALL resolve_sales_id(NEW.sales, v_sales_id);
+    SET NEW.sales_id = v_sales_id;
+  END IF;
+END //
+
+CREATE TRIGGER `sales_orders_sales_id_insert` BEFORE INSERT ON `sales_orders` FOR EACH ROW
+BEGIN
+  DECLARE v_sales_id INT;
+  IF NEW.sales_id = 0 THEN
+    CALL resolve_sales_id(NEW.sales, v_sales_id);
+    SET NEW.sales_id = v_sales_id;
+  END IF;
+END //
+
+CREATE TRIGGER `sales_orders_sales_id_update` BEFORE UPDATE ON `sales_orders` FOR EACH ROW
+BEGIN
+  DECLARE v_sales_id INT;
+  IF NEW.sales <> OLD.sales AND NEW.sales_id = OLD.sales_id THEN
+    CALL resolve_sales_id(NEW.sales, v_sales_id);
+    SET NEW.sales_id = v_sales_id;
+  END IF;
+END //
+DELIMITER ;
+
+-- Monthly partitions are split out of p_future by `python migrate.py partitions`
+-- (also run daily by the scheduler). Run it right after creating the tables
+-- from this file, before loading data: once p_future holds rows the split
+-- has to copy them, and the scheduled run skips it with a warning.
+-- Existing databases are brought to this layout with `python migrate.py up`;
+-- a database created from this file is marked current with
+-- `python migrate.py baseline`.
+
+-- Migrations applied by migrate.py
+CREATE TABLE IF NOT EXISTS `schema_migrations` (
+  `version` VARCHAR(100) PRIMARY KEY,
+  `applied_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Daily rollup of closed days, one row per (day, sales_id)
+-- Maintained by rollup_refresh_job in scheduler.py; never holds today
+CREATE TABLE IF NOT EXISTS `daily_sales_stats` (
+  `day` DATE NOT NULL,
+  `sales_id` INT NOT NULL,
+  `leads_count` INT NOT NULL DEFAULT 0,
+  `orders_count` INT NOT NULL DEFAULT 0,
+  `total_sales` DECIMAL(14, 2) NOT NULL DEFAULT 0,
+  `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`day`, `sales_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Monthly rollup built from daily_sales_stats; `month` is the first day of the month
+CREATE TABLE IF NOT EXISTS `monthly_sales_stats` (
+  `month` DATE NOT NULL,
+  `sales_id` INT NOT NULL,
+  `leads_count` INT NOT NULL DEFAULT 0,
+  `orders_count` INT NOT NULL DEFAULT 0,
+  `total_sales` DECIMAL(16, 2) NOT NULL DEFAULT 0,
+  `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`month`, `sales_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Days whose rollup rows are complete. Reports only read rollups for the last
+-- unbroken run of logged days; everything else is scanned from the raw tables
+CREATE TABLE IF NOT EXISTS `rollup_refresh_log` (
+  `day` DATE PRIMARY KEY,
+  `refreshed_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Scheduled reports already sent, one row per (report, day covered)
+-- A scheduler leader that takes over after the send time checks it and
+-- sends a report the previous leader missed
+CREATE TABLE IF NOT EXISTS `report_runs` (
+  `report` VARCHAR(50) NOT NULL,
+  `day` DATE NOT NULL,
+  `sent_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`report`, `day`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 -- Sample data for testing (optional)
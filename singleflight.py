@@ -0,0 +1,94 @@
+"""
+Request coalescing module
+"""
+import threading
+
+
+class FollowerTimeoutError(TimeoutError):
+    """A caller gave up waiting on a shared call before it finished"""
+
+
+class _Call:
+    """An in-flight computation that other callers can wait on"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one execution
+
+    The first caller for a key runs the function; callers arriving while it
+    is still running wait for it, at most ``timeout`` seconds, and receive
+    the same result (or exception). Nothing is cached once the call
+    completes.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.collapsed = 0
+
+    def do(self, key, func, timeout=None):
+        """
+        Run ``func`` once for all concurrent callers using ``key``
+
+        Args:
+            key: Hashable identity of the computation
+            func: Zero-argument callable
+            timeout: Seconds a caller joining a running call waits for it,
+                or None to wait until it finishes. The caller running
+                ``func`` bounds it itself (e.g. with a query deadline).
+
+        Returns:
+            The result of the shared call
+
+        Raises:
+            FollowerTimeoutError: If the shared call did not finish within timeout
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.collapsed += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            if not call.event.wait(timeout):
+                raise FollowerTimeoutError(f"Shared call did not finish within {timeout:.1f}s")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def stats(self):
+        """
+        Get coalescing counters
+
+        Returns:
+            dict: Executed calls, collapsed calls and calls currently in flight
+        """
+        with self._lock:
+            return {
+                'executed': self.executed,
+                'collapsed': self.collapsed,
+                'in_flight': len(self._calls),
+            }
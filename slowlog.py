@@ -0,0 +1,132 @@
+"""
+Slow query log for the report database
+
+When SLOW_QUERY_MS is set, pooled connections hand out cursors whose
+``execute`` is timed; statements over the threshold, including those that
+fail (a query timeout is usually the slowest statement of all), are logged
+with their parameters, duration and row count or error, and the most
+recent ones are kept for
+/debug/slow_queries. With the threshold at 0 the pool opens plain pymysql
+connections, so nothing is timed.
+"""
+import logging
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+import pymysql
+from config import SLOW_QUERY_MS, SLOW_QUERY_LOG_SIZE
+from metrics import SLOW_QUERIES
+
+
+class SlowQueryLog:
+    """Keeps the most recent statements that ran longer than ``threshold_ms``"""
+
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, size=SLOW_QUERY_LOG_SIZE):
+        self.threshold_ms = threshold_ms
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.recorded = 0
+
+    def record(self, sql, params, duration_ms, rows, error=None):
+        """
+        Note a statement's duration, keeping it if it exceeds the threshold
+
+        Args:
+            sql: Statement as passed to ``cursor.execute``
+            params: Its parameters
+            duration_ms: Execution time in milliseconds
+            rows: Rows returned or affected (None when it failed)
+            error: Class name of the exception it raised, if any
+        """
+        if duration_ms < self.threshold_ms:
+            return
+        sql = re.sub(r'\s+', ' ', sql).strip()
+        entry = {
+            'at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'sql': sql,
+            'params': repr(params),
+            'duration_ms': round(duration_ms, 1),
+            'rows': rows,
+            'error': error,
+        }
+        with self._lock:
+            self._entries.append(entry)
+            self.recorded += 1
+        SLOW_QUERIES.inc()
+        outcome = f"error={error}" if error is not None else f"rows={rows}"
+        logging.warning(f"慢查询 {entry['duration_ms']}ms {outcome}: {sql} params={entry['params']}")
+
+    def entries(self):
+        """
+        Get the kept slow statements
+
+        Returns:
+            list: Entries, most recent first
+        """
+        with self._lock:
+            return list(reversed(self._entries))
+
+    def stats(self):
+        with self._lock:
+            return {'threshold_ms': self.threshold_ms, 'recorded': self.recorded, 'kept': len(self._entries)}
+
+
+_timed_cursor_classes = {}
+
+
+def timed_cursor_class(base, log):
+    """
+    Subclass a pymysql cursor class so that ``execute`` reports to ``log``
+
+    Args:
+        base: Cursor class, e.g. pymysql.cursors.DictCursor
+        log: SlowQueryLog
+
+    Returns:
+        type: Cursor class (one per base class and log)
+    """
+    key = (base, id(log))
+    cls = _timed_cursor_classes.get(key)
+    if cls is None:
+        def execute(self, query, args=None):
+            started = time.perf_counter()
+            rows = error = None
+            try:
+                rows = base.execute(self, query, args)
+                return rows
+            except BaseException as e:
+                error = type(e).__name__
+                raise
+            finally:
+                log.record(query, args, (time.perf_counter() - started) * 1000, rows, error)
+        cls = type(f"Timed{base.__name__}", (base,), {'execute': execute})
+        _timed_cursor_classes[key] = cls
+    return cls
+
+
+class TimedConnection(pymysql.connections.Connection):
+    """pymysql connection whose cursors report slow statements"""
+
+    def __init__(self, *args, slow_query_log, **kwargs):
+        self.slow_query_log = slow_query_log
+        super().__init__(*args, **kwargs)
+
+    def cursor(self, cursor=None):
+        return super().cursor(timed_cursor_class(cursor or self.cursorclass, self.slow_query_log))
+
+
+_default_log = None
+_default_log_lock = threading.Lock()
+
+
+def get_default_slow_query_log():
+    """Return the process-wide slow query log, or None when SLOW_QUERY_MS is 0"""
+    global _default_log
+    if SLOW_QUERY_MS <= 0:
+        return None
+    with _default_log_lock:
+        if _default_log is None:
+            _default_log = SlowQueryLog()
+        return _default_log
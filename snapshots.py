@@ -0,0 +1,113 @@
+"""
+Pre-rendered report snapshots for the standard menu commands, and the
+last good report per query served while the database fails
+"""
+import threading
+import time
+from datetime import datetime
+from config import SNAPSHOT_ENABLED, SNAPSHOT_MAX_AGE, LAST_GOOD_MAX_AGE
+
+
+class SnapshotStore:
+    """
+    Latest rendered report per command
+
+    Each snapshot remembers the day it was rendered on and when its figures
+    were read, so a report is never served across midnight or once it is
+    older than ``max_age`` seconds.
+    """
+
+    def __init__(self, max_age=SNAPSHOT_MAX_AGE):
+        self.max_age = max_age
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, command, message, age_seconds=None, day=None):
+        """
+        Store a rendered report
+
+        Args:
+            command: Command key, e.g. 'today'
+            message: Rendered report
+            age_seconds: How old the figures already were when rendered
+            day: Day the report was rendered for, defaults to today; pass
+                the day the builder used so a report rendered just before
+                midnight is not served as the next day's
+        """
+        data_time = time.time() - (age_seconds or 0)
+        day = day or datetime.now().date()
+        with self._lock:
+            self._snapshots[command] = (message, day, data_time)
+
+    def get(self, command, max_age=None):
+        """
+        Get a stored report if it is still valid
+
+        Args:
+            command: Command key
+            max_age: Override for the maximum age in seconds
+
+        Returns:
+            tuple: (message, age_seconds), or None if there is no valid snapshot
+        """
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            snapshot = self._snapshots.get(command)
+            if snapshot is not None:
+                message, day, data_time = snapshot
+                age = time.time() - data_time
+                if day == datetime.now().date() and age <= max_age:
+                    self.hits += 1
+                    return message, age
+            self.misses += 1
+            return None
+
+    def stats(self):
+        """
+        Get snapshot ages and hit/miss counters
+
+        Returns:
+            dict: Age in seconds of each stored snapshot plus counters
+        """
+        now = time.time()
+        with self._lock:
+            return {
+                'ages': {command: round(now - data_time, 1)
+                         for command, (_, _, data_time) in self._snapshots.items()},
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_default_snapshot_store():
+    """Return the process-wide snapshot store, or None when snapshots are disabled"""
+    global _default_store
+    if not SNAPSHOT_ENABLED:
+        return None
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = SnapshotStore()
+        return _default_store
+
+
+_last_good_store = None
+
+
+def get_default_last_good_store():
+    """
+    Return the process-wide store of the last successfully computed report
+    per query, served while the database fails; None when LAST_GOOD_MAX_AGE is 0
+    """
+    global _last_good_store
+    if LAST_GOOD_MAX_AGE <= 0:
+        return None
+    with _default_store_lock:
+        if _last_good_store is None:
+            _last_good_store = SnapshotStore(max_age=LAST_GOOD_MAX_AGE)
+        return _last_good_store
@@ -87,6 +87,2102 @@ def test_message_formatter():
     return True
 
 
+class _FakeReportCursor:
+    """DictCursor stand-in that answers the report SQL from in-memory rows"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @staticmethod
+    def _group(rows, date_key, start, end, with_price):
+        groups = {}
+        for row in rows:
+            if start <= row[date_key] <= end:
+                g = groups.setdefault(row['sales'], [0, 0])
+                g[0] += 1
+                if with_price:
+                    g[1] += row['sales_price']
+        return groups
+
+    def execute(self, sql, params):
+        from decimal import Decimal
+        self.conn.statements.append(sql)
+        self.conn.params.append(params)
+        leads = self._group(self.conn.leads, 'leads_date', params[0], params[1], False)
+        if 'WITH ROLLUP' in sql:
+            # MySQL 5.7 returns ROLLUP groups sorted by the group column
+            orders = self._group(self.conn.orders, 'order_date', params[2], params[3], True)
+            rows = []
+            for source, groups in (('leads', leads), ('orders', orders)):
+                for sales in sorted(groups):
+                    cnt, price = groups[sales]
+                    rows.append({'source': source, 'sales': sales, 'row_count': cnt,
+                                 'total_sales': Decimal(price) if source == 'orders' else None})
+                if groups:
+                    rows.append({'source': source, 'sales': None,
+                                 'row_count': sum(g[0] for g in groups.values()),
+                                 'total_sales': Decimal(sum(g[1] for g in groups.values()))
+                                 if source == 'orders' else None})
+            self._rows = rows
+        elif 'total_leads' in sql:
+            self._rows = [{'total_leads': sum(g[0] for g in leads.values())}]
+        elif 'leads_count' in sql:
+            self._rows = [{'sales': k, 'leads_count': v[0]}
+                          for k, v in sorted(leads.items(), key=lambda kv: (-kv[1][0], kv[0]))]
+        else:
+            orders = self._group(self.conn.orders, 'order_date', params[0], params[1], True)
+            if 'total_orders' in sql:
+                self._rows = [{'total_orders': sum(g[0] for g in orders.values())}]
+            else:
+                self._rows = [{'sales': k, 'orders_count': v[0], 'total_sales': Decimal(v[1])}
+                              for k, v in sorted(orders.items(), key=lambda kv: (-kv[1][0], kv[0]))]
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+
+class _FakeReportPool:
+    """Connection pool stand-in that records every executed statement"""
+
+    def __init__(self, leads, orders):
+        self.leads = leads
+        self.orders = orders
+        self.statements = []
+        self.params = []
+
+    def cursor(self, *args):
+        return _FakeReportCursor(self)
+
+    def connection(self):
+        from contextlib import nullcontext
+        return nullcontext(self)
+
+
+def test_combined_stats_parity():
+    """Test the fused combined query matches the four-query implementation"""
+    from database import Database
+    from cache import ResultCache
+    from decimal import Decimal
+
+    print("\nTesting combined stats parity...")
+
+    day = datetime(2024, 1, 15).date()
+    leads = [{'leads_date': day + timedelta(days=i % 3), 'sales': s}
+             for i, s in enumerate(['张三', '李四', '张三', '王五', '李四', '张三', '赵六'])]
+    orders = [{'order_date': day + timedelta(days=i % 2), 'sales': s, 'sales_price': Decimal(p)}
+              for i, (s, p) in enumerate([('张三', 1500), ('李四', 2300), ('张三', 800), ('王五', 990)])]
+
+    for start, end in [(day, day), (day, day + timedelta(days=2)), (day - timedelta(days=9), day - timedelta(days=1))]:
+        pool = _FakeReportPool(leads, orders)
+        db = Database(pool=pool, cache=ResultCache())
+        fused = db.get_combined_stats(start, end)
+        if len(pool.statements) != 1:
+            print(f"✗ Fused query used {len(pool.statements)} statements - FAIL")
+            return False
+        legacy = {
+            'leads': db.get_leads_stats(start, end),
+            'orders': db.get_orders_stats(start, end),
+            'start_date': start.strftime('%Y-%m-%d'),
+            'end_date': end.strftime('%Y-%m-%d')
+        }
+        if fused != legacy:
+            print(f"✗ Parity {start} ~ {end}: {fused} != {legacy} - FAIL")
+            return False
+        print(f"✓ Parity {start} ~ {end} in one statement - PASS")
+
+    return True
+
+
+def test_sales_dimension():
+    """Test grouping by sales_id and resolving names before results are built"""
+    from database import Database
+    from sales_directory import SalesDirectory
+    from cache import ResultCache
+    from decimal import Decimal
+
+    print("\nTesting sales dimension...")
+
+    day = datetime(2024, 1, 15).date()
+    # 2 was renamed from 李四 to 李思; all of their rows share the ID
+    leads = [{'leads_date': day, 'sales': s} for s in [1, 2, 2, 3, 1]]
+    orders = [{'order_date': day, 'sales': s, 'sales_price': Decimal(p)}
+              for s, p in [(2, 500), (1, 800)]]
+    pool = _FakeReportPool(leads, orders)
+    db = Database(pool=pool, cache=ResultCache(), sales_directory=SalesDirectory())
+    loads = []
+    db._load_sales_people = lambda: loads.append(1) or {1: '张三', 2: '李思', 3: '王五'}
+
+    stats = db.get_combined_stats(day, day)
+    leads_order = [(r['sales'], r['leads_count']) for r in stats['leads']['by_sales']]
+    if leads_order != [('张三', 2), ('李思', 2), ('王五', 1)] or 'GROUP BY sales_id' not in pool.statements[0]:
+        print(f"✗ Grouped by sales_id: {leads_order} - FAIL")
+        return False
+    print("✓ Grouped by sales_id, names resolved - PASS")
+
+    db.get_combined_stats(day - timedelta(days=1), day)
+    if len(loads) != 1 or len(pool.statements) != 2:
+        print(f"✗ Name mapping loaded {len(loads)} times - FAIL")
+        return False
+    print("✓ Name mapping cached - PASS")
+
+    return True
+
+
+def test_embedded_backend():
+    """Test the embedded replica answers closed days with the same totals as MySQL"""
+    import tempfile
+    import os
+    from database import Database
+    from backends import EmbeddedBackend
+    from cache import ResultCache
+    from decimal import Decimal
+
+    print("\nTesting embedded backend...")
+
+    today = datetime.now().date()
+    leads = [{'leads_id': f'L{i}', 'leads_date': today - timedelta(days=i % 12), 'sales': s}
+             for i, s in enumerate(['张三', '李四', '张三', '王五', '李四', '张三', '赵六'] * 3)]
+    orders = [{'order_id': i, 'order_date': today - timedelta(days=i % 9), 'sales': s, 'sales_price': Decimal(p)}
+              for i, (s, p) in enumerate([('张三', 1500), ('李四', 2300), ('张三', 800), ('王五', 990)] * 3)]
+
+    class _Source:
+        sales_column = 'sales'
+
+        def export_fact_rows(self, start, end):
+            return ([(r['leads_date'], r['sales'], r['leads_id']) for r in leads if start <= r['leads_date'] <= end],
+                    [(r['order_date'], r['sales'], r['sales_price'] * 100, r['order_id'])
+                     for r in orders if start <= r['order_date'] <= end])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        backend = EmbeddedBackend(os.path.join(tmp, 'replica.db'), 'sqlite')
+        days = backend.sync(_Source(), history_days=30)
+        if days != 30 or backend.coverage() != (today - timedelta(days=30), today - timedelta(days=1)):
+            print(f"✗ Sync coverage: {days} {backend.coverage()} - FAIL")
+            return False
+        print("✓ Closed days synced - PASS")
+
+        start = today - timedelta(days=13)
+        mysql_only = Database(pool=_FakeReportPool(leads, orders), cache=ResultCache(), backend=None)
+        pool = _FakeReportPool(leads, orders)
+        routed = Database(pool=pool, cache=ResultCache(), backend=backend)
+        expected = mysql_only.get_combined_stats(start, today)
+        actual = routed.get_combined_stats(start, today)
+        # Only today went to MySQL
+        if actual != expected or len(pool.statements) != 1 or tuple(pool.params[0][:2]) != (today, today):
+            print(f"✗ Routed stats: {actual} != {expected} - FAIL")
+            return False
+        print("✓ Long range read from the replica, today from MySQL - PASS")
+        backend.close()
+
+    import config
+    saved = config.EMBEDDED_BACKEND, config.GUNICORN_WORKERS
+    config.EMBEDDED_BACKEND, config.GUNICORN_WORKERS = 'duckdb', 4
+    try:
+        config.check_config()
+        print("✗ DuckDB with several gunicorn workers was accepted - FAIL")
+        return False
+    except ValueError:
+        print("✓ DuckDB with several gunicorn workers is refused - PASS")
+    finally:
+        config.EMBEDDED_BACKEND, config.GUNICORN_WORKERS = saved
+    return True
+
+
+def test_parquet_archive():
+    """Test the Parquet archive appends settled days and aggregates them like the replica"""
+    import tempfile
+    import os
+    from archive import ParquetArchive, pa
+    from backends import EmbeddedBackend
+    from decimal import Decimal
+
+    print("\nTesting Parquet archive...")
+    if pa is None:
+        print("⚠ pyarrow not installed - SKIP")
+        return True
+
+    today = datetime.now().date()
+    leads = [(today - timedelta(days=i % 20), s, f'L{i}')
+             for i, s in enumerate(['张三', '李四', '张三', '王五'] * 5)]
+    orders = [(today - timedelta(days=i % 15), s, p * 100, i)
+              for i, (s, p) in enumerate([('张三', 1500), ('李四', 2300), ('王五', 990)] * 4)]
+    exported = []
+
+    class _Source:
+        sales_column = 'sales'
+
+        def export_fact_rows(self, start, end):
+            exported.append((start, end))
+            return ([r for r in leads if start <= r[0] <= end], [r for r in orders if start <= r[0] <= end])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = ParquetArchive(os.path.join(tmp, 'archive'), settle_days=2)
+        replica = EmbeddedBackend(os.path.join(tmp, 'replica.db'), 'sqlite')
+        archive.sync(_Source(), history_days=30)
+        replica.sync(_Source(), history_days=30)
+        exported.clear()
+        if archive.sync(_Source(), history_days=30) != 0 or exported:
+            print("✗ Second export re-read archived days - FAIL")
+            return False
+        print("✓ Only new days are exported - PASS")
+
+        start, end = today - timedelta(days=25), today - timedelta(days=2)
+        sort_rows = lambda rows: sorted(rows, key=lambda r: (str(r.get('day')), r['sales']))
+        if (sort_rows(archive.sales_rows(start, end)) != sort_rows(replica.sales_rows(start, end))
+                or archive.daily_totals(start, end) != replica.daily_totals(start, end)
+                or sort_rows(archive.daily_sales_rows(start, end)) != sort_rows(replica.daily_sales_rows(start, end))):
+            print("✗ Archive aggregates differ from the replica - FAIL")
+            return False
+        print("✓ Archive aggregates match the replica - PASS")
+        replica.close()
+
+    return True
+
+
+def test_rollup_segments():
+    """Test splitting a date range into month, edge-day and raw segments"""
+    from database import _plan_rollup_segments
+    from datetime import date
+
+    print("\nTesting rollup segment planning...")
+
+    cases = [
+        # 最近365天 with rollups up to yesterday: months + edge days + today raw
+        ((date(2024, 1, 10), date(2024, 12, 31), date(2023, 1, 1), date(2024, 12, 30)),
+         ((date(2024, 2, 1), date(2024, 11, 1)),
+          [(date(2024, 1, 10), date(2024, 1, 31)), (date(2024, 12, 1), date(2024, 12, 30))],
+          [(date(2024, 12, 31), date(2024, 12, 31))]), "long range"),
+        ((date(2024, 3, 1), date(2024, 3, 31), date(2023, 1, 1), date(2024, 12, 30)),
+         ((date(2024, 3, 1), date(2024, 3, 1)), [], []), "closed month"),
+        ((date(2024, 3, 5), date(2024, 3, 20), date(2024, 3, 10), date(2024, 3, 15)),
+         (None, [(date(2024, 3, 10), date(2024, 3, 15))],
+          [(date(2024, 3, 5), date(2024, 3, 9)), (date(2024, 3, 16), date(2024, 3, 20))]), "partial coverage"),
+        ((date(2024, 12, 31), date(2024, 12, 31), date(2023, 1, 1), date(2024, 12, 30)),
+         (None, [], [(date(2024, 12, 31), date(2024, 12, 31))]), "today only"),
+    ]
+
+    for args, expected, description in cases:
+        if _plan_rollup_segments(*args) == expected:
+            print(f"✓ {description} - PASS")
+        else:
+            print(f"✗ {description}: {_plan_rollup_segments(*args)} - FAIL")
+            return False
+
+    return True
+
+
+class RecordingPool:
+    """Connection pool stand-in that records statements and returns no rows"""
+
+    def __init__(self, rows=None):
+        self.statements = []
+        self.rows = rows or {}
+
+    def connection(self):
+        from contextlib import contextmanager
+        pool = self
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def execute(self, sql, params=None):
+                pool.statements.append((sql, params))
+                self.last = sql
+
+            def fetchall(self):
+                return [dict(row) for key, rows in pool.rows.items() if key in self.last for row in rows]
+
+            def fetchone(self):
+                rows = self.fetchall()
+                return rows[0] if rows else None
+
+        class Connection:
+            def cursor(self, *args):
+                return Cursor()
+
+            def begin(self):
+                pass
+
+            def commit(self):
+                pass
+
+            def rollback(self):
+                pass
+
+        @contextmanager
+        def borrow():
+            yield Connection()
+        return borrow()
+
+    def stats(self):
+        return {}
+
+
+def test_rollup_schema_columns():
+    """Test that the rollup SQL only uses columns schema.sql defines, with and without the sales dimension"""
+    import os
+    import re
+    import database
+    from database import Database
+
+    print("\nTesting rollup SQL against schema.sql...")
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql'), encoding='utf-8') as f:
+        schema = f.read()
+    columns = {}
+    for table in ('daily_sales_stats', 'monthly_sales_stats'):
+        body = re.search(r"CREATE TABLE IF NOT EXISTS `%s` \((.*?)\n\)" % table, schema, re.S).group(1)
+        columns[table] = set(re.findall(r"^\s*`(\w+)`", body, re.M))
+
+    def used_columns(sql):
+        """(table, column) pairs a statement reads from or writes to the rollup tables"""
+        used = set()
+        for table, cols in re.findall(r"INSERT INTO (\w+_sales_stats) \(([^)]*)\)", sql):
+            used.update((table, c.strip()) for c in cols.split(','))
+        for select, table, rest in re.findall(r"SELECT ((?:(?!SELECT).)*?)\s+FROM (\w+_sales_stats)\b(.*?)(?:\)|UNION|$)",
+                                              sql, re.S):
+            for item in select.split(','):
+                expr = re.sub(r"\s+AS\s+\w+$", '', item.strip())
+                expr = re.sub(r"^SUM\((.*)\)$", r"\1", expr)
+                if re.fullmatch(r"[a-z_]+", expr):
+                    used.add((table, expr))
+            used.update((table, c) for c in re.findall(r"GROUP BY (\w+)", rest))
+        return used
+
+    start, end = datetime(2024, 1, 10).date(), datetime(2024, 3, 20).date()
+    coverage = (datetime(2023, 1, 1).date(), datetime(2024, 3, 31).date())
+    saved = database.ROLLUP_ENABLED
+    database.ROLLUP_ENABLED = True
+    try:
+        for sales_column in ('sales', 'sales_id'):
+            pool = RecordingPool()
+            db = Database(pool=pool, cache=None, cube=None, backend=None, replicas=None)
+            db.sales_column = sales_column
+            db.breaker = None
+            db._get_rollup_coverage = lambda: coverage
+            db._get_combined_stats_from_rollups(start, end, coverage)
+            db._get_daily_totals_from_rollups(start, end, coverage)
+            db.get_daily_sales_rows(start, end)
+            db.refresh_rollups(end, end)
+            used = set()
+            for sql, _ in pool.statements:
+                used |= used_columns(sql)
+            unknown = sorted(f"{table}.{column}" for table, column in used if column not in columns[table])
+            if unknown or ('daily_sales_stats', 'sales_id') not in used:
+                print(f"✗ {sales_column} mode uses unknown rollup columns: {unknown} - FAIL")
+                return False
+            print(f"✓ {sales_column} mode: {len(used)} rollup columns, all in schema.sql - PASS")
+    finally:
+        database.ROLLUP_ENABLED = saved
+
+    import config
+    saved = config.ROLLUP_ENABLED, config.SALES_DIMENSION_ENABLED
+    config.ROLLUP_ENABLED, config.SALES_DIMENSION_ENABLED = True, False
+    try:
+        config.check_config()
+        print("✗ ROLLUP_ENABLED without the sales dimension was accepted - FAIL")
+        return False
+    except ValueError:
+        print("✓ ROLLUP_ENABLED without the sales dimension is refused - PASS")
+    finally:
+        config.ROLLUP_ENABLED, config.SALES_DIMENSION_ENABLED = saved
+    return True
+
+
+def test_rollup_refresh_range():
+    """Test that the rollup refresh fills days missed since the last refresh"""
+    import scheduler
+
+    print("\nTesting rollup refresh range...")
+
+    yesterday = datetime.now().date() - timedelta(days=1)
+    lookback_start = yesterday - timedelta(days=max(scheduler.ROLLUP_REFRESH_LOOKBACK_DAYS, 1) - 1)
+    cases = [
+        (None, lookback_start, "no refresh yet: lookback only"),
+        (yesterday - timedelta(days=1), lookback_start, "refreshed up to the day before: lookback only"),
+        (yesterday - timedelta(days=10), yesterday - timedelta(days=9), "missed days are filled in"),
+    ]
+
+    class FakeDatabase:
+        last_day = None
+        refreshed = None
+
+        def get_last_rollup_day(self):
+            return self.last_day
+
+        def refresh_rollups(self, start_date, end_date):
+            FakeDatabase.refreshed = (start_date, end_date)
+            return (end_date - start_date).days + 1
+
+    original = scheduler.Database
+    scheduler.Database = FakeDatabase
+    try:
+        for last_day, expected, description in cases:
+            FakeDatabase.last_day = last_day
+            scheduler.rollup_refresh_job()
+            if FakeDatabase.refreshed != (expected, yesterday):
+                print(f"✗ {description}: {FakeDatabase.refreshed} - FAIL")
+                return False
+            print(f"✓ {description} - PASS")
+    finally:
+        scheduler.Database = original
+
+    from database import Database
+    run = (yesterday - timedelta(days=5), yesterday - timedelta(days=1))
+    pool = RecordingPool({'rollup_refresh_log': [{'first_day': run[0], 'last_day': run[1]}]})
+    db = Database(pool=pool, cache=None, cube=None, backend=None, replicas=None)
+    db.breaker = None
+    if db._get_rollup_coverage() != run:
+        print("✗ Coverage read from rollup_refresh_log - FAIL")
+        return False
+
+    # Same statement on SQLite, whose date arithmetic is spelled differently
+    import sqlite3
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE rollup_refresh_log (day TEXT PRIMARY KEY)")
+    logged = [1, 2, 3, 6, 7, 8]
+    conn.executemany("INSERT INTO rollup_refresh_log VALUES (?)", [(f"2024-01-0{d}",) for d in logged])
+    sql = pool.statements[0][0].replace("l.day - INTERVAL 1 DAY", "date(l.day, '-1 day')")
+    if conn.execute(sql).fetchone() != ('2024-01-06', '2024-01-08'):
+        print("✗ Coverage is the last unbroken run of logged days - FAIL")
+        return False
+    print("✓ Coverage is the last unbroken run of logged days - PASS")
+    return True
+
+
+def test_today_counters():
+    """Test the today counters: one-snapshot baseline, late commits and no double counting"""
+    from decimal import Decimal
+    from database import Database
+    from today_counters import TodayCounters
+
+    print("\nTesting today counters...")
+
+    today = datetime.now().date()
+    now = datetime.now().replace(microsecond=0)
+
+    pool = RecordingPool({
+        'MAX(order_id)': [{'max_id': 10, 'max_created': now}],
+        'max_created FROM leads': [{'max_created': None}],
+        'SELECT order_id, created_at FROM sales_orders': [{'order_id': 10, 'created_at': now}],
+    })
+    db = Database(pool=pool, cache=None, cube=None, backend=None, replicas=None)
+    db.sales_directory = None
+    db.breaker = None
+    baseline = db.get_today_baseline(today, 5, 30)
+    first = pool.statements[0][0] if pool.statements else None
+    if first != "START TRANSACTION WITH CONSISTENT SNAPSHOT" or baseline['recent_order_ids'] != {10: now} \
+            or baseline['order_hwm_id'] != 10:
+        print(f"✗ Baseline reads start one consistent snapshot: {first}, {baseline} - FAIL")
+        return False
+    print("✓ Baseline reads start one consistent snapshot - PASS")
+
+    def order(order_id, seconds_ago, price=100):
+        return {'order_id': order_id, 'order_date': today, 'sales': '张三', 'sales_price': Decimal(price),
+                'created_at': now - timedelta(seconds=seconds_ago)}
+
+    class FakeDatabase:
+        """Orders visible to the counters: 10 at the baseline, 9 commits late, then 11"""
+
+        def __init__(self):
+            self.committed = [order(10, 3)]
+
+        def get_today_baseline(self, day, leads_overlap_seconds, orders_overlap_seconds):
+            return {
+                'order_hwm_id': 10,
+                'order_hwm_created_at': now - timedelta(seconds=3),
+                'lead_hwm_created_at': None,
+                'rows': [{'sales': '张三', 'leads_count': 0, 'orders_count': 1, 'total_sales': Decimal(100)}],
+                'recent_lead_ids': {},
+                'recent_order_ids': {10: now - timedelta(seconds=3)},
+            }
+
+        def get_rows_since(self, order_created_at, lead_created_at):
+            rows = [row for row in self.committed if row['created_at'] >= order_created_at]
+            return sorted(rows, key=lambda r: (r['created_at'], r['order_id'])), []
+
+    fake = FakeDatabase()
+    counters = TodayCounters(resync_seconds=3600, orders_overlap_seconds=30)
+    counters.refresh(fake)
+    fake.committed.append(order(9, 5))
+    counters.refresh(fake)
+    fake.committed.append(order(11, 1))
+    counters.refresh(fake)
+    counters.refresh(fake)
+    stats, _ = counters.get_stats()
+    if stats['orders']['total_orders'] != 3 or counters.order_hwm_id != 11:
+        print(f"✗ Late commit counted once: {stats['orders']} - FAIL")
+        return False
+    print("✓ An order committed after a higher ID is counted, and only once - PASS")
+    return True
+
+
+def test_sales_cube():
+    """Test cube sums against raw rows across a slide, a late row and an invalidated day"""
+    import random
+    from datetime import date
+    from decimal import Decimal
+    import sales_cube
+    from sales_cube import SalesCube
+
+    print("\nTesting sales cube...")
+
+    if sales_cube.np is None:
+        print("✓ numpy not installed, cube disabled - SKIP")
+        return True
+
+    rng = random.Random(7)
+    raw = {}
+
+    def add_rows(day):
+        for sales in ('张三', '李四', '王五'):
+            if rng.random() < 0.8:
+                raw[(day, sales)] = [rng.randint(0, 9), rng.randint(0, 5), Decimal(rng.randint(0, 99999)) / 100]
+
+    class RecordingCache:
+        def __init__(self):
+            self.dropped = []
+
+        def invalidate(self, start_date=None, end_date=None):
+            self.dropped.append(start_date)
+            return 0
+
+    class RawDatabase:
+        def __init__(self):
+            self.cache = RecordingCache()
+
+        def get_daily_sales_rows(self, start_date, end_date):
+            return [
+                {'day': day, 'sales': sales, 'leads_count': v[0], 'orders_count': v[1], 'total_sales': v[2]}
+                for (day, sales), v in raw.items() if start_date <= day <= end_date
+            ]
+
+    def raw_totals(start_date, end_date):
+        totals = {}
+        for (day, sales), v in raw.items():
+            if start_date <= day <= end_date:
+                t = totals.setdefault(sales, [0, 0, Decimal(0)])
+                t[0], t[1], t[2] = t[0] + v[0], t[1] + v[1], t[2] + v[2]
+        return {sales: t for sales, t in totals.items() if t[0] or t[1]}
+
+    today = [date(2024, 3, 1)]
+
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.combine(today[0], datetime.min.time())
+
+    def matches(cube, start_date, end_date):
+        rows = cube.range_rows(start_date, end_date)
+        got = {r['sales']: [r['leads_count'], r['orders_count'], r['total_sales']] for r in rows}
+        leads_by_day, orders_by_day = cube.daily_totals(start_date, end_date)
+        return got == raw_totals(start_date, end_date) \
+            and sum(leads_by_day.values()) == sum(t[0] for t in got.values())
+
+    original = sales_cube.datetime
+    sales_cube.datetime = FrozenDatetime
+    try:
+        cube = SalesCube(days=20)
+        db = RawDatabase()
+        for i in range(30):
+            add_rows(today[0] - timedelta(days=i + 1))
+        cube.refresh(db)
+        first, last = cube.first_day, cube.last_day
+        if not (matches(cube, first, last) and matches(cube, first + timedelta(days=3), last - timedelta(days=5))):
+            print("✗ Sums match the raw rows after loading - FAIL")
+            return False
+        if cube.range_rows(first - timedelta(days=1), last) is not None or cube.daily_totals(first, today[0]) is not None:
+            print("✗ Ranges outside the cube are refused - FAIL")
+            return False
+        print("✓ Sums match the raw rows; ranges outside the cube are refused - PASS")
+
+        # Next day: yesterday's rows, a late row two days back, and a back-dated fix
+        add_rows(today[0])
+        raw[(today[0] - timedelta(days=2), '赵六')] = [4, 2, Decimal('123.45')]
+        old_day = today[0] - timedelta(days=10)
+        raw[(old_day, '张三')] = [1, 1, Decimal('1.00')]
+        cube.invalidate(old_day)
+        if cube.range_rows(old_day - timedelta(days=1), old_day + timedelta(days=1)) is not None \
+                or cube.daily_totals(old_day, old_day) is not None:
+            print("✗ Range with an invalidated day answered from the cube - FAIL")
+            return False
+        db.cache.dropped.clear()
+        today[0] += timedelta(days=1)
+        cube.refresh(db)
+        if sorted(db.cache.dropped) != [old_day, today[0] - timedelta(days=3)]:
+            print(f"✗ Refresh dropped cached results of {db.cache.dropped} - FAIL")
+            return False
+        if cube.first_day != first + timedelta(days=1) or not matches(cube, cube.first_day, cube.last_day) \
+                or not matches(cube, old_day, old_day):
+            print("✗ Sums match the raw rows after a slide and reload - FAIL")
+            return False
+        print("✓ Invalidated days go to SQL until reloaded; changed days leave the result cache - PASS")
+        print("✓ Sums match the raw rows after a slide, a late row and an invalidated day - PASS")
+    finally:
+        sales_cube.datetime = original
+    return True
+
+
+def test_migration_helpers():
+    """Test SQL script splitting and monthly partition clauses"""
+    from migrate import split_sql, month_partitions
+    from datetime import date
+
+    print("\nTesting migration helpers...")
+
+    script = """
+    -- covering index
+    ALTER TABLE leads
+      ADD INDEX idx_leads_date_sales (leads_date, sales);
+    DROP INDEX idx_leads_date ON leads;
+    """
+    statements = split_sql(script)
+    if len(statements) == 2 and statements[1].strip() == "DROP INDEX idx_leads_date ON leads":
+        print("✓ split_sql - PASS")
+    else:
+        print(f"✗ split_sql: {statements} - FAIL")
+        return False
+
+    clauses = month_partitions(date(2024, 11, 15), date(2025, 1, 1))
+    expected = ("PARTITION p202411 VALUES LESS THAN ('2024-12-01'), "
+                "PARTITION p202412 VALUES LESS THAN ('2025-01-01'), "
+                "PARTITION p202501 VALUES LESS THAN ('2025-02-01'), "
+                "PARTITION p_future VALUES LESS THAN (MAXVALUE)")
+    if clauses == expected:
+        print("✓ month_partitions - PASS")
+    else:
+        print(f"✗ month_partitions: {clauses} - FAIL")
+        return False
+
+    from migrate import ensure_future_partitions
+
+    class PartitionCursor:
+        def __init__(self, future_rows):
+            self.future_rows = future_rows
+            self.statements = []
+            self._result = []
+
+        def execute(self, sql, params=None):
+            self.statements.append(sql)
+            if 'information_schema.PARTITIONS' in sql:
+                self._result = [('p_start', "'2024-01-01'"), ('p_future', 'MAXVALUE')]
+            elif 'PARTITION (p_future)' in sql:
+                self._result = [(1,)] if self.future_rows else []
+
+        def fetchall(self):
+            return self._result
+
+        def fetchone(self):
+            return self._result[0] if self._result else None
+
+    empty, filled = PartitionCursor(False), PartitionCursor(True)
+    added = ensure_future_partitions(empty, 'leads', months_ahead=1)
+    skipped = ensure_future_partitions(filled, 'leads', months_ahead=1)
+    copied = ensure_future_partitions(PartitionCursor(True), 'leads', months_ahead=1, copy_rows=True)
+    if added < 2 or 'REORGANIZE' not in empty.statements[-1] or skipped != 0 \
+            or any('REORGANIZE' in sql for sql in filled.statements) or copied != added:
+        print(f"✗ ensure_future_partitions: added {added}, skipped {skipped}, copied {copied} - FAIL")
+        return False
+    print("✓ A filled p_future is only split with copy_rows - PASS")
+
+    return True
+
+
+def test_connection_pool():
+    """Test the pool's wait timeout, ping/recycle and release on errors"""
+    import time
+    import pymysql
+    from database import ConnectionPool, PoolTimeoutError
+
+    print("\nTesting connection pool...")
+
+    class FakeConnection:
+        opened = 0
+
+        def __init__(self):
+            FakeConnection.opened += 1
+            self.closed = False
+            self.alive = True
+
+        def ping(self, reconnect=False):
+            if not self.alive:
+                raise pymysql.err.OperationalError(2006, "MySQL server has gone away")
+
+        def close(self):
+            self.closed = True
+
+    class FakePool(ConnectionPool):
+        def _connect(self):
+            from database import _PooledConnection
+            return _PooledConnection(FakeConnection())
+
+    pool = FakePool({}, size=1, timeout=0.05, max_lifetime=0, ping_interval=0)
+    first = pool.acquire()
+    started = time.monotonic()
+    try:
+        pool.acquire()
+        print("✗ Second borrower of a full pool did not time out - FAIL")
+        return False
+    except PoolTimeoutError:
+        waited = time.monotonic() - started
+    if not 0.04 <= waited < 1 or pool.stats()['waiting'] != 0:
+        print(f"✗ Waited {waited:.3f}s, stats {pool.stats()} - FAIL")
+        return False
+    print("✓ A borrower waits at most the pool timeout - PASS")
+
+    pool.release(first)
+    if pool.acquire() is not first:
+        print("✗ Healthy idle connection not reused - FAIL")
+        return False
+    first.conn.alive = False
+    pool.release(first)
+    second = pool.acquire()
+    if second is first or not first.conn.closed or FakeConnection.opened != 2:
+        print("✗ Connection failing its ping was handed out - FAIL")
+        return False
+    pool.release(second)
+    pool.max_lifetime = 0.01
+    time.sleep(0.02)
+    third = pool.acquire()
+    if third is second or not second.conn.closed:
+        print("✗ Connection past max_lifetime was reused - FAIL")
+        return False
+    pool.release(third)
+    pool.max_lifetime = 0
+    print("✓ Dead connections are replaced and old ones recycled - PASS")
+
+    pool._apply_deadline = lambda pooled: None
+    for error, discarded in ((ValueError('bug'), False),
+                             (pymysql.err.OperationalError(2013, 'Lost connection'), True)):
+        opened = FakeConnection.opened
+        try:
+            with pool.connection():
+                raise error
+        except type(error):
+            pass
+        stats = pool.stats()
+        if stats['in_use'] != 0 or stats['idle'] != (0 if discarded else 1):
+            print(f"✗ After {type(error).__name__}: {stats} - FAIL")
+            return False
+        with pool.connection():
+            pass
+        if (FakeConnection.opened > opened) != discarded:
+            print(f"✗ Connection after {type(error).__name__} {'kept' if discarded else 'dropped'} - FAIL")
+            return False
+    print("✓ Errors return the connection; connection errors discard it - PASS")
+
+    def refuse():
+        raise pymysql.err.OperationalError(2003, "Can't connect")
+
+    pool.close()
+    pool._connect = refuse
+    try:
+        pool.acquire()
+    except pymysql.err.OperationalError:
+        pass
+    if pool.stats()['in_use'] != 0:
+        print(f"✗ Failed connect kept its slot: {pool.stats()} - FAIL")
+        return False
+    print("✓ A failed connect frees its slot - PASS")
+    return True
+
+
+def test_run_concurrently():
+    """Test concurrent report queries: overlap, deadline and context propagation"""
+    import time
+    from database import Database, QueryTimeoutError
+    from deadlines import deadline, remaining
+
+    print("\nTesting concurrent queries...")
+
+    db = Database(pool='pool', cache=None)
+
+    def slow(seconds, value):
+        time.sleep(seconds)
+        return value
+
+    started = time.monotonic()
+    results = db.run_concurrently({'a': (slow, (0.1, 1)), 'b': (slow, (0.1, 2))})
+    elapsed = time.monotonic() - started
+    if results != {'a': 1, 'b': 2} or elapsed >= 0.19:
+        print(f"✗ Got {results} in {elapsed:.3f}s - FAIL")
+        return False
+    print("✓ Independent queries overlap - PASS")
+
+    with deadline(5):
+        seen = db.run_concurrently({'left': (remaining, ())})['left']
+    if seen is None or not 0 < seen <= 5:
+        print(f"✗ Query thread saw deadline {seen} - FAIL")
+        return False
+    print("✓ Query threads inherit the caller's deadline - PASS")
+
+    started = time.monotonic()
+    try:
+        with deadline(0.05):
+            db.run_concurrently({'slow': (slow, (0.5, None))})
+        print("✗ Query past the deadline did not time out - FAIL")
+        return False
+    except QueryTimeoutError:
+        elapsed = time.monotonic() - started
+    if elapsed >= 0.3:
+        print(f"✗ Timed out after {elapsed:.3f}s instead of at the deadline - FAIL")
+        return False
+
+    def fail():
+        raise ValueError('bad row')
+
+    try:
+        db.run_concurrently({'ok': (slow, (0, 1)), 'bad': (fail, ())})
+        print("✗ Query error swallowed - FAIL")
+        return False
+    except ValueError:
+        pass
+    print("✓ The deadline bounds the wait and errors reach the caller - PASS")
+    return True
+
+
+def test_message_dedup():
+    """Test callback claims, single push requests, expiry and message keys"""
+    import threading
+    import time
+    from types import SimpleNamespace
+    from dedup import MessageDeduplicator, message_key
+
+    print("\nTesting message deduplication...")
+
+    dedup = MessageDeduplicator(max_entries=2, ttl=0.1, shared_dir='')
+    claims = []
+    barrier = threading.Barrier(8)
+
+    def deliver():
+        barrier.wait()
+        claims.append(dedup.claim('msg:1'))
+
+    threads = [threading.Thread(target=deliver) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    futures = {id(future) for future, _ in claims}
+    if sum(is_new for _, is_new in claims) != 1 or len(futures) != 1 or dedup.stats()['duplicates'] != 7:
+        print(f"✗ 8 concurrent deliveries gave {sum(is_new for _, is_new in claims)} new claims - FAIL")
+        return False
+    claims[0][0].set_result('报表')
+    if dedup.claim('msg:1')[0].result(timeout=0) != '报表':
+        print("✗ Re-delivery did not get the first reply - FAIL")
+        return False
+    print("✓ One claim per message; re-deliveries share its reply - PASS")
+
+    if not dedup.request_push('msg:1') or dedup.request_push('msg:1') or dedup.request_push('msg:unknown'):
+        print("✗ request_push should succeed once per claimed message - FAIL")
+        return False
+    print("✓ Only the first timed-out retry arranges the push - PASS")
+
+    dedup.claim('msg:2')
+    dedup.claim('msg:3')
+    if dedup.stats()['entries'] != 2 or not dedup.claim('msg:1')[1]:
+        print(f"✗ Oldest entry not evicted past max_entries: {dedup.stats()} - FAIL")
+        return False
+    time.sleep(0.12)
+    if not dedup.claim('msg:3')[1]:
+        print("✗ Entry older than ttl still claimed - FAIL")
+        return False
+    print("✓ Entries are evicted past max_entries and expire after ttl - PASS")
+
+    text = SimpleNamespace(id=42, source='zhangsan', create_time=1700000000)
+    event = SimpleNamespace(id=None, source='zhangsan', create_time=1700000000)
+    if message_key(text) != 'msg:42' or message_key(event) != 'event:zhangsan:1700000000':
+        print(f"✗ message_key: {message_key(text)}, {message_key(event)} - FAIL")
+        return False
+    print("✓ Messages keyed by MsgId, events by sender and time - PASS")
+    return True
+
+
+def test_single_flight():
+    """Test shared calls: a leader's failure reaches its followers, whose wait is bounded"""
+    import threading
+    import time
+    import query_handler as qh
+    from singleflight import SingleFlight, FollowerTimeoutError
+
+    print("\nTesting single flight...")
+
+    flight = SingleFlight()
+    started = threading.Event()
+    outcomes = []
+
+    def failing():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError('leader failed')
+
+    def call(func, timeout=None):
+        try:
+            outcomes.append(flight.do('k', func, timeout))
+        except Exception as e:
+            outcomes.append(e)
+
+    leader = threading.Thread(target=call, args=(failing,))
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=call, args=(failing,)) for _ in range(4)]
+    for t in followers:
+        t.start()
+    for t in [leader] + followers:
+        t.join()
+    errors = {id(e) for e in outcomes if isinstance(e, ValueError)}
+    if len(outcomes) != 5 or len(errors) != 1 or flight.stats() != {'executed': 1, 'collapsed': 4, 'in_flight': 0}:
+        print(f"✗ Leader failure not shared: {outcomes}, {flight.stats()} - FAIL")
+        return False
+    print("✓ The leader's exception is raised in every follower - PASS")
+
+    outcomes.clear()
+    started.clear()
+
+    def slow():
+        started.set()
+        time.sleep(0.3)
+        return 'done'
+
+    leader = threading.Thread(target=call, args=(slow,))
+    leader.start()
+    started.wait()
+    waited = time.monotonic()
+    call(slow, timeout=0.05)
+    waited = time.monotonic() - waited
+    leader.join()
+    if not isinstance(outcomes[0], FollowerTimeoutError) or waited >= 0.25 or outcomes[1] != 'done':
+        print(f"✗ Follower waited {waited:.3f}s: {outcomes} - FAIL")
+        return False
+
+    class SlowHandler(qh.QueryHandler):
+        def __init__(self):
+            self.single_flight = SingleFlight()
+            self.last_good = None
+
+        def handle_today_query(self):
+            started.set()
+            time.sleep(0.3)
+            return '今日报表'
+
+    handler = SlowHandler()
+    started.clear()
+    replies = []
+    original = qh.QUERY_DEADLINES
+    qh.QUERY_DEADLINES = {'today': 0.05}
+    try:
+        leader = threading.Thread(target=lambda: replies.append(handler.process_query('今日')))
+        leader.start()
+        started.wait()
+        replies.append(handler.process_query('今日'))
+        leader.join()
+    finally:
+        qh.QUERY_DEADLINES = original
+    if replies != ["查询今日数据时出错: 查询超时，请稍后再试或缩小查询范围", '今日报表']:
+        print(f"✗ Unexpected replies: {replies} - FAIL")
+        return False
+    print("✓ Followers stop waiting at the query deadline - PASS")
+    return True
+
+
+def test_post_json_retries():
+    """Test WeChat send retries, the 45009 backoff budget and no retry on read timeouts"""
+    import requests
+    import wechat_bot
+    from types import SimpleNamespace
+
+    print("\nTesting WeChat send retries...")
+
+    class ScriptedSession:
+        def __init__(self, script):
+            self.script = list(script)
+            self.posts = 0
+
+        def post(self, url, **kwargs):
+            self.posts += 1
+            step = self.script.pop(0)
+            if isinstance(step, Exception):
+                raise step
+            status, body = step
+            return SimpleNamespace(status_code=status, json=lambda: body)
+
+    delays = []
+    originals = wechat_bot.get_session, wechat_bot.time, wechat_bot.WECHAT_RATE_LIMIT_MAX_WAIT
+
+    def send(script):
+        session = ScriptedSession(script)
+        wechat_bot.get_session = lambda: session
+        delays.clear()
+        return wechat_bot.post_json('https://example.invalid/send', {}), session.posts
+
+    wechat_bot.time = SimpleNamespace(sleep=delays.append)
+    try:
+        result, posts = send([requests.ConnectionError('refused'), (502, None), (200, {'errcode': -1}),
+                              (200, {'errcode': 0})])
+        if result != {'errcode': 0} or posts != 4 or len(delays) != 3:
+            print(f"✗ Transient failures: {result} after {posts} posts - FAIL")
+            return False
+        try:
+            send([requests.ReadTimeout('slow')])
+            print("✗ Read timeout retried or swallowed - FAIL")
+            return False
+        except requests.ReadTimeout:
+            if delays:
+                print("✗ Read timeout was retried - FAIL")
+                return False
+        print("✓ Connection errors, 5xx and errcode -1 are retried; read timeouts are not - PASS")
+
+        wechat_bot.WECHAT_RATE_LIMIT_MAX_WAIT = 40
+        result, posts = send([(200, {'errcode': 45009})] * 10)
+        if result != {'errcode': 45009} or sum(delays) > 40 or posts != len(delays) + 1 \
+                or posts > wechat_bot.WECHAT_RATE_LIMIT_RETRIES + 1:
+            print(f"✗ Rate limit waits {delays} over {posts} posts - FAIL")
+            return False
+        result, _ = send([(200, {'errcode': 45009}), (200, {'errcode': 0})])
+        if result != {'errcode': 0} or len(delays) != 1:
+            print(f"✗ Rate-limited send not retried: {result} - FAIL")
+            return False
+    finally:
+        wechat_bot.get_session, wechat_bot.time, wechat_bot.WECHAT_RATE_LIMIT_MAX_WAIT = originals
+    print("✓ 45009 is retried within WECHAT_RATE_LIMIT_MAX_WAIT in total - PASS")
+    return True
+
+
+def test_result_cache():
+    """Test result cache expiry, LRU eviction and invalidation"""
+    from cache import ResultCache
+    from datetime import date
+
+    print("\nTesting result cache...")
+
+    today = datetime.now().date()
+    cache = ResultCache(max_entries=2, open_ttl=0)
+
+    cache.put('closed', {'n': 1}, date(2024, 1, 1), date(2024, 1, 31))
+    cache.put('open', {'n': 2}, today, today)
+    hit, value = cache.get('closed')
+    if not hit or value != {'n': 1} or cache.get('open')[0]:
+        print("✗ Closed ranges are kept and open ranges honour the TTL - FAIL")
+        return False
+    print("✓ Closed ranges are kept and open ranges honour the TTL - PASS")
+
+    cache.put('older', {'n': 3}, date(2023, 1, 1), date(2023, 1, 1))
+    cache.put('newer', {'n': 4}, date(2023, 2, 1), date(2023, 2, 1))
+    if cache.get('closed')[0] or cache.stats()['evictions'] != 1:
+        print("✗ Least recently used entry is evicted - FAIL")
+        return False
+    print("✓ Least recently used entry is evicted - PASS")
+
+    if cache.invalidate(date(2023, 1, 1)) != 1 or cache.get('older')[0] or not cache.get('newer')[0]:
+        print("✗ Invalidation drops only overlapping ranges - FAIL")
+        return False
+    print("✓ Invalidation drops only overlapping ranges - PASS")
+
+    return True
+
+
+def test_split_message():
+    """Test splitting long messages under the WeChat byte limit"""
+    from wechat_bot import split_message
+
+    print("\nTesting message splitting...")
+
+    lines = [f"2024-01-{i % 28 + 1:02d}: 线索:12 订单:3 销售额:¥4500" for i in range(365)]
+    message = "\n".join(lines + ["长" * 1000])
+    chunks = split_message(message, 2048)
+
+    if any(len(chunk.encode('utf-8')) > 2048 for chunk in chunks):
+        print("✗ Every chunk fits in 2048 bytes - FAIL")
+        return False
+    print(f"✓ Every chunk fits in 2048 bytes ({len(chunks)} chunks) - PASS")
+
+    chunk_lines = set("\n".join(chunks).split("\n"))
+    if not all(line in chunk_lines for line in lines):
+        print("✗ Chunks break at line boundaries - FAIL")
+        return False
+    print("✓ Chunks break at line boundaries - PASS")
+
+    if "".join(chunks).replace("\n", "") != message.replace("\n", ""):
+        print("✗ No content is lost - FAIL")
+        return False
+    print("✓ No content is lost - PASS")
+
+    if split_message("今日数据报告", 2048) != ["今日数据报告"]:
+        print("✗ Short messages are left alone - FAIL")
+        return False
+    print("✓ Short messages are left alone - PASS")
+
+    return True
+
+
+def test_outbound_queue():
+    """Test the webhook send window and that only messages from one source are merged"""
+    import time
+    from wechat_bot import OutboundQueue, SlidingWindowLimiter
+
+    print("\nTesting outbound queue...")
+
+    limiter = SlidingWindowLimiter(3, window=0.2)
+    started = time.monotonic()
+    times = []
+    for _ in range(7):
+        limiter.acquire()
+        times.append(time.monotonic() - started)
+    busiest = max(sum(1 for t in times if start <= t < start + 0.2) for start in times)
+    if busiest > 3 or times[-1] < 0.4:
+        print(f"✗ {busiest} sends in one window, last at {times[-1]:.2f}s - FAIL")
+        return False
+    print("✓ At most N sends in any window - PASS")
+
+    class RecordingBot:
+        def __init__(self):
+            self.sent = []
+
+        def send_text_message(self, content):
+            self.sent.append(content)
+            return True
+
+    bot = RecordingBot()
+    queue = OutboundQueue(bot, rate_per_minute=600)
+    queue.limiter = SlidingWindowLimiter(100, window=0.01)
+    with queue._cond:
+        queue.enqueue('日报 1', source='daily_report')
+        queue.enqueue('日报 2', source='daily_report')
+        queue.enqueue('其他 1', source='other')
+        queue.enqueue('无来源 1')
+        queue.enqueue('无来源 2')
+    queue.flush(timeout=5)
+    if bot.sent != ['日报 1\n\n日报 2', '其他 1', '无来源 1', '无来源 2']:
+        print(f"✗ Merged messages: {bot.sent} - FAIL")
+        return False
+    print("✓ Queued messages are merged with their own source only - PASS")
+
+    bot.send_text_message = lambda content: False
+    failed = []
+    with queue._cond:
+        queue.enqueue('日报 3', source='daily_report', on_failed=lambda: failed.append('日报 3'))
+        queue.enqueue('日报 4', source='daily_report', on_failed=lambda: failed.append('日报 4'))
+        queue.enqueue('无来源 3')
+    queue.flush(timeout=5)
+    if failed != ['日报 3', '日报 4']:
+        print(f"✗ Failure callbacks: {failed} - FAIL")
+        return False
+    print("✓ A failed send calls each merged message's callback - PASS")
+    return True
+
+
+def test_benchmark_summary():
+    """Test benchmark percentiles and regression detection"""
+    from benchmark import summarize, compare
+
+    print("\nTesting benchmark summary...")
+
+    summary = summarize([i / 1000 for i in range(1, 101)], [2] * 100)
+    if (summary['p50_ms'], summary['p95_ms'], summary['p99_ms'], summary['queries']) != (50, 95, 99, 2):
+        print(f"✗ Percentiles: {summary} - FAIL")
+        return False
+    print("✓ Nearest-rank percentiles - PASS")
+
+    before = {'results': {'fast': {'p50_ms': 5, 'p95_ms': 10, 'queries': 1},
+                          'slow': {'p50_ms': 5, 'p95_ms': 10, 'queries': 1}}}
+    after = {'results': {'fast': {'p50_ms': 5, 'p95_ms': 10.5, 'queries': 1},
+                         'slow': {'p50_ms': 9, 'p95_ms': 20, 'queries': 1}}}
+    _, regressions = compare(before, after, 0.1)
+    if regressions != ['slow']:
+        print(f"✗ Regressions: {regressions} - FAIL")
+        return False
+    print("✓ Regressions detected - PASS")
+
+    return True
+
+
+def test_metrics_registry():
+    """Test histogram buckets, counters and collector output"""
+    from metrics import Registry
+
+    print("\nTesting metrics registry...")
+
+    registry = Registry()
+    latency = registry.histogram('test_seconds', 'Test latency', ['method'], buckets=(0.1, 1))
+    errors = registry.counter('test_errors', 'Test errors', ['where'])
+    for value in (0.05, 0.5, 5):
+        latency.observe(value, method='a')
+    errors.inc(where='db')
+
+    @latency.time(method='b')
+    def work():
+        return 42
+
+    work()
+    registry.register_collector(lambda: [('test_pool', 'gauge', 'Test pool', [({'state': 'idle'}, 3)])])
+    registry.register_collector(lambda: [('test_sent', 'counter', 'Test sent', [({}, 2)])])
+    registry.register_collector(lambda: 1 / 0)
+    text = registry.render()
+    expected = [
+        '# TYPE test_errors_total counter',
+        '# TYPE test_sent_total counter',
+        'test_sent_total 2',
+        '# TYPE test_pool gauge',
+        'test_seconds_bucket{method="a",le="0.1"} 1',
+        'test_seconds_bucket{method="a",le="1"} 2',
+        'test_seconds_bucket{method="a",le="+Inf"} 3',
+        'test_seconds_count{method="a"} 3',
+        'test_seconds_count{method="b"} 1',
+        'test_errors_total{where="db"} 1',
+        'test_pool{state="idle"} 3',
+    ]
+    missing = [line for line in expected if line not in text.splitlines()]
+    if missing:
+        print(f"✗ Missing lines: {missing} - FAIL")
+        return False
+    print("✓ Cumulative buckets, counters and collectors rendered - PASS")
+
+    import os
+
+    class Components:
+        def __init__(self, size):
+            self.size = size
+
+        def collect(self):
+            return [('test_pool_size', 'gauge', 'Test pool size', [({}, self.size)])]
+
+    registry = Registry(pid_label=True)
+    registry.counter('test_errors', 'Test errors', ['where']).inc(where='db')
+    first, second = Components(4), Components(8)
+    registry.register_collector(first.collect, key='components')
+    registry.register_collector(second.collect, key='components')
+    lines = registry.render().splitlines()
+    pid = os.getpid()
+    if [line for line in lines if line.startswith('test_pool_size')] != [f'test_pool_size{{pid="{pid}"}} 8'] \
+            or f'test_errors_total{{where="db",pid="{pid}"}} 1' not in lines:
+        print(f"✗ Expected one collector family and pid labels: {lines} - FAIL")
+        return False
+    registry.unregister_collector(second.collect)
+    if 'test_pool_size' in registry.render():
+        print("✗ Collector still rendered after unregistering - FAIL")
+        return False
+    print("✓ A rebuilt app replaces its collector; series carry the pid - PASS")
+    return True
+
+
+def test_debug_tools():
+    """Test the slow query log cursor and the sampling profiler"""
+    import threading
+    import time
+    from slowlog import SlowQueryLog, timed_cursor_class
+    from profiler import SamplingProfiler
+
+    print("\nTesting debug tools...")
+
+    class FakeCursor:
+        def __init__(self, connection):
+            self.connection = connection
+
+        def execute(self, query, args=None):
+            time.sleep(args[0])
+            if query == 'SELECT timeout':
+                raise TimeoutError(query)
+            return 7
+
+    log = SlowQueryLog(threshold_ms=20, size=10)
+    cursor = timed_cursor_class(FakeCursor, log)(None)
+    cursor.execute("SELECT 1", (0,))
+    rows = cursor.execute("SELECT\n  slow", (0.03,))
+    entries = log.entries()
+    if rows != 7 or len(entries) != 1 or entries[0]['sql'] != 'SELECT slow' or entries[0]['rows'] != 7:
+        print(f"✗ Slow query log: {entries} - FAIL")
+        return False
+    print("✓ Only statements over the threshold are logged - PASS")
+
+    try:
+        cursor.execute("SELECT timeout", (0.03,))
+        print("✗ Statement error swallowed - FAIL")
+        return False
+    except TimeoutError:
+        pass
+    entry = log.entries()[0]
+    if entry['sql'] != 'SELECT timeout' or entry['error'] != 'TimeoutError' or entry['rows'] is not None:
+        print(f"✗ Failed slow statement not logged: {entry} - FAIL")
+        return False
+    print("✓ Failed slow statements are logged with their error - PASS")
+
+    stop = threading.Event()
+
+    def busy_report_worker():
+        while not stop.is_set():
+            sum(range(1000))
+
+    worker = threading.Thread(target=busy_report_worker, name='busy-worker')
+    worker.start()
+    try:
+        stacks, rounds = SamplingProfiler(interval=0.005).profile(0.2)
+    finally:
+        stop.set()
+        worker.join()
+    sampled = [stack for stack in stacks if stack.startswith('busy-worker;') and 'busy_report_worker (' in stack]
+    if rounds == 0 or not sampled:
+        print(f"✗ Profiler samples: {rounds} rounds, {list(stacks)[:3]} - FAIL")
+        return False
+    print("✓ Profiler collapses other threads' stacks - PASS")
+    return True
+
+
+def test_report_snapshots():
+    """Test snapshots are kept under the day they were built for and refreshed on the app's handler"""
+    from datetime import date
+    import query_handler as qh
+    import scheduler
+    import snapshots
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from query_handler import QueryHandler
+    from snapshots import SnapshotStore
+
+    print("\nTesting report snapshots...")
+
+    ranges = []
+
+    class RangeDatabase:
+        def get_combined_stats(self, start_date, end_date):
+            ranges.append((start_date, end_date))
+            return {
+                'start_date': start_date.strftime('%Y-%m-%d'),
+                'end_date': end_date.strftime('%Y-%m-%d'),
+                'leads': {'total_leads': 0, 'by_sales': []},
+                'orders': {'total_orders': 0, 'by_sales': []}
+            }
+
+    def frozen(day):
+        class FrozenDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return datetime.combine(day, datetime.min.time()) + timedelta(hours=23, minutes=59)
+        return FrozenDatetime
+
+    handler = QueryHandler()
+    handler.db = RangeDatabase()
+    handler.today_counters = None
+    handler.snapshots = SnapshotStore(max_age=3600)
+    before, after = date(2024, 3, 31), date(2024, 4, 1)
+    originals = qh.datetime, snapshots.datetime
+    # The refresh starts just before midnight; the snapshots are stored just after
+    qh.datetime, snapshots.datetime = frozen(before), frozen(after)
+    try:
+        stored = handler.refresh_snapshots()
+        served = handler.snapshots.get('today')
+        snapshots.datetime = frozen(before)
+        kept = handler.snapshots.get('today')
+    finally:
+        qh.datetime, snapshots.datetime = originals
+    if stored != 3 or set(ranges) != {(before, before), (before - timedelta(days=1),) * 2, (date(2024, 3, 1), before)}:
+        print(f"✗ Reports not all built for one day: {ranges} - FAIL")
+        return False
+    if served is not None or kept is None:
+        print("✗ Snapshot built for the previous day served after midnight - FAIL")
+        return False
+    print("✓ Snapshots are stored under the day they were built for - PASS")
+
+    class CountingHandler:
+        refreshed = 0
+
+        def refresh_snapshots(self):
+            self.refreshed += 1
+            return 3
+
+    app_handler = CountingHandler()
+    original_enabled = scheduler.SNAPSHOT_ENABLED
+    scheduler.SNAPSHOT_ENABLED = True
+    try:
+        jobs = BackgroundScheduler()
+        scheduler.add_worker_jobs(jobs, app_handler)
+    finally:
+        scheduler.SNAPSHOT_ENABLED = original_enabled
+    for job_id in ('report_snapshots', 'report_snapshots_midnight'):
+        job = jobs.get_job(job_id)
+        job.func(*job.args)
+    if app_handler.refreshed != 2:
+        print("✗ Snapshot jobs did not run on the app's query handler - FAIL")
+        return False
+    print("✓ Snapshot jobs run on the app's query handler - PASS")
+    return True
+
+
+def test_scheduler_lease():
+    """Test that one lease holder runs the leader jobs and others take over"""
+    import os
+    import tempfile
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from lease import FileLease
+    from scheduler import scheduler_lease_job
+
+    print("\nTesting scheduler lease...")
+
+    path = os.path.join(tempfile.mkdtemp(), 'scheduler.lock')
+    leader, follower = FileLease(path), FileLease(path)
+    if not leader.acquire() or follower.acquire():
+        print("✗ Lock not exclusive - FAIL")
+        return False
+    print("✓ Only one holder - PASS")
+
+    scheduler = BackgroundScheduler()
+    scheduler_lease_job(scheduler, follower)
+    if scheduler.get_job('daily_report') is not None:
+        print("✗ Follower scheduled the daily report - FAIL")
+        return False
+    leader.release()
+    scheduler_lease_job(scheduler, follower)
+    follower.release()
+    if scheduler.get_job('daily_report') is None:
+        print("✗ Follower did not take over - FAIL")
+        return False
+    print("✓ Follower takes over the leader jobs - PASS")
+    return True
+
+
+def test_worker_shared_state():
+    """Test that invalidations, async-mode claims and daily reports span worker processes"""
+    import os
+    import tempfile
+    from datetime import date
+    import scheduler
+    from cache import InvalidationLog, ResultCache
+    from database import Database
+    from dedup import MessageDeduplicator
+
+    print("\nTesting state shared between workers...")
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'cache_invalidations')
+    workers = []
+    for _ in range(2):
+        db = Database(pool=object(), cache=ResultCache(), replicas=None, breaker=None)
+        db.cube = None
+        db.invalidations = InvalidationLog(path, max_bytes=60)
+        db.cache.put('jan', 1, date(2024, 1, 1), date(2024, 1, 31))
+        db.cache.put('feb', 2, date(2024, 2, 1), date(2024, 2, 29))
+        workers.append(db)
+    first, second = workers
+
+    first.invalidate_cache(date(2024, 1, 15))
+    second.apply_shared_invalidations()
+    if second.cache.get('jan')[0] or not second.cache.get('feb')[0]:
+        print("✗ Invalidation reaches the other worker - FAIL")
+        return False
+    print("✓ Invalidation reaches the other worker - PASS")
+
+    # Outgrowing max_bytes starts a new file; the other worker clears everything
+    for day in range(1, 4):
+        first.invalidate_cache(date(2023, 1, day))
+    second.cache.put('jan', 1, date(2024, 1, 1), date(2024, 1, 31))
+    second.apply_shared_invalidations()
+    if second.cache.get('jan')[0] or second.cache.get('feb')[0]:
+        print("✗ A rotated log clears the other worker's cache - FAIL")
+        return False
+    print("✓ A rotated log clears the other worker's cache - PASS")
+
+    claims = os.path.join(directory, 'dedup')
+    a, b = MessageDeduplicator(shared_dir=claims), MessageDeduplicator(shared_dir=claims)
+    if not a.claim_shared('msg:1') or b.claim_shared('msg:1') or not b.claim_shared('msg:2'):
+        print("✗ Async-mode claims are shared between workers - FAIL")
+        return False
+    print("✓ Async-mode claims are shared between workers - PASS")
+
+    class FakeDatabase:
+        claimed = set()
+
+        def claim_report_run(self, report, day):
+            if (report, day) in self.claimed:
+                return False
+            self.claimed.add((report, day))
+            return True
+
+        def release_report_run(self, report, day):
+            self.claimed.discard((report, day))
+
+        def get_combined_stats(self, start_date, end_date):
+            return {'total_leads': 0, 'total_orders': 0, 'total_sales': 0, 'sales_data': []}
+
+    class FakeBot:
+        queued = []
+        accept = True
+        deliver = True
+
+        def enqueue_text_message(self, message, source=None, on_failed=None):
+            if not self.accept:
+                return False
+            if self.deliver:
+                self.queued.append(message)
+            elif on_failed is not None:
+                on_failed()
+            return True
+
+    original = scheduler.Database, scheduler.WeChatBot, scheduler.format_daily_report
+    scheduler.Database, scheduler.WeChatBot = FakeDatabase, FakeBot
+    scheduler.format_daily_report = lambda stats: 'report'
+    try:
+        FakeBot.accept = False
+        scheduler.daily_report_job()
+        FakeBot.accept, FakeBot.deliver = True, False
+        scheduler.daily_report_job()
+        FakeBot.deliver = True
+        scheduler.daily_report_job()
+        scheduler.daily_report_job()
+        scheduler.daily_report_job(force=True)
+    finally:
+        scheduler.Database, scheduler.WeChatBot, scheduler.format_daily_report = original
+    if len(FakeBot.queued) != 2 or len(FakeDatabase.claimed) != 1:
+        print(f"✗ Daily report sent once per day: {FakeBot.queued} - FAIL")
+        return False
+    print("✓ Daily report sent once per day, retried after a failed send - PASS")
+
+    import pymysql
+    from contextlib import contextmanager
+    from database import Database
+
+    class MissingTableCursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def execute(self, sql, args=None):
+            raise pymysql.err.ProgrammingError(1146, "Table 'sales.report_runs' doesn't exist")
+
+    class MissingTableConnection:
+        def cursor(self):
+            return MissingTableCursor()
+
+    db = Database.__new__(Database)
+    db.get_connection = contextmanager(lambda: (yield MissingTableConnection()))
+    if not db.claim_report_run('daily_report', '2024-01-01'):
+        print("✗ Report claimed without report_runs - FAIL")
+        return False
+    db.release_report_run('daily_report', '2024-01-01')
+    print("✓ Report still sent before migration 004 - PASS")
+    return True
+
+
+def test_app_factory():
+    """Test that importing the app is cheap and create_app builds it"""
+    import os
+    import subprocess
+    import app
+
+    print("\nTesting app factory...")
+
+    check = "import sys, app; print(sorted(m for m in ('wechatpy', 'pymysql', 'apscheduler') if m in sys.modules))"
+    loaded = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    if loaded != '[]':
+        print(f"✗ Heavy modules imported with app: {loaded} - FAIL")
+        return False
+    print("✓ Importing app defers wechatpy, pymysql and apscheduler - PASS")
+
+    client = app.create_app(start_scheduler=False, warm_up=False).test_client()
+    response = client.get('/ready')
+    if response.status_code != 200 or not response.get_json()['ready']:
+        print(f"✗ /ready: {response.status_code} - FAIL")
+        return False
+    print("✓ create_app serves /ready - PASS")
+
+    from components import BotComponents
+    components = BotComponents(query_handler_factory=lambda: 1 / 0)
+    names = [family[0] for family in components.collect_runtime_metrics()]
+    if names != ['eyewear_outbound_queue_length'] or components._reply_dispatcher is not None:
+        print(f"✗ Scrape built components: {names} - FAIL")
+        return False
+    print("✓ A scrape reads only the components already built - PASS")
+    return True
+
+
+def test_wechat_callback():
+    """Test a /wechat POST end to end with stubbed crypto, and that a retry reuses the reply"""
+    import types
+    import app
+
+    print("\nTesting WeChat callback...")
+
+    class FakeCrypto:
+        def decrypt_message(self, xml, signature, timestamp, nonce):
+            return xml
+
+        def encrypt_message(self, xml, nonce, timestamp):
+            return xml
+
+    class FakeQueryHandler:
+        calls = 0
+
+        def process_query(self, text):
+            FakeQueryHandler.calls += 1
+            return f"报表: {text}"
+
+    xml = ("<xml><ToUserName>corp</ToUserName><FromUserName>zhangsan</FromUserName>"
+           "<CreateTime>1700000000</CreateTime><MsgType>text</MsgType><Content>今日</Content>"
+           "<MsgId>42</MsgId><AgentID>1</AgentID></xml>")
+
+    saved = {name: sys.modules.get(name) for name in ('wechatpy', 'wechatpy.enterprise')}
+    try:
+        import wechatpy.enterprise  # noqa: F401
+    except ImportError:
+        # wechatpy is not installed here: parse just what the handler reads
+        import re
+        enterprise = types.ModuleType('wechatpy.enterprise')
+
+        def parse_message(text):
+            fields = dict(re.findall(r'<(\w+)>([^<]*)</\1>', text.decode() if isinstance(text, bytes) else text))
+            return types.SimpleNamespace(type=fields['MsgType'], content=fields['Content'], id=fields['MsgId'],
+                                         source=fields['FromUserName'], create_time=fields['CreateTime'])
+
+        enterprise.parse_message = parse_message
+        enterprise.create_reply = lambda content, msg: types.SimpleNamespace(render=lambda: content)
+        sys.modules['wechatpy'] = types.ModuleType('wechatpy')
+        sys.modules['wechatpy.enterprise'] = enterprise
+
+    try:
+        flask_app = app.create_app(start_scheduler=False, warm_up=False)
+        bot_components = flask_app.extensions['eyewear_bot']
+        bot_components._crypto = FakeCrypto()
+        bot_components._query_handler = FakeQueryHandler()
+        client = flask_app.test_client()
+        url = '/wechat?msg_signature=s&timestamp=1700000000&nonce=n'
+        first = client.post(url, data=xml.encode())
+        retry = client.post(url, data=xml.encode())
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    body = first.get_data(as_text=True)
+    if first.status_code != 200 or '报表: 今日' not in body:
+        print(f"✗ /wechat POST: {first.status_code} {body} - FAIL")
+        return False
+    print("✓ Text message gets the report as reply - PASS")
+    if retry.get_data(as_text=True) != body or FakeQueryHandler.calls != 1:
+        print(f"✗ Retry ran the query again ({FakeQueryHandler.calls} calls) - FAIL")
+        return False
+    print("✓ Re-delivered message reuses the first reply - PASS")
+    return True
+
+
+def test_reply_dispatcher():
+    """Test that background replies go to the sender through the app, never the group robot"""
+    import config
+    import wechat_bot
+    from reply_dispatcher import ReplyDispatcher
+
+    print("\nTesting reply dispatcher...")
+
+    class FakeQueryHandler:
+        def process_query(self, query_text):
+            return f"报表: {query_text}"
+
+    class FakeAppClient:
+        def __init__(self, configured):
+            self.configured = configured
+            self.sent = []
+
+        def send_text_message(self, touser, content):
+            self.sent.append((touser, content))
+            return True
+
+    robot = []
+    original = wechat_bot.WeChatBot.enqueue_text_message
+    wechat_bot.WeChatBot.enqueue_text_message = lambda self, content: robot.append(content) or True
+    try:
+        for configured in (True, False):
+            client = FakeAppClient(configured)
+            dispatcher = ReplyDispatcher(FakeQueryHandler(), workers=1, app_client=client)
+            dispatcher.submit('zhangsan', '今日')
+            dispatcher.shutdown()
+            stats = dispatcher.stats()
+            expected = [('zhangsan', '报表: 今日')] if configured else []
+            if client.sent != expected or robot or stats['completed'] != int(configured) \
+                    or stats['failed'] != int(not configured):
+                print(f"✗ configured={configured}: sent {client.sent}, robot {robot}, {stats} - FAIL")
+                return False
+        print("✓ Replies go to the sender only; nothing reaches the group robot - PASS")
+    finally:
+        wechat_bot.WeChatBot.enqueue_text_message = original
+
+    saved = config.WECHAT_REPLY_MODE, config.WECHAT_CORP_SECRET
+    config.WECHAT_REPLY_MODE, config.WECHAT_CORP_SECRET = 'async', ''
+    try:
+        config.check_config()
+        print("✗ Async reply mode without app credentials was accepted - FAIL")
+        return False
+    except ValueError:
+        print("✓ Async reply mode without app credentials is refused - PASS")
+    finally:
+        config.WECHAT_REPLY_MODE, config.WECHAT_CORP_SECRET = saved
+    return True
+
+
+def test_async_query_handler():
+    """Test that the async handler builds reports and collapses identical queries"""
+    import asyncio
+    from async_query_handler import AsyncQueryHandler
+
+    print("\nTesting async query handler...")
+
+    class FakeAsyncDatabase:
+        calls = 0
+
+        async def get_combined_stats(self, start_date, end_date):
+            FakeAsyncDatabase.calls += 1
+            await asyncio.sleep(0.05)
+            return {
+                'start_date': start_date.strftime('%Y-%m-%d'),
+                'end_date': end_date.strftime('%Y-%m-%d'),
+                'leads': {'total_leads': 3, 'by_sales': [{'sales': '张三', 'leads_count': 3}]},
+                'orders': {'total_orders': 1,
+                           'by_sales': [{'sales': '张三', 'orders_count': 1, 'total_sales': 800}]}
+            }
+
+    handler = AsyncQueryHandler(adb=FakeAsyncDatabase())
+    handler.snapshots = None
+
+    async def run():
+        return await asyncio.gather(*(handler.process_query_async('昨日') for _ in range(5)))
+
+    replies = asyncio.run(run())
+    if len(set(replies)) != 1 or '张三' not in replies[0]:
+        print(f"✗ Unexpected replies: {replies[0]} - FAIL")
+        return False
+    if FakeAsyncDatabase.calls != 1:
+        print(f"✗ {FakeAsyncDatabase.calls} queries for 5 identical requests - FAIL")
+        return False
+    print("✓ 5 concurrent 昨日 queries share one database read - PASS")
+
+    if asyncio.run(handler.process_query_async('随便')) != handler.handle_unknown_query():
+        print("✗ Unknown query not handled - FAIL")
+        return False
+    print("✓ Unknown query gets the help text - PASS")
+
+    class FakeDatabase:
+        fail = False
+
+        def get_combined_stats(self, start_date, end_date):
+            if self.fail:
+                raise RuntimeError('down')
+            return asyncio.run(FakeAsyncDatabase.get_combined_stats(None, start_date, end_date))
+
+    async def down(start_date, end_date):
+        raise RuntimeError('down')
+
+    handler.db = FakeDatabase()
+    handler.today_counters = None
+    handler.last_good = None
+    working = handler.adb.get_combined_stats
+    for failing in (False, True):
+        handler.db.fail = failing
+        handler.adb.get_combined_stats = down if failing else working
+        for query in ('今日', '昨日', '本月', '上个月'):
+            sync_reply = handler.process_query(query)
+            async_reply = asyncio.run(handler.process_query_async(query))
+            if sync_reply != async_reply:
+                print(f"✗ {query}: sync and async replies differ: {sync_reply!r} / {async_reply!r} - FAIL")
+                return False
+    print("✓ Sync and async handlers give the same reports and errors - PASS")
+    return True
+
+
+def test_replica_selection():
+    """Test replica choice by strategy and lag, and 今日 staying on the primary"""
+    import time
+    from database import Database
+    from replicas import Replica, ReplicaSet, parse_replicas
+
+    print("\nTesting replica selection...")
+
+    configs = parse_replicas('r1.db:3307, r2.db', {'host': 'primary', 'port': 3306, 'user': 'bot'})
+    if [(c['host'], c['port'], c['user']) for c in configs] != [('r1.db', 3307, 'bot'), ('r2.db', 3306, 'bot')]:
+        print(f"✗ parse_replicas: {configs} - FAIL")
+        return False
+
+    def replica(name, lag, latency):
+        r = Replica(name, pool=name + '-pool')
+        r.lag, r.latency, r.checked_at = lag, latency, float('inf')
+        return r
+
+    replicas = [replica('a', 1, 0.020), replica('b', 2, 0.005), replica('c', 120, 0.001), replica('d', None, None)]
+    round_robin = ReplicaSet(replicas, strategy='round_robin', max_lag=30)
+    picked = [round_robin.choose().name for _ in range(4)]
+    if picked != ['a', 'b', 'a', 'b']:
+        print(f"✗ Round robin picked {picked} - FAIL")
+        return False
+    print("✓ Round robin skips lagging and unchecked replicas - PASS")
+
+    if ReplicaSet(replicas, strategy='least_latency', max_lag=30).choose().name != 'b':
+        print("✗ Least latency did not pick the fastest usable replica - FAIL")
+        return False
+    if ReplicaSet(replicas[2:], max_lag=30).choose() is not None:
+        print("✗ Expected the primary when no replica is usable - FAIL")
+        return False
+    print("✓ Least latency and primary fallback - PASS")
+
+    db = Database(pool='primary-pool', replicas=round_robin, cache=None)
+    today = datetime.now().date()
+    if db._read_replica(today) is not None or db._read_replica(today - timedelta(days=7)) is None:
+        print("✗ 今日 should read the primary and older ranges a replica - FAIL")
+        return False
+    print("✓ 今日 reads the primary, older ranges a replica - PASS")
+
+    import pymysql
+    from contextlib import contextmanager
+    from circuit_breaker import CircuitBreaker
+
+    class DownPool:
+        @contextmanager
+        def connection(self):
+            raise pymysql.err.OperationalError(2003, "Can't connect to MySQL server")
+            yield
+
+    down = replica('down', 1, 0.001)
+    down.pool = DownPool()
+    down.breaker = CircuitBreaker('down', failure_threshold=1, reset_timeout=60)
+    primary_breaker = CircuitBreaker('primary', failure_threshold=1, reset_timeout=60)
+    db = Database(pool='primary-pool', replicas=ReplicaSet([down], max_lag=30), cache=None, breaker=primary_breaker)
+    try:
+        with db.get_read_connection(today - timedelta(days=7)):
+            pass
+    except pymysql.err.OperationalError:
+        pass
+    if down.lag is not None or down.breaker.state != 'open' or primary_breaker.state != 'closed':
+        print(f"✗ Replica failure: lag {down.lag}, replica {down.breaker.state}, primary {primary_breaker.state} - FAIL")
+        return False
+    down.lag = 1
+    if db._read_replica(today - timedelta(days=7)) is not None:
+        print("✗ Replica with an open breaker was chosen - FAIL")
+        return False
+    print("✓ A failing replica opens its own breaker only and is skipped - PASS")
+
+    class UpConnection:
+        def cursor(self, *args):
+            return self
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    class UpPool:
+        @contextmanager
+        def connection(self):
+            yield UpConnection()
+
+    down.breaker.reset_timeout = 0
+    if down.breaker.state != 'half_open' or db._read_replica(today - timedelta(days=7)) is not None:
+        print("✗ Replica with a half-open breaker was chosen - FAIL")
+        return False
+    import replicas as replicas_module
+    original_lag = replicas_module.replication_lag
+    replicas_module.replication_lag = lambda cursor: 1.0
+    down.pool = UpPool()
+    try:
+        db.replicas.check(down)
+    finally:
+        replicas_module.replication_lag = original_lag
+    if down.breaker.state != 'closed' or db._read_replica(today - timedelta(days=7)) is not down:
+        print(f"✗ Lag check did not close the half-open breaker: {down.breaker.state} - FAIL")
+        return False
+    print("✓ A half-open replica is skipped until its lag check succeeds - PASS")
+
+    import scheduler
+    checked = []
+    lagging = ReplicaSet([Replica('unchecked', pool=None)], max_lag=30, check_interval=10)
+    lagging.check = checked.append
+    if lagging.choose() is not None or checked:
+        print("✗ choose() checked an unchecked replica inline - FAIL")
+        return False
+    original = scheduler.get_default_replica_set
+    scheduler.get_default_replica_set = lambda: lagging
+    try:
+        scheduler.replica_check_job()
+    finally:
+        scheduler.get_default_replica_set = original
+    if [r.name for r in checked] != ['unchecked']:
+        print("✗ Replica check job did not check the replicas - FAIL")
+        return False
+    stale = replica('stale', 1, 0.001)
+    stale.checked_at = time.monotonic() - 31
+    if ReplicaSet([stale], max_lag=30, check_interval=10).choose() is not None:
+        print("✗ Replica not checked for three intervals was chosen - FAIL")
+        return False
+    print("✓ Lag is checked by the scheduler job; choose() reads the last results only - PASS")
+    return True
+
+
+def test_circuit_breaker():
+    """Test deadlines, the breaker and the last-known-good fallback"""
+    import time
+    from circuit_breaker import CircuitBreaker, CircuitOpenError
+    from deadlines import deadline, execution_time_ms
+    from query_handler import QueryHandler
+    from snapshots import SnapshotStore
+
+    print("\nTesting circuit breaker...")
+
+    with deadline(0.5):
+        with deadline(10):
+            inner = execution_time_ms()
+    if not 0 < inner <= 500 or execution_time_ms() != 0:
+        print(f"✗ Deadline gave {inner}ms inside, {execution_time_ms()}ms outside - FAIL")
+        return False
+    print("✓ Nested deadlines keep the earlier one - PASS")
+
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    breaker.record_failure()
+    try:
+        breaker.before_call()
+        print("✗ Breaker did not open - FAIL")
+        return False
+    except CircuitOpenError:
+        pass
+    time.sleep(0.06)
+    breaker.before_call()
+    try:
+        breaker.before_call()
+        print("✗ Half-open breaker let a second call through - FAIL")
+        return False
+    except CircuitOpenError:
+        pass
+    breaker.record_success()
+    if breaker.state != 'closed':
+        print(f"✗ Breaker {breaker.state} after a successful trial - FAIL")
+        return False
+    print("✓ Breaker opens, lets one trial through and closes - PASS")
+
+    import asyncio
+    from async_database import AsyncDatabase
+
+    class BreakerOnly:
+        pass
+
+    holder = BreakerOnly()
+    holder.breaker = CircuitBreaker('async', failure_threshold=1, reset_timeout=0.01)
+    holder._read_replica = lambda start_date=None: None
+    adb = AsyncDatabase(holder)
+    for error in (asyncio.CancelledError(), ValueError('bug')):
+        holder.breaker.record_failure()
+        time.sleep(0.02)
+
+        async def execute(replica, sql, params, error=error):
+            raise error
+        adb._execute = execute
+        try:
+            asyncio.run(adb._fetchall("SELECT 1", ()))
+        except (asyncio.CancelledError, ValueError):
+            pass
+        if holder.breaker.state != 'half_open':
+            print(f"✗ {type(error).__name__} counted as a trial result: {holder.breaker.state} - FAIL")
+            return False
+        # The trial slot is free again
+        holder.breaker.before_call()
+        holder.breaker.record_failure()
+    print("✓ Cancelled and non-database errors leave the breaker unchanged - PASS")
+
+    import async_database
+    from database import QueryTimeoutError
+    from replicas import Replica
+
+    class SlowCursor:
+        async def execute(self, sql, params=None):
+            await asyncio.sleep(1)
+
+    class AsyncConnection:
+        closed = False
+
+        async def cursor(self, cursorclass=None):
+            return SlowCursor()
+
+        def close(self):
+            self.closed = True
+
+    class AsyncPool:
+        def __init__(self):
+            self.conn = AsyncConnection()
+            self.released = []
+
+        async def acquire(self):
+            return self.conn
+
+        async def release(self, conn):
+            self.released.append(conn)
+
+    replica = Replica('r1', pool=None, breaker=CircuitBreaker('r1', failure_threshold=1, reset_timeout=60))
+    holder.breaker = CircuitBreaker('async', failure_threshold=1, reset_timeout=60)
+    holder._read_replica = lambda start_date=None: replica
+    replica_pool = AsyncPool()
+    adb = AsyncDatabase(holder, pool=AsyncPool())
+    adb._pools['r1'] = replica_pool
+    original_aiomysql, async_database.aiomysql = async_database.aiomysql, type('aiomysql', (), {'DictCursor': None})
+    try:
+        with deadline(0.05):
+            asyncio.run(adb._fetchall("SELECT 1", (), datetime.now().date()))
+    except QueryTimeoutError:
+        pass
+    finally:
+        async_database.aiomysql = original_aiomysql
+    if not replica_pool.conn.closed or replica_pool.released != [replica_pool.conn]:
+        print("✗ Connection cut off by the deadline went back to the pool open - FAIL")
+        return False
+    if replica.breaker.state != 'open' or holder.breaker.state != 'closed':
+        print(f"✗ Async timeout counted against {replica.breaker.state}/{holder.breaker.state} - FAIL")
+        return False
+    print("✓ Async reads use the chosen replica and drop timed-out connections - PASS")
+
+    class FlakyDatabase:
+        fail = False
+
+        def get_combined_stats(self, start_date, end_date):
+            if self.fail:
+                raise CircuitOpenError("数据库 熔断中")
+            return {
+                'start_date': start_date.strftime('%Y-%m-%d'),
+                'end_date': end_date.strftime('%Y-%m-%d'),
+                'leads': {'total_leads': 3, 'by_sales': [{'sales': '张三', 'leads_count': 3}]},
+                'orders': {'total_orders': 0, 'by_sales': []}
+            }
+
+    handler = QueryHandler()
+    handler.db = FlakyDatabase()
+    handler.snapshots = None
+    handler.last_good = SnapshotStore(max_age=3600)
+    handler.handle_yesterday_query()
+    handler.db.fail = True
+    reply = handler.handle_yesterday_query()
+    if '张三' not in reply or '数据库暂时无法查询' not in reply:
+        print(f"✗ Expected the last good report, got: {reply} - FAIL")
+        return False
+    print("✓ Failing query serves the last good report with its age - PASS")
+
+    handler.last_good = None
+    reply = handler.handle_yesterday_query()
+    if reply != "查询昨日数据时出错: 数据库暂时不可用，请稍后再试":
+        print(f"✗ Unexpected error reply: {reply} - FAIL")
+        return False
+    print("✓ Without one, the error reply hides the exception text - PASS")
+    return True
+
+
 def test_date_calculations():
     """Test date range calculations"""
     print("\nTesting date calculations...")
@@ -128,6 +2224,36 @@ def main():
         ("Configuration", test_config),
         ("Query Handler", test_query_handler),
         ("Message Formatter", test_message_formatter),
+        ("Combined Stats Parity", test_combined_stats_parity),
+        ("Sales Dimension", test_sales_dimension),
+        ("Embedded Backend", test_embedded_backend),
+        ("Parquet Archive", test_parquet_archive),
+        ("Rollup Segments", test_rollup_segments),
+        ("Rollup Schema Columns", test_rollup_schema_columns),
+        ("Rollup Refresh Range", test_rollup_refresh_range),
+        ("Today Counters", test_today_counters),
+        ("Sales Cube", test_sales_cube),
+        ("Report Snapshots", test_report_snapshots),
+        ("Connection Pool", test_connection_pool),
+        ("Concurrent Queries", test_run_concurrently),
+        ("Message Dedup", test_message_dedup),
+        ("Single Flight", test_single_flight),
+        ("WeChat Send Retries", test_post_json_retries),
+        ("Migration Helpers", test_migration_helpers),
+        ("Result Cache", test_result_cache),
+        ("Message Splitting", test_split_message),
+        ("Outbound Queue", test_outbound_queue),
+        ("Benchmark Summary", test_benchmark_summary),
+        ("Metrics Registry", test_metrics_registry),
+        ("Debug Tools", test_debug_tools),
+        ("Scheduler Lease", test_scheduler_lease),
+        ("Worker Shared State", test_worker_shared_state),
+        ("App Factory", test_app_factory),
+        ("WeChat Callback", test_wechat_callback),
+        ("Reply Dispatcher", test_reply_dispatcher),
+        ("Async Query Handler", test_async_query_handler),
+        ("Replica Selection", test_replica_selection),
+        ("Circuit Breaker", test_circuit_breaker),
         ("Date Calculations", test_date_calculations),
     ]
     
@@ -0,0 +1,208 @@
+"""
+Incrementally maintained counters for today's report
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from config import (
+    TODAY_COUNTERS_ENABLED,
+    TODAY_MAX_STALENESS,
+    TODAY_RESYNC_SECONDS,
+    TODAY_LEADS_OVERLAP_SECONDS,
+    TODAY_ORDERS_OVERLAP_SECONDS,
+)
+
+# Lower bound used when a table was empty at the last baseline
+_EPOCH = datetime(1970, 1, 1)
+
+
+class TodayCounters:
+    """
+    Per-sales leads, orders and revenue for today, kept current by deltas
+
+    A baseline aggregates today's rows in one consistent snapshot and
+    notes the high-water marks (last ``created_at`` of orders and of
+    leads). Each refresh after that re-reads the rows from a few seconds
+    before the marks, drops the ones already counted by ID and adds those
+    dated today. The overlap catches rows committed after rows with a
+    later ``created_at`` (or a higher ``order_id``) and rows sharing a
+    timestamp. Updates, deletes and rows whose transaction stayed open
+    longer than the overlap are not visible to the deltas; a periodic
+    resync rebuilds the baseline to correct them.
+    """
+
+    def __init__(self, max_staleness=TODAY_MAX_STALENESS, resync_seconds=TODAY_RESYNC_SECONDS,
+                 leads_overlap_seconds=TODAY_LEADS_OVERLAP_SECONDS,
+                 orders_overlap_seconds=TODAY_ORDERS_OVERLAP_SECONDS):
+        self.max_staleness = max_staleness
+        self.resync_seconds = resync_seconds
+        self.leads_overlap = timedelta(seconds=leads_overlap_seconds)
+        self.orders_overlap = timedelta(seconds=orders_overlap_seconds)
+        self.day = None
+        self.order_hwm_id = 0
+        self.order_hwm_created_at = None
+        self.lead_hwm_created_at = None
+        self.refreshed_at = None
+        self.synced_at = None
+        self._by_sales = {}
+        self._recent_lead_ids = {}
+        self._recent_order_ids = {}
+        self._lock = threading.Lock()
+
+    def refresh(self, db):
+        """
+        Poll the database and bring the counters up to date
+
+        Rebuilds the baseline on first use, after midnight and every
+        ``resync_seconds``; otherwise applies only the new rows.
+
+        Args:
+            db: Database to read from
+
+        Returns:
+            int: Number of new rows applied (0 after a baseline)
+        """
+        today = datetime.now().date()
+        if (self.day != today or self.synced_at is None
+                or time.time() - self.synced_at >= self.resync_seconds):
+            self._load_baseline(db, today)
+            return 0
+        return self._apply_deltas(db, today)
+
+    def _load_baseline(self, db, today):
+        baseline = db.get_today_baseline(today, self.leads_overlap.total_seconds(),
+                                         self.orders_overlap.total_seconds())
+        by_sales = {}
+        for row in baseline['rows']:
+            by_sales[row['sales']] = [
+                int(row['leads_count'] or 0),
+                int(row['orders_count'] or 0),
+                Decimal(row['total_sales'] or 0),
+            ]
+        now = time.time()
+        with self._lock:
+            self.day = today
+            self._by_sales = by_sales
+            self.order_hwm_id = baseline['order_hwm_id']
+            self.order_hwm_created_at = baseline['order_hwm_created_at'] or _EPOCH
+            self.lead_hwm_created_at = baseline['lead_hwm_created_at'] or _EPOCH
+            self._recent_lead_ids = baseline['recent_lead_ids']
+            self._recent_order_ids = baseline['recent_order_ids']
+            self.refreshed_at = now
+            self.synced_at = now
+
+    def _apply_deltas(self, db, today):
+        orders, leads = db.get_rows_since(self.order_hwm_created_at - self.orders_overlap,
+                                          self.lead_hwm_created_at - self.leads_overlap)
+        applied = 0
+        with self._lock:
+            for row in orders:
+                if row['order_id'] in self._recent_order_ids:
+                    continue
+                self._recent_order_ids[row['order_id']] = row['created_at']
+                if row['order_date'] == today:
+                    counts = self._by_sales.setdefault(row['sales'], [0, 0, Decimal(0)])
+                    counts[1] += 1
+                    counts[2] += Decimal(row['sales_price'] or 0)
+                    applied += 1
+                self.order_hwm_id = max(self.order_hwm_id, row['order_id'])
+                if row['created_at'] > self.order_hwm_created_at:
+                    self.order_hwm_created_at = row['created_at']
+
+            for row in leads:
+                if row['leads_id'] in self._recent_lead_ids:
+                    continue
+                self._recent_lead_ids[row['leads_id']] = row['created_at']
+                if row['leads_date'] == today:
+                    counts = self._by_sales.setdefault(row['sales'], [0, 0, Decimal(0)])
+                    counts[0] += 1
+                    applied += 1
+                if row['created_at'] > self.lead_hwm_created_at:
+                    self.lead_hwm_created_at = row['created_at']
+
+            # Only IDs inside the overlap windows can be seen again
+            floor = self.lead_hwm_created_at - self.leads_overlap
+            self._recent_lead_ids = {
+                leads_id: created_at for leads_id, created_at in self._recent_lead_ids.items()
+                if created_at >= floor
+            }
+            floor = self.order_hwm_created_at - self.orders_overlap
+            self._recent_order_ids = {
+                order_id: created_at for order_id, created_at in self._recent_order_ids.items()
+                if created_at >= floor
+            }
+            self.refreshed_at = time.time()
+        return applied
+
+    def get_stats(self, today=None):
+        """
+        Get today's statistics if the counters are fresh enough to serve
+
+        Args:
+            today: Day the caller reports on, defaults to today
+
+        Returns:
+            tuple: (stats, age_seconds) where stats has the same shape as
+            ``Database.get_combined_stats``, or (None, None) when the
+            counters are not loaded, from another day or older than
+            ``max_staleness``
+        """
+        today = today or datetime.now().date()
+        with self._lock:
+            if self.day != today or self.refreshed_at is None:
+                return None, None
+            age = time.time() - self.refreshed_at
+            if age > self.max_staleness:
+                return None, None
+            by_sales = {sales: list(counts) for sales, counts in self._by_sales.items()}
+
+        leads_by_sales = [
+            {'sales': sales, 'leads_count': counts[0]}
+            for sales, counts in by_sales.items() if counts[0]
+        ]
+        orders_by_sales = [
+            {'sales': sales, 'orders_count': counts[1], 'total_sales': counts[2]}
+            for sales, counts in by_sales.items() if counts[1]
+        ]
+        leads_by_sales.sort(key=lambda r: (-r['leads_count'], r['sales']))
+        orders_by_sales.sort(key=lambda r: (-r['orders_count'], r['sales']))
+        day = today.strftime('%Y-%m-%d')
+        stats = {
+            'leads': {'total_leads': sum(r['leads_count'] for r in leads_by_sales), 'by_sales': leads_by_sales},
+            'orders': {'total_orders': sum(r['orders_count'] for r in orders_by_sales), 'by_sales': orders_by_sales},
+            'start_date': day,
+            'end_date': day
+        }
+        return stats, age
+
+    def stats(self):
+        """
+        Get high-water marks and freshness
+
+        Returns:
+            dict: Day, high-water marks and seconds since the last refresh
+        """
+        with self._lock:
+            return {
+                'day': self.day.strftime('%Y-%m-%d') if self.day else None,
+                'order_hwm_id': self.order_hwm_id,
+                'order_hwm_created_at': str(self.order_hwm_created_at) if self.order_hwm_created_at else None,
+                'lead_hwm_created_at': str(self.lead_hwm_created_at) if self.lead_hwm_created_at else None,
+                'age_seconds': round(time.time() - self.refreshed_at, 1) if self.refreshed_at else None,
+            }
+
+
+_default_counters = None
+_default_counters_lock = threading.Lock()
+
+
+def get_default_today_counters():
+    """Return the process-wide counters, or None when they are disabled"""
+    global _default_counters
+    if not TODAY_COUNTERS_ENABLED:
+        return None
+    with _default_counters_lock:
+        if _default_counters is None:
+            _default_counters = TodayCounters()
+        return _default_counters
@@ -1,9 +1,420 @@
 """
 WeChat Work Bot messaging module
 """
+import atexit
 import requests
 import json
-from config import WECHAT_WEBHOOK_URL
+import random
+import threading
+import time
+from collections import deque
+from requests.adapters import HTTPAdapter
+from config import (
+    WECHAT_WEBHOOK_URL,
+    WECHAT_CORP_ID,
+    WECHAT_CORP_SECRET,
+    WECHAT_AGENT_ID,
+    WECHAT_CONNECT_TIMEOUT,
+    WECHAT_READ_TIMEOUT,
+    WECHAT_HTTP_POOL_SIZE,
+    WECHAT_SEND_RETRIES,
+    WECHAT_RETRY_BACKOFF,
+    WECHAT_RATE_LIMIT_RETRIES,
+    WECHAT_RATE_LIMIT_BACKOFF,
+    WECHAT_RATE_LIMIT_MAX_WAIT,
+    WECHAT_WEBHOOK_RATE_PER_MINUTE,
+    WECHAT_TEXT_MAX_BYTES,
+    WECHAT_MARKDOWN_MAX_BYTES,
+)
+from metrics import WECHAT_SEND_SECONDS, ERRORS
+
+# WeChat errcodes
+ERRCODE_SYSTEM_BUSY = -1
+ERRCODE_RATE_LIMITED = 45009
+
+
+class _TransientHTTPError(Exception):
+    """A 5xx response that is worth retrying"""
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the process-wide keep-alive HTTP session for WeChat APIs"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=WECHAT_HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def _backoff(base, attempt):
+    """Full-jitter exponential backoff in seconds"""
+    return random.uniform(0, base * (2 ** attempt))
+
+
+def _rate_limit_delay(retried, waited):
+    """
+    Seconds to wait before retrying a rate-limited (45009) request
+
+    The n-th retry waits n * WECHAT_RATE_LIMIT_BACKOFF seconds plus jitter,
+    cut so that all of them together stay within WECHAT_RATE_LIMIT_MAX_WAIT.
+
+    Args:
+        retried: Rate-limit retries already made
+        waited: Seconds already spent waiting on them
+
+    Returns:
+        float: The delay, or None to give up and return the 45009 response
+    """
+    budget = WECHAT_RATE_LIMIT_MAX_WAIT - waited
+    if retried >= WECHAT_RATE_LIMIT_RETRIES or budget <= 0:
+        return None
+    delay = WECHAT_RATE_LIMIT_BACKOFF * (1 + retried) + random.uniform(0, WECHAT_RATE_LIMIT_BACKOFF)
+    return min(delay, budget)
+
+
+def post_json(url, data, params=None):
+    """
+    POST a JSON body to a WeChat API and return the decoded response
+
+    Connection failures, 5xx responses and errcode -1 are retried up to
+    WECHAT_SEND_RETRIES times with jittered exponential backoff. Rate
+    limiting (errcode 45009) is retried up to WECHAT_RATE_LIMIT_RETRIES times
+    with a longer backoff, so the message is delayed rather than dropped,
+    but for no more than WECHAT_RATE_LIMIT_MAX_WAIT seconds in total.
+    Read timeouts are not retried: WeChat may already have delivered the
+    message, and a retry would post it twice.
+
+    Args:
+        url: API URL
+        data: JSON-serialisable body
+        params: Optional query string parameters
+
+    Returns:
+        dict: Decoded JSON response (the last one, if retries ran out)
+
+    Raises:
+        requests.RequestException: If the request could not be completed
+    """
+    body = json.dumps(data)
+    attempt = 0
+    rate_limited = 0
+    rate_limit_waited = 0.0
+    while True:
+        try:
+            response = get_session().post(
+                url,
+                params=params,
+                data=body,
+                headers={'Content-Type': 'application/json'},
+                timeout=(WECHAT_CONNECT_TIMEOUT, WECHAT_READ_TIMEOUT)
+            )
+            if response.status_code >= 500:
+                raise _TransientHTTPError(f"HTTP {response.status_code}")
+            result = response.json()
+        except (requests.ConnectionError, _TransientHTTPError) as e:
+            if attempt >= WECHAT_SEND_RETRIES:
+                if isinstance(e, _TransientHTTPError):
+                    return {'errcode': ERRCODE_SYSTEM_BUSY, 'errmsg': str(e)}
+                raise
+            delay = _backoff(WECHAT_RETRY_BACKOFF, attempt)
+            print(f"WeChat request failed ({str(e)}), retrying in {delay:.1f}s")
+            attempt += 1
+            time.sleep(delay)
+            continue
+
+        errcode = result.get('errcode')
+        delay = _rate_limit_delay(rate_limited, rate_limit_waited) if errcode == ERRCODE_RATE_LIMITED else None
+        if delay is not None:
+            print(f"WeChat rate limit hit, retrying in {delay:.1f}s")
+            rate_limited += 1
+            rate_limit_waited += delay
+            time.sleep(delay)
+            continue
+        if errcode == ERRCODE_SYSTEM_BUSY and attempt < WECHAT_SEND_RETRIES:
+            delay = _backoff(WECHAT_RETRY_BACKOFF, attempt)
+            print(f"WeChat system busy, retrying in {delay:.1f}s")
+            attempt += 1
+            time.sleep(delay)
+            continue
+        return result
+
+
+def _utf8_len(text):
+    return len(text.encode('utf-8'))
+
+
+def _split_long_line(line, max_bytes):
+    """Cut a single line into pieces of at most max_bytes, between characters"""
+    if _utf8_len(line) <= max_bytes:
+        return [line]
+    pieces = []
+    current = []
+    size = 0
+    for char in line:
+        char_size = _utf8_len(char)
+        if current and size + char_size > max_bytes:
+            pieces.append(''.join(current))
+            current = []
+            size = 0
+        current.append(char)
+        size += char_size
+    if current:
+        pieces.append(''.join(current))
+    return pieces
+
+
+def split_message(content, max_bytes=WECHAT_TEXT_MAX_BYTES):
+    """
+    Split a message into chunks that fit WeChat's byte limit
+
+    Chunks break at line boundaries; a single line longer than the limit is
+    cut between characters, so multi-byte UTF-8 characters are never split.
+
+    Args:
+        content: Message content
+        max_bytes: Maximum UTF-8 size of each chunk
+
+    Returns:
+        list: Message chunks, in order
+    """
+    if _utf8_len(content) <= max_bytes:
+        return [content]
+    chunks = []
+    current = []
+    size = 0
+    for line in content.split('\n'):
+        for piece in _split_long_line(line, max_bytes):
+            piece_size = _utf8_len(piece)
+            added = piece_size + (1 if current else 0)
+            if current and size + added > max_bytes:
+                chunks.append('\n'.join(current))
+                current = []
+                size = 0
+                added = piece_size
+            current.append(piece)
+            size += added
+    if current:
+        chunks.append('\n'.join(current))
+    chunks = [chunk.strip('\n') for chunk in chunks]
+    return [chunk for chunk in chunks if chunk]
+
+
+class SlidingWindowLimiter:
+    """
+    Thread-safe limiter allowing at most ``limit`` calls in any ``window`` seconds
+
+    The group robot counts messages per rolling minute, so a token bucket
+    that starts full would allow a burst on top of the refill rate; this
+    keeps the send times of the last window and waits for the oldest one
+    to leave it.
+    """
+
+    def __init__(self, limit, window=60.0):
+        self.limit = max(int(limit), 1)
+        self.window = window
+        self._sent_at = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Record one call, sleeping until the window has room for it"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._sent_at and now - self._sent_at[0] >= self.window:
+                    self._sent_at.popleft()
+                if len(self._sent_at) < self.limit:
+                    self._sent_at.append(now)
+                    return
+                wait = self._sent_at[0] + self.window - now
+            time.sleep(wait)
+
+
+class OutboundQueue:
+    """
+    Background sender for a group robot webhook
+
+    Callers enqueue and return immediately. A sender thread sends at most
+    ``rate_per_minute`` messages in any 60 seconds, so the webhook's limit
+    is respected; consecutive messages from the same source that pile up
+    meanwhile are merged into as few messages as the size limit allows.
+    Messages from different sources (or without one) are always sent
+    separately. A caller that must know about a failed send (e.g. to retry
+    it later) passes ``on_failed``; it is called once from the sender
+    thread if any part of the message could not be sent.
+    """
+
+    def __init__(self, bot, rate_per_minute=WECHAT_WEBHOOK_RATE_PER_MINUTE):
+        self.bot = bot
+        self.limiter = SlidingWindowLimiter(rate_per_minute)
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._sending = False
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+
+    def enqueue(self, content, msgtype='text', source=None, on_failed=None):
+        """
+        Queue a message for sending
+
+        Args:
+            content: Message content; split if it exceeds the size limit
+            msgtype: 'text' or 'markdown'
+            source: What produced the message (e.g. 'daily_report'); only
+                messages with the same source are merged
+            on_failed: Optional callable with no arguments, called once if
+                the message (or any part of it) fails to send
+        """
+        if on_failed is not None:
+            on_failed = _Once(on_failed)
+        with self._cond:
+            for chunk in split_message(content, self._max_bytes(msgtype)):
+                self._queue.append((msgtype, source, chunk, on_failed))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='wechat-outbound', daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    @staticmethod
+    def _max_bytes(msgtype):
+        return WECHAT_MARKDOWN_MAX_BYTES if msgtype == 'markdown' else WECHAT_TEXT_MAX_BYTES
+
+    def _next_message(self):
+        """Pop the next message, merging queued messages of the same type and source that still fit"""
+        msgtype, source, content, on_failed = self._queue.popleft()
+        callbacks = [on_failed] if on_failed is not None else []
+        max_bytes = self._max_bytes(msgtype)
+        while source is not None and self._queue and self._queue[0][:2] == (msgtype, source):
+            merged = content + '\n\n' + self._queue[0][2]
+            if _utf8_len(merged) > max_bytes:
+                break
+            content = merged
+            if self._queue[0][3] is not None:
+                callbacks.append(self._queue[0][3])
+            self._queue.popleft()
+            self.coalesced += 1
+        return msgtype, content, callbacks
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+            self.limiter.acquire()
+            with self._cond:
+                msgtype, content, callbacks = self._next_message()
+                self._sending = True
+            try:
+                if msgtype == 'markdown':
+                    ok = self.bot.send_markdown_message(content)
+                else:
+                    ok = self.bot.send_text_message(content)
+            except Exception as e:
+                print(f"Error in outbound sender: {str(e)}")
+                ok = False
+            if not ok:
+                for on_failed in callbacks:
+                    on_failed()
+            with self._cond:
+                self._sending = False
+                if ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued message has been sent
+
+        Returns:
+            bool: True if the queue drained within timeout
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            while self._queue or self._sending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def stats(self):
+        """
+        Get queue counters
+
+        Returns:
+            dict: Queued, sent, failed and coalesced message counts
+        """
+        with self._cond:
+            return {
+                'queued': len(self._queue),
+                'sent': self.sent,
+                'failed': self.failed,
+                'coalesced': self.coalesced,
+            }
+
+
+class _Once:
+    """Wrap an on_failed callback so it runs at most once across a message's chunks"""
+
+    def __init__(self, callback):
+        self.callback = callback
+        self._called = False
+
+    def __call__(self):
+        if self._called:
+            return
+        self._called = True
+        try:
+            self.callback()
+        except Exception as e:
+            print(f"Error in outbound failure callback: {str(e)}")
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_outbound_queue(webhook_url):
+    """Return the shared outbound queue for a webhook, creating it on first use"""
+    with _queues_lock:
+        queue = _queues.get(webhook_url)
+        if queue is None:
+            queue = OutboundQueue(WeChatBot(webhook_url))
+            _queues[webhook_url] = queue
+        return queue
+
+
+def flush_outbound_queues(timeout=10):
+    """Give queued messages a chance to go out, e.g. at shutdown"""
+    with _queues_lock:
+        queues = list(_queues.values())
+    for queue in queues:
+        queue.flush(timeout)
+
+
+def outbound_queue_stats():
+    """Get queue counters summed over every webhook (URLs carry the robot key, so they are not listed)"""
+    with _queues_lock:
+        queues = list(_queues.values())
+    totals = {'queued': 0, 'sent': 0, 'failed': 0, 'coalesced': 0}
+    for queue in queues:
+        for name, value in queue.stats().items():
+            totals[name] += value
+    return totals
+
+
+atexit.register(flush_outbound_queues)
 
 
 class WeChatBot:
@@ -12,6 +423,7 @@ class WeChatBot:
     def __init__(self, webhook_url=None):
         self.webhook_url = webhook_url or WECHAT_WEBHOOK_URL
     
+    @WECHAT_SEND_SECONDS.time(channel='webhook_text')
     def send_text_message(self, content):
         """
         Send a text message through WeChat Work Bot
@@ -34,23 +446,21 @@ class WeChatBot:
         }
         
         try:
-            response = requests.post(
-                self.webhook_url,
-                data=json.dumps(data),
-                headers={'Content-Type': 'application/json'}
-            )
-            result = response.json()
+            result = post_json(self.webhook_url, data)
             
             if result.get('errcode') == 0:
                 print(f"Message sent successfully: {content[:50]}...")
                 return True
             else:
                 print(f"Failed to send message: {result}")
+                ERRORS.inc(where='wechat_send')
                 return False
         except Exception as e:
             print(f"Error sending message: {str(e)}")
+            ERRORS.inc(where='wechat_send')
             return False
     
+    @WECHAT_SEND_SECONDS.time(channel='webhook_markdown')
     def send_markdown_message(self, content):
         """
         Send a markdown message through WeChat Work Bot
@@ -73,19 +483,154 @@ class WeChatBot:
         }
         
         try:
-            response = requests.post(
-                self.webhook_url,
-                data=json.dumps(data),
-                headers={'Content-Type': 'application/json'}
-            )
-            result = response.json()
+            result = post_json(self.webhook_url, data)
             
             if result.get('errcode') == 0:
                 print(f"Markdown message sent successfully")
                 return True
             else:
                 print(f"Failed to send markdown message: {result}")
+                ERRORS.inc(where='wechat_send')
                 return False
         except Exception as e:
             print(f"Error sending markdown message: {str(e)}")
+            ERRORS.inc(where='wechat_send')
+            return False
+
+    def enqueue_text_message(self, content, source=None, on_failed=None):
+        """
+        Queue a text message for the background sender and return at once
+
+        Long messages are split at line boundaries and sends are paced to the
+        webhook's rate limit.
+
+        Args:
+            content: Message content to send
+            source: What produced the message; queued messages are only
+                merged with others from the same source
+            on_failed: Optional callable, called once if the send fails
+
+        Returns:
+            bool: True if queued, False if the webhook is not configured
+        """
+        if not self.webhook_url:
+            print("Warning: WeChat webhook URL not configured")
+            return False
+        get_outbound_queue(self.webhook_url).enqueue(content, 'text', source, on_failed)
+        return True
+
+    def enqueue_markdown_message(self, content, source=None, on_failed=None):
+        """
+        Queue a markdown message for the background sender and return at once
+
+        Args:
+            content: Markdown content to send
+            source: What produced the message; queued messages are only
+                merged with others from the same source
+            on_failed: Optional callable, called once if the send fails
+
+        Returns:
+            bool: True if queued, False if the webhook is not configured
+        """
+        if not self.webhook_url:
+            print("Warning: WeChat webhook URL not configured")
+            return False
+        get_outbound_queue(self.webhook_url).enqueue(content, 'markdown', source, on_failed)
+        return True
+
+
+class WeChatAppClient:
+    """WeChat Work app message API client for pushing messages to users"""
+
+    TOKEN_URL = 'https://qyapi.weixin.qq.com/cgi-bin/gettoken'
+    SEND_URL = 'https://qyapi.weixin.qq.com/cgi-bin/message/send'
+
+    def __init__(self, corp_id=None, corp_secret=None, agent_id=None):
+        self.corp_id = corp_id or WECHAT_CORP_ID
+        self.corp_secret = corp_secret or WECHAT_CORP_SECRET
+        self.agent_id = agent_id or WECHAT_AGENT_ID
+        self._access_token = None
+        self._token_expires_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def configured(self):
+        """Whether the corp ID, secret and agent ID are all set"""
+        return bool(self.corp_id and self.corp_secret and self.agent_id)
+
+    def get_access_token(self, force_refresh=False):
+        """
+        Get a cached access token, fetching a new one when it is about to expire
+
+        Args:
+            force_refresh: Ignore the cached token
+
+        Returns:
+            str: Access token
+        """
+        with self._lock:
+            if force_refresh or not self._access_token or time.time() >= self._token_expires_at:
+                response = get_session().get(
+                    self.TOKEN_URL,
+                    params={'corpid': self.corp_id, 'corpsecret': self.corp_secret},
+                    timeout=(WECHAT_CONNECT_TIMEOUT, WECHAT_READ_TIMEOUT)
+                )
+                result = response.json()
+                if result.get('errcode') != 0:
+                    raise RuntimeError(f"Failed to get access token: {result}")
+                self._access_token = result['access_token']
+                # Refresh a few minutes before WeChat expires the token
+                self._token_expires_at = time.time() + result.get('expires_in', 7200) - 300
+            return self._access_token
+
+    @WECHAT_SEND_SECONDS.time(channel='app_text')
+    def send_text_message(self, touser, content):
+        """
+        Push a text message to users through the app
+
+        Args:
+            touser: User ID, or several joined with '|'
+            content: Message content to send
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        if not self.configured:
+            print("Warning: WeChat app credentials not configured")
+            return False
+
+        data = {
+            "touser": touser,
+            "msgtype": "text",
+            "agentid": self.agent_id,
+            "text": {
+                "content": content
+            }
+        }
+
+        try:
+            # App text messages are capped at 2048 bytes too
+            for chunk in split_message(content, WECHAT_TEXT_MAX_BYTES):
+                data["text"]["content"] = chunk
+                result = {}
+                for attempt in range(2):
+                    result = post_json(
+                        self.SEND_URL,
+                        data,
+                        params={'access_token': self.get_access_token(force_refresh=attempt > 0)}
+                    )
+                    # 40014/42001: invalid or expired token, fetch a new one and retry once
+                    if result.get('errcode') not in (40014, 42001):
+                        break
+
+                if result.get('errcode') != 0:
+                    print(f"Failed to send app message: {result}")
+                    ERRORS.inc(where='wechat_send')
+                    return False
+
+            print(f"App message sent successfully to {touser}: {content[:50]}...")
+            return True
+        except Exception as e:
+            print(f"Error sending app message: {str(e)}")
+            ERRORS.inc(where='wechat_send')
             return False